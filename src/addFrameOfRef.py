@@ -1,37 +1,93 @@
 #!/usr/bin/env python3
 
+import argparse
+import functools
+import operator
 import os
 import sys
-import pydicom
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
 from pydicom.uid import generate_uid
 
-def set_frame_of_reference(directory):
+import dicom_scan
+import modify_dicom_tag
+
+FRAME_OF_REFERENCE_UID_TAG = Tag(0x0020, 0x0052)
+
+
+def has_frame_of_reference(dicom_path):
+    """Check for a FrameOfReferenceUID, reading the header only up to tag (0020,0052)."""
+    with open(dicom_path, 'rb') as f:
+        ds = read_partial(f, stop_when=lambda tag, VR, length: tag > FRAME_OF_REFERENCE_UID_TAG, specific_tags=[FRAME_OF_REFERENCE_UID_TAG])
+    return bool(ds.get('FrameOfReferenceUID'))
+
+def set_frame_of_reference_batch(dicom_paths, frame_of_reference_uid):
+    failures = 0
+    for dicom_path in dicom_paths:
+        try:
+            modify_dicom_tag.patch_dicom_file(dicom_path, {'FrameOfReferenceUID': frame_of_reference_uid})
+            print(f"Set FrameOfReferenceUID for {os.path.basename(dicom_path)}")
+        except Exception as e:
+            print(f"Failed to process {dicom_path}: {e}")
+            failures += 1
+    return failures
+
+def apply_frame_of_reference(directory, pool=None):
+    """
+    Give all DICOM files of a directory a new shared FrameOfReferenceUID.
+
+    Returns (file name, reason) for the first file that already has a FrameOfReferenceUID or cannot be read,
+    in which case nothing is changed.
+    """
     dicom_files = [f for f in os.listdir(directory) if f.endswith('.dcm')]
-    
+    dicom_paths = [os.path.join(directory, dicom_file) for dicom_file in dicom_files]
+
     # Check if any DICOM file has a FrameOfReferenceUID set
-    for dicom_file in dicom_files:
-        dicom_path = os.path.join(directory, dicom_file)
-        ds = pydicom.dcmread(dicom_path)
-        
-        if hasattr(ds, 'FrameOfReferenceUID') and ds.FrameOfReferenceUID:
-            print(f"Warning: DICOM file {dicom_file} already has a FrameOfReferenceUID set. Exiting.")
-            sys.exit(1)
+    for dicom_path in dicom_paths:
+        try:
+            found = has_frame_of_reference(dicom_path)
+        except Exception as e:
+            return os.path.basename(dicom_path), f"can not be read ({e})"
+        if found:
+            return os.path.basename(dicom_path), "already has a FrameOfReferenceUID set"
 
     # Generate a FrameOfReferenceUID
     frame_of_reference_uid = generate_uid()
 
-    # Set the FrameOfReferenceUID for all DICOM files
-    for dicom_file in dicom_files:
-        dicom_path = os.path.join(directory, dicom_file)
-        ds = pydicom.dcmread(dicom_path)
-        ds.FrameOfReferenceUID = frame_of_reference_uid
-        ds.save_as(dicom_path)
-        print(f"Set FrameOfReferenceUID for {dicom_file}")
+    # Set the FrameOfReferenceUID for all DICOM files, only their headers are rewritten
+    set_batch = functools.partial(set_frame_of_reference_batch, frame_of_reference_uid=frame_of_reference_uid)
+    dicom_scan.scan_files(dicom_paths, set_batch, operator.add, 0, pool)
+    return None
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: script_name.py <directory_path>")
+def set_frame_of_reference(directory, workers=None, use_threads=False):
+    skipped = dicom_scan.run_with_pool(functools.partial(apply_frame_of_reference, directory), workers, use_threads)
+    if skipped is not None:
+        dicom_file, reason = skipped
+        print(f"Warning: DICOM file {dicom_file} {reason}. Exiting.")
         sys.exit(1)
-    
-    directory_path = sys.argv[1]
-    set_frame_of_reference(directory_path)
+
+def set_frame_of_reference_recursive(directory, workers=None, use_threads=False):
+    """Treat every directory containing DICOM files as its own series with its own FrameOfReferenceUID."""
+    def apply_to_all(pool):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            if any(f.endswith('.dcm') for f in filenames):
+                print(f"Processing series directory {dirpath}")
+                skipped = apply_frame_of_reference(dirpath, pool)
+                if skipped is not None:
+                    dicom_file, reason = skipped
+                    print(f"Warning: DICOM file {dicom_file} {reason}. Skipping {dirpath}.")
+
+    dicom_scan.run_with_pool(apply_to_all, workers, use_threads)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set a new FrameOfReferenceUID on all DICOM files of a series directory.", usage="addFrameOfRef.py <directory_path> [--recursive] [--workers N] [--threads]")
+    parser.add_argument("directory", help="Path to the series directory.")
+    parser.add_argument("--recursive", action="store_true", help="Process every directory below directory_path as a separate series, each with its own FrameOfReferenceUID.")
+    dicom_scan.add_scan_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.recursive:
+        set_frame_of_reference_recursive(args.directory, args.workers, args.threads)
+    else:
+        set_frame_of_reference(args.directory, args.workers, args.threads)
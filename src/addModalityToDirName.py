@@ -1,11 +1,52 @@
 #!/usr/bin/env python3
 
+import argparse
+import functools
 import os
-import pydicom
 import shutil
-import sys
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
 
-def extract_modalities_from_directory(directory):
+import dicom_scan
+import dicom_stats
+
+MODALITY_TAG = Tag(0x0008, 0x0060)
+
+
+def scan_modalities_batch(filepaths):
+    modalities = set()
+
+    for filepath in filepaths:
+        try:
+            ds = dicom_scan.read_header(filepath, ["Modality"])
+            modality = ds.Modality
+            modalities.add(modality)
+        except Exception as e:
+            print(f"Error reading {filepath}: {e}")
+
+    return modalities
+
+def extract_modalities_from_directory(directory, pool=None):
+    return dicom_scan.scan_files(dicom_scan.iter_files(directory, extension=None), scan_modalities_batch, dicom_scan.merge_sets, set(), pool)
+
+def read_modality(filepath):
+    """Return the Modality of a file, or None when it is not a DICOM file (no 'DICM' prefix after the preamble)."""
+    dicom_stats.add("files")
+    with dicom_stats.timed("read_modality"), open(filepath, 'rb') as f:
+        if f.read(132)[128:] != b'DICM':
+            return None
+        f.seek(0)
+        # Stop reading as soon as the header gets past (0008,0060)
+        ds = read_partial(f, stop_when=lambda tag, VR, length: tag > MODALITY_TAG, specific_tags=[MODALITY_TAG])
+        dicom_stats.add("bytes_read", f.tell())
+    return ds.Modality
+
+def extract_modalities_fast(directory, sample=False):
+    """
+    Collect the modalities below directory reading each header only up to the Modality, silently skipping non DICOM files.
+
+    With sample only the first DICOM file of every directory is read, assuming each series is stored in its own directory.
+    """
     modalities = set()
 
     for dirpath, dirnames, filenames in os.walk(directory):
@@ -13,11 +54,16 @@ def extract_modalities_from_directory(directory):
             filepath = os.path.join(dirpath, filename)
 
             try:
-                ds = pydicom.dcmread(filepath)
-                modality = ds.Modality
-                modalities.add(modality)
+                modality = read_modality(filepath)
             except Exception as e:
                 print(f"Error reading {filepath}: {e}")
+                continue
+
+            if modality is None:
+                continue
+            modalities.add(modality)
+            if sample:
+                break
 
     return modalities
 
@@ -33,19 +79,36 @@ def rename_directory(directory, modalities):
         shutil.move(directory, new_directory_path)
         print(f"Renamed {directory} to {new_directory_name}")
 
-def main(directory=None):
+def rename_all(sub_directories, pool, fast=False, sample=False):
+    if fast or sample:
+        # Every sub-directory is scanned by a single worker, so many sub-directories are processed concurrently
+        extract = functools.partial(extract_modalities_fast, sample=sample)
+        all_modalities = dicom_scan.imap(extract, sub_directories, pool)
+    else:
+        # The files of one sub-directory at a time are spread over the pool
+        all_modalities = (extract_modalities_from_directory(sub_directory, pool) for sub_directory in sub_directories)
+
+    for sub_directory, modalities in zip(sub_directories, all_modalities):
+        rename_directory(sub_directory, modalities)
+
+def main(directory=None, workers=None, use_threads=False, fast=False, sample=False):
     if directory is None:
         directory = os.getcwd()
 
     # Get all sub-directories in the provided directory
     sub_directories = [os.path.join(directory, d) for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
 
-    for sub_directory in sub_directories:
-        modalities = extract_modalities_from_directory(sub_directory)
-        rename_directory(sub_directory, modalities)
+    # One pool is shared by all sub-directories
+    dicom_scan.run_with_pool(functools.partial(rename_all, sub_directories, fast=fast, sample=sample), workers, use_threads)
 
 if __name__ == "__main__":
-    directory = None
-    if len(sys.argv) > 1:
-        directory = sys.argv[1]
-    main(directory)
+    parser = argparse.ArgumentParser(description="Prefix every sub-directory with the modalities of the DICOM files it contains.", usage="addModalityToDirName.py [directory_path] [--fast] [--sample] [--workers N] [--threads] [--stats [JSON_PATH]]")
+    parser.add_argument("directory", nargs="?", default=None, help="Directory whose sub-directories are renamed. Defaults to the current directory.")
+    parser.add_argument("--fast", action="store_true", help="Read each header only up to the Modality and silently skip files without the DICM prefix.")
+    parser.add_argument("--sample", action="store_true", help="Read only the first DICOM file of every directory, assuming each series is stored in its own directory. Implies --fast.")
+    dicom_scan.add_scan_arguments(parser)
+    dicom_stats.add_stats_arguments(parser)
+
+    args = parser.parse_args()
+    dicom_stats.enable_from_arguments(args)
+    main(args.directory, args.workers, args.threads, args.fast, args.sample)
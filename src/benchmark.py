@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the core function of every script.
+#
+# Each benchmark runs in its own process, so that its peak RSS is not
+# hidden by the ones that ran before, with the output of the scripts sent
+# to /dev/null. The peak RSS only covers the timed run: on Linux it is
+# reset once the input of the benchmark is prepared, and read from VmHWM,
+# which unlike ru_maxrss does not carry over the peak of the benchmark.py
+# process that started the child. Files/sec and MB/sec are computed from the files each
+# benchmark goes through. The upload and download benchmarks talk to
+# fake_orthanc.py, started as a separate process. The results are saved as
+# JSON, and compared with the ones of a previous run when a baseline is
+# given, to catch regressions.
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import glob
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import dicom_scan
+import generate_corpus
+
+# Corpus generated when --corpus does not exist yet, --patients scales it
+CORPUS_OPTIONS = {"studies": 2, "series": 3, "instances": 25, "multiframe": 2, "noise": 3, "transfer_syntax": "mixed"}
+
+JPEG_COUNT = 50
+
+COMPARE_PAIRS = 50
+
+REPORT_TAGS = ["PatientID", "StudyDate", "Modality", "SeriesDescription"]
+
+
+def dicom_files(directory):
+    return sorted(dicom_scan.iter_files(directory))
+
+def all_files(directory):
+    return sorted(dicom_scan.iter_files(directory, extension=None))
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def copy_corpus(corpus, work_dir):
+    target = os.path.join(work_dir, "corpus")
+    shutil.copytree(corpus, target)
+    return target
+
+@contextlib.contextmanager
+def fake_orthanc(load=None):
+    """Run fake_orthanc.py in its own process, yielding its base URL."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_orthanc.py"), "--port", "0"]
+    if load:
+        command += ["--load", load]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        for line in process.stdout:
+            if line.startswith("Serving on "):
+                url = line.split()[-1]
+                break
+        else:
+            raise Exception("fake_orthanc.py did not start")
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+def list_patients(url):
+    with urllib.request.urlopen(f"{url}/patients") as response:
+        return json.load(response)
+
+# Every benchmark prepares its input in work_dir and returns the function to time, with the files it goes through.
+# Servers are entered into the resources exit stack, which is only closed once the peak RSS was measured.
+# Only the function to time may use worker processes.
+
+def bench_scan_two_tags(corpus, work_dir, workers, use_threads, resources):
+    import generalScanTwoTags
+
+    files = dicom_files(corpus)
+    return lambda: generalScanTwoTags.scan_directory_for_dicom(corpus, "Modality", "BodyPartExamined", workers, use_threads), files
+
+def bench_scan_modality_bodyparts(corpus, work_dir, workers, use_threads, resources):
+    scan_modality_bodyparts = importlib.import_module("scan-modality-bodyparts")
+
+    files = dicom_files(corpus)
+    return lambda: scan_modality_bodyparts.scan_directory_for_dicom(corpus, workers, use_threads), files
+
+def bench_report(corpus, work_dir, workers, use_threads, resources):
+    import create_report_for_tags
+
+    files = dicom_files(corpus)
+    return lambda: create_report_for_tags.scan_directory_for_dicom(corpus, REPORT_TAGS, False, workers, use_threads), files
+
+def bench_index_cold(corpus, work_dir, workers, use_threads, resources):
+    import dicom_index
+
+    files = dicom_files(corpus)
+    index_path = os.path.join(work_dir, "index.sqlite")
+    return lambda: dicom_index.update_index(corpus, index_path, workers, use_threads), files
+
+def bench_index_warm(corpus, work_dir, workers, use_threads, resources):
+    import dicom_index
+
+    files = dicom_files(corpus)
+    index_path = os.path.join(work_dir, "index.sqlite")
+    # Without a worker pool, so that no finished child process adds its peak RSS to the measured one
+    dicom_index.update_index(corpus, index_path, workers=1)
+    return lambda: list(dicom_index.query_index(corpus, dicom_index.update_index(corpus, index_path, workers, use_threads), REPORT_TAGS, index_path)), files
+
+def bench_modify_tag(corpus, work_dir, workers, use_threads, resources):
+    import modify_dicom_tag
+
+    target = copy_corpus(corpus, work_dir)
+    return lambda: modify_dicom_tag.update_dicom_tags_in_directory(target, {"BodyPartExamined": "PHANTOM"}, workers=workers, use_threads=use_threads), dicom_files(target)
+
+def bench_modify_tag_patch(corpus, work_dir, workers, use_threads, resources):
+    import modify_dicom_tag
+
+    target = copy_corpus(corpus, work_dir)
+    return lambda: modify_dicom_tag.update_dicom_tags_in_directory(target, {"BodyPartExamined": "PHANTOM"}, patch=True, workers=workers, use_threads=use_threads), dicom_files(target)
+
+def bench_compare_files(corpus, work_dir, workers, use_threads, resources):
+    import compareTwoFiles
+
+    # Neighbouring slices of the same series
+    files = [path for path in dicom_files(corpus) if "noise" not in path]
+    pairs = [(file1, file2) for file1, file2 in zip(files[0::2], files[1::2]) if os.path.dirname(file1) == os.path.dirname(file2)][:COMPARE_PAIRS]
+
+    def run():
+        for file1, file2 in pairs:
+            compareTwoFiles.compare_dicom_tags(file1, file2, pixels=True)
+
+    return run, [path for pair in pairs for path in pair]
+
+def bench_compare_directories(corpus, work_dir, workers, use_threads, resources):
+    import compareTwoFiles
+
+    copy = copy_corpus(corpus, work_dir)
+    return lambda: compareTwoFiles.compare_directories(corpus, copy, workers=workers, use_threads=use_threads, pixels=True), dicom_files(corpus) + dicom_files(copy)
+
+def write_jpegs(corpus, work_dir):
+    """Write JPEG images made from the first slices of the corpus, returning their directory and the example DICOM file."""
+    import numpy as np
+    import pydicom
+    from PIL import Image
+
+    directory = os.path.join(work_dir, "jpegs")
+    os.makedirs(directory)
+    examples = [path for path in dicom_files(corpus) if "noise" not in path]
+    for index in range(JPEG_COUNT):
+        pixels = pydicom.dcmread(examples[index % len(examples)]).pixel_array
+        if pixels.ndim == 3:
+            pixels = pixels[0]
+        gray = ((pixels - pixels.min()) * (255.0 / max(int(pixels.max()) - int(pixels.min()), 1))).astype(np.uint8)
+        Image.fromarray(np.stack([gray, np.roll(gray, index, axis=0), np.roll(gray, index, axis=1)], axis=-1)).save(os.path.join(directory, f"image{index:04d}.jpg"), quality=90)
+    return directory, examples[0]
+
+def bench_jpg_2_dcm(corpus, work_dir, workers, use_threads, resources, passthrough=False):
+    import jpg_2_dcm
+
+    directory, example = write_jpegs(corpus, work_dir)
+    output = os.path.join(work_dir, "output")
+    return lambda: jpg_2_dcm.convert_series(directory, example, output, workers, use_threads, passthrough), all_files(directory)
+
+def bench_jpg_2_dcm_passthrough(corpus, work_dir, workers, use_threads, resources):
+    return bench_jpg_2_dcm(corpus, work_dir, workers, use_threads, resources, passthrough=True)
+
+def bench_create_slices(corpus, work_dir, workers, use_threads, resources):
+    import create_slice_in_series
+
+    # The slices of the first series are stamped with the header of the first slice of the second one
+    files = [path for path in dicom_files(corpus) if "noise" not in path]
+    series = sorted({os.path.dirname(path) for path in files})
+    target = next(path for path in files if os.path.dirname(path) == series[min(1, len(series) - 1)])
+    inputs = [path for path in files if os.path.dirname(path) == series[0]]
+    source = os.path.join(glob.escape(series[0]), "*_[0-9][0-9][0-9][0-9][0-9].dcm")
+    output = os.path.join(work_dir, "output")
+    return lambda: create_slice_in_series.create_slices(source, target, output, 1, [0, 0, 2.5], workers=workers, use_threads=use_threads), inputs
+
+def bench_export(corpus, work_dir, workers, use_threads, resources):
+    import exportToOrthanc
+
+    files = all_files(corpus)
+    url = resources.enter_context(fake_orthanc())
+    return lambda: asyncio.run(exportToOrthanc.Export(url, corpus, concurrency=workers or 4)), files
+
+def bench_download(corpus, work_dir, workers, use_threads, resources, instances=False):
+    import downloadPatients
+
+    url = resources.enter_context(fake_orthanc(load=corpus))
+    patients = list_patients(url)
+    output = os.path.join(work_dir, "output")
+
+    def run():
+        downloadPatients.main(url, patients, output, workers or 4, instances)
+        return all_files(output)
+
+    return run, None
+
+def bench_download_instances(corpus, work_dir, workers, use_threads, resources):
+    return bench_download(corpus, work_dir, workers, use_threads, resources, instances=True)
+
+BENCHMARKS = {
+    "scan_two_tags": bench_scan_two_tags,
+    "scan_modality_bodyparts": bench_scan_modality_bodyparts,
+    "report": bench_report,
+    "index_cold": bench_index_cold,
+    "index_warm": bench_index_warm,
+    "modify_tag": bench_modify_tag,
+    "modify_tag_patch": bench_modify_tag_patch,
+    "compare_files": bench_compare_files,
+    "compare_directories": bench_compare_directories,
+    "jpg_2_dcm": bench_jpg_2_dcm,
+    "jpg_2_dcm_passthrough": bench_jpg_2_dcm_passthrough,
+    "create_slices": bench_create_slices,
+    "export": bench_export,
+    "download": bench_download,
+    "download_instances": bench_download_instances,
+}
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS, so that the setup of a benchmark is not measured (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """Return the peak RSS of this process since reset_peak_rss and of its finished children (such as worker pools), in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        # Also holds the peak of the process this one was started from
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = max(own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def run_child(name, corpus, workers, use_threads):
+    """Run one benchmark in this process, writing its measurements as JSON to the original stdout."""
+    result_stream = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    sys.stdout.flush()
+    os.dup2(devnull, 1)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as work_dir, contextlib.ExitStack() as resources:
+        run, files = BENCHMARKS[name](corpus, work_dir, workers, use_threads, resources)
+        reset_peak_rss()
+        start = time.perf_counter()
+        processed = run()
+        seconds = time.perf_counter() - start
+        rss = peak_rss_mb()
+        # The download benchmarks only know what they went through once they ran
+        files = files if files is not None else processed
+        size = total_size(files)
+
+    sys.stdout.flush()
+    json.dump({"seconds": seconds, "files": len(files), "bytes": size, "peak_rss_mb": round(rss, 1)}, result_stream)
+    result_stream.close()
+
+def run_benchmark(name, corpus, workers, use_threads, repeat):
+    """Run a benchmark repeat times in fresh processes, keeping the fastest run and the highest peak RSS."""
+    runs = []
+    for _ in range(repeat):
+        command = [sys.executable, os.path.abspath(__file__), corpus, "--child", name]
+        if workers is not None:
+            command += ["--workers", str(workers)]
+        if use_threads:
+            command.append("--threads")
+        completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            return {"error": f"exited with status {completed.returncode}"}
+        runs.append(json.loads(completed.stdout))
+
+    best = min(runs, key=lambda run: run["seconds"])
+    return {
+        "seconds": round(best["seconds"], 4),
+        "all_seconds": [round(run["seconds"], 4) for run in runs],
+        "files": best["files"],
+        "bytes": best["bytes"],
+        "files_per_second": round(best["files"] / best["seconds"], 1),
+        "mb_per_second": round(best["bytes"] / 1024 / 1024 / best["seconds"], 2),
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+    }
+
+def compare_with_baseline(results, baseline, threshold):
+    """Print the changes from a previous run, returning the names of the benchmarks that got slower than threshold percent."""
+    regressions = []
+    print(f"\n{'benchmark':<24} {'files/s':>10} {'baseline':>10} {'change':>8} {'RSS MB':>8} {'baseline':>9}")
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if "error" in result or old is None or "error" in old:
+            continue
+        change = (result["files_per_second"] / old["files_per_second"] - 1) * 100
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24} {result['files_per_second']:>10.1f} {old['files_per_second']:>10.1f} {change:>+7.1f}% {result['peak_rss_mb']:>8.1f} {old['peak_rss_mb']:>9.1f}{flag}")
+    return regressions
+
+def main(corpus, output=None, baseline=None, names=None, patients=4, workers=None, use_threads=False, repeat=1, threshold=10.0):
+    if not os.path.isdir(corpus):
+        files, size = generate_corpus.generate_corpus(corpus, patients=patients, workers=workers, use_threads=use_threads, **CORPUS_OPTIONS)
+        print(f"Generated {files} files ({size / 1024 / 1024:.1f} MB) in {corpus}")
+
+    corpus_files = all_files(corpus)
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": workers,
+        "threads": use_threads,
+        "corpus": {"path": os.path.abspath(corpus), "files": len(corpus_files), "bytes": total_size(corpus_files)},
+        "results": {},
+    }
+
+    print(f"{'benchmark':<24} {'seconds':>8} {'files':>7} {'files/s':>10} {'MB/s':>8} {'RSS MB':>8}")
+    for name in names or BENCHMARKS:
+        result = run_benchmark(name, corpus, workers, use_threads, repeat)
+        report["results"][name] = result
+        if "error" in result:
+            print(f"{name:<24} failed: {result['error']}")
+        else:
+            print(f"{name:<24} {result['seconds']:>8.3f} {result['files']:>7} {result['files_per_second']:>10.1f} {result['mb_per_second']:>8.2f} {result['peak_rss_mb']:>8.1f}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare_with_baseline(report["results"], json.load(f), threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {threshold}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the core function of every script on a synthetic corpus.", usage="benchmark.py <corpus_dir> [--output RESULTS.json] [--baseline PREVIOUS.json] [--only NAME ...] [--patients N] [--repeat N] [--threshold PERCENT] [--workers N] [--threads]")
+    parser.add_argument("corpus", help="Directory of DICOM files to benchmark on, generated with generate_corpus.py when it does not exist.")
+    parser.add_argument("--output", help="JSON file the results are saved to.")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with, the exit status is 1 when a benchmark got slower.")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), metavar="NAME", help=f"Benchmarks to run, out of {', '.join(BENCHMARKS)}. Defaults to all of them.")
+    parser.add_argument("--patients", type=int, default=4, help="Number of patients of a generated corpus. Defaults to 4.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each benchmark, the fastest one is kept. Defaults to 1.")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Slowdown in files/sec, in percent, reported as a regression. Defaults to 10.")
+    parser.add_argument("--child", choices=list(BENCHMARKS), help=argparse.SUPPRESS)
+    dicom_scan.add_scan_arguments(parser)
+
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child, args.corpus, args.workers, args.threads)
+    else:
+        sys.exit(main(args.corpus, args.output, args.baseline, args.only, args.patients, args.workers, args.threads, args.repeat, args.threshold))
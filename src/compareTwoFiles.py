@@ -1,19 +1,41 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import csv
+import difflib
+import functools
+import hashlib
+import json
+import math
 import os
-import subprocess
+import re
+import struct
 import sys
-import tempfile
 
+import numpy as np
 import pydicom
-from rich.console import Console
-from rich.syntax import Syntax
+from pydicom.datadict import dictionary_description, keyword_for_tag
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
 from termcolor import colored
 
+import dicom_scan
 
-def load_dicom_file(file1_path, file2_path):
-        # Check if files exist
+SOP_INSTANCE_UID_TAG = Tag(0x0008, 0x0018)
+
+# Pixel Data, Float Pixel Data and Double Float Pixel Data, the elements stop_before_pixels stops at
+PIXEL_DATA_TAGS = {Tag(0x7FE0, 0x0010): None, Tag(0x7FE0, 0x0008): np.float32, Tag(0x7FE0, 0x0009): np.float64}
+
+# Explicit VRs whose element header has a 4 byte length
+LONG_LENGTH_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CSV_FIELDS = ["SOPInstanceUID", "file1", "file2", "status", "differing_tags", "only_in_file1", "only_in_file2", "max_abs_diff", "differing_voxels", "min_psnr"]
+
+
+def check_files_exist(file1_path, file2_path):
     if not os.path.exists(file1_path):
         print(f"Error: File {file1_path} not found.")
         sys.exit(1)
@@ -21,6 +43,10 @@ def load_dicom_file(file1_path, file2_path):
         print(f"Error: File {file2_path} not found.")
         sys.exit(1)
 
+def load_dicom_file(file1_path, file2_path):
+    # Check if files exist
+    check_files_exist(file1_path, file2_path)
+
     # Load the DICOM files
     dicom1 = pydicom.dcmread(file1_path)
     dicom2 = pydicom.dcmread(file2_path)
@@ -32,56 +58,227 @@ def truncate_value(value, length=100):
     value_str = str(value)
     return value_str if len(value_str) <= length else value_str[:length] + "..."
 
-def write_dicom_tags_to_file(dicom, file_path):
-    with open(file_path, 'w') as f:
-        for elem in dicom.iterall():
-            tag_name = elem.name if hasattr(elem, 'name') else str(elem.tag)
-            value = truncate_value(elem.value)
-            f.write(f"{tag_name} {elem.tag}: {value}\n")
-            
-def use_git(file1_path, file2_path, git_diff_args):
-    # Load the DICOM files
-    dicom1, dicom2 = load_dicom_file(file1_path, file2_path)
-        # Create temporary files to store the metadata
-    with tempfile.NamedTemporaryFile(delete=False) as temp1, tempfile.NamedTemporaryFile(delete=False) as temp2:
-        temp1_path = temp1.name
-        temp2_path = temp2.name
+def element_line(elem):
+    tag_name = elem.name if hasattr(elem, 'name') else str(elem.tag)
+    if elem.VR == "SQ":
+        # The elements of the items get lines of their own
+        return f"{tag_name} {elem.tag}: {len(elem.value)} item(s)"
+    value = truncate_value(elem.value).replace("\r", "\\r").replace("\n", "\\n")
+    return f"{tag_name} {elem.tag}: {value}"
 
-    try:
-        # Write DICOM tags to temporary files
-        write_dicom_tags_to_file(dicom1, temp1_path)
-        write_dicom_tags_to_file(dicom2, temp2_path)
+def json_scalar(value):
+    if isinstance(value, bytes):
+        # Short binary values in full, longer ones by their length and digest
+        return value.hex() if len(value) <= 64 else f"{len(value)} bytes, blake2b {hashlib.blake2b(value).hexdigest()}"
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return str(value)
 
-        git_diff_command = ['git', 'diff', '--no-index', temp1_path, temp2_path] + git_diff_args
+def element_json_value(elem):
+    """Return the untruncated value of an element in a form json can write, the number of items for a sequence."""
+    if elem.VR == "SQ":
+        return len(elem.value)
+    if isinstance(elem.value, (list, pydicom.multival.MultiValue)):
+        return [json_scalar(value) for value in elem.value]
+    return json_scalar(elem.value)
 
-        # Use git diff to compare the temporary files
-        result = subprocess.run(git_diff_command, capture_output=True, text=True)
+def iter_elements(dataset, prefix=()):
+    """
+    Yield (key, element) for every element of a dataset in iterall() order.
 
-        # Use rich to display the diff output with color
-        console = Console()
-        syntax = Syntax(result.stdout, "diff", theme="ansi_dark")
-        console.print(syntax)
+    The key is the path of the element, (tag,) at the top level and (sequence tag, item index, tag, ...)
+    inside sequences, so that the keys come out sorted.
+    """
+    for elem in dataset:
+        key = prefix + (elem.tag,)
+        yield key, elem
+        if elem.VR == "SQ":
+            for index, item in enumerate(elem.value):
+                yield from iter_elements(item, key + (index,))
 
-    finally:
-        # Remove temporary files
-        os.remove(temp1_path)
-        os.remove(temp2_path)
+def read_element_lines(filepath):
+    """
+    Return the (key, line) pairs of a file, with a digest of its pixel data instead of its truncated value,
+    and the {key: value} of its elements for diff_to_json.
+    """
+    ds, tag, digest, location = read_pixel_data_digest(filepath)
+    lines, values = [], {}
+    for key, elem in iter_elements(ds):
+        lines.append((key, element_line(elem)))
+        values[key] = element_json_value(elem)
+    if tag is not None:
+        lines.append(((tag,), f"{dictionary_description(tag)} {tag}: blake2b {digest}"))
+        values[(tag,)] = f"blake2b {digest}"
+    return lines, values
 
-def compare_dicom_tags(file1_path, file2_path, show_all=False):
-    print(f"Comparing DICOM tags between {file1_path} and {file2_path}...")
+def merge_element_lines(lines1, lines2):
+    """
+    Align two sorted (key, line) streams in a single linear merge.
 
-    # Load the DICOM files
-    dicom1, dicom2 = load_dicom_file(file1_path, file2_path)
+    Yields (status, key, line1, line2), status being "equal", "changed", "removed" (only in the first
+    stream) or "added" (only in the second one).
+    """
+    i = j = 0
+    while i < len(lines1) or j < len(lines2):
+        if j == len(lines2) or (i < len(lines1) and lines1[i][0] < lines2[j][0]):
+            yield "removed", lines1[i][0], lines1[i][1], None
+            i += 1
+        elif i == len(lines1) or lines2[j][0] < lines1[i][0]:
+            yield "added", lines2[j][0], None, lines2[j][1]
+            j += 1
+        else:
+            yield "equal" if lines1[i][1] == lines2[j][1] else "changed", lines1[i][0], lines1[i][1], lines2[j][1]
+            i += 1
+            j += 1
+
+def diff_hunks(ops, context=3):
+    """Group the differences into hunks of (first line in file 1, first line in file 2, ops) with context elements around them."""
+    line1 = line2 = 1
+    starts = []
+    for status, key, old, new in ops:
+        starts.append((line1, line2))
+        line1 += old is not None
+        line2 += new is not None
+
+    changed = [index for index, (status, key, old, new) in enumerate(ops) if status != "equal"]
+    hunks = []
+    for index in changed:
+        first, last = max(0, index - context), min(len(ops), index + context + 1)
+        if hunks and first <= hunks[-1][1]:
+            hunks[-1][1] = last
+        else:
+            hunks.append([first, last])
+    return [(starts[first][0], starts[first][1], ops[first:last]) for first, last in hunks]
+
+def split_words(line):
+    return re.findall(r"\s+|[^\s]+", line)
+
+def render_words(old, new, mode, paint):
+    """Render a changed line word by word, as git diff --color-words or --word-diff=plain do."""
+    words1, words2 = split_words(old), split_words(new)
+    parts = []
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, words1, words2, autojunk=False).get_opcodes():
+        removed, added = "".join(words1[i1:i2]), "".join(words2[j1:j2])
+        if op == "equal":
+            parts.append(removed)
+            continue
+        if removed:
+            parts.append(f"[-{removed}-]" if mode == "plain" else paint(removed, 'red'))
+        if added:
+            parts.append(f"{{+{added}+}}" if mode == "plain" else paint(added, 'green'))
+    return "".join(parts)
+
+def hunk_range(start, count):
+    # Like diff, a single line is given without its count and an empty range starts before its position
+    if count == 1:
+        return str(start)
+    return f"{start - 1 if count == 0 else start},{count}"
+
+def render_diff(ops, file1_path, file2_path, context=3, word_mode=None, color=True):
+    """Render the ops of merge_element_lines as a unified diff, or word by word with word_mode "color" or "plain"."""
+    paint = colored if color else lambda text, *args, **kwargs: text
+    lines = [paint(f"--- {file1_path}", attrs=['bold']), paint(f"+++ {file2_path}", attrs=['bold'])]
+
+    for start1, start2, hunk in diff_hunks(ops, context):
+        count1 = sum(old is not None for status, key, old, new in hunk)
+        count2 = sum(new is not None for status, key, old, new in hunk)
+        lines.append(paint(f"@@ -{hunk_range(start1, count1)} +{hunk_range(start2, count2)} @@", 'cyan'))
 
-    # Extract the tags from both files
+        for status, key, old, new in hunk:
+            if word_mode is None:
+                if status == "equal":
+                    lines.append(f" {old}")
+                    continue
+                if old is not None:
+                    lines.append(paint(f"-{old}", 'red'))
+                if new is not None:
+                    lines.append(paint(f"+{new}", 'green'))
+            elif status == "equal":
+                lines.append(old)
+            elif status == "changed":
+                lines.append(render_words(old, new, word_mode, paint))
+            elif status == "removed":
+                lines.append(f"[-{old}-]" if word_mode == "plain" else paint(old, 'red'))
+            else:
+                lines.append(f"{{+{new}+}}" if word_mode == "plain" else paint(new, 'green'))
+    return "\n".join(lines)
+
+def diff_to_json(ops, values1, values2):
+    """
+    List the differences, each with the tag and keyword of its element, its path (tags, and item indexes
+    inside sequences) and its value in both files (None when it is missing from one of them).
+    """
+    return [{"path": [index if i % 2 else str(index) for i, index in enumerate(key)], "status": status, "tag": str(key[-1]),
+             "keyword": keyword_for_tag(key[-1]) or None, "left": values1.get(key), "right": values2.get(key)}
+            for status, key, old, new in ops if status != "equal"]
+
+def parse_diff_args(diff_args):
+    """Read the git diff style options: --color-words, --word-diff[=color|plain], -U<n>/--unified=<n>, --no-color."""
+    context, word_mode, color = 3, None, sys.stdout.isatty()
+    for arg in diff_args:
+        if arg == "--color-words":
+            word_mode = "color"
+            color = True
+        elif arg == "--word-diff":
+            word_mode = "plain"
+        elif arg.startswith("--word-diff="):
+            word_mode = arg.split("=", 1)[1]
+            color = color or word_mode == "color"
+        elif arg.startswith("--unified="):
+            context = int(arg.split("=", 1)[1])
+        elif arg.startswith("-U"):
+            context = int(arg[2:])
+        elif arg == "--color":
+            color = True
+        elif arg == "--no-color":
+            color = False
+        else:
+            print(f"Warning: ignoring unsupported diff option {arg}")
+    if word_mode not in (None, "color", "plain"):
+        print(f"Warning: unsupported word diff mode {word_mode}, using color")
+        word_mode = "color"
+    return context, word_mode, color
+
+def show_diff(file1_path, file2_path, diff_args=None, json_path=None):
+    """Print a line diff of the tags of two files in the style of git diff, unless diff_args is None, and optionally write it as JSON."""
+    check_files_exist(file1_path, file2_path)
+    lines1, values1 = read_element_lines(file1_path)
+    lines2, values2 = read_element_lines(file2_path)
+    ops = list(merge_element_lines(lines1, lines2))
+
+    if diff_args is not None:
+        context, word_mode, color = parse_diff_args(diff_args)
+        print(render_diff(ops, file1_path, file2_path, context, word_mode, color))
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(diff_to_json(ops, values1, values2), f, indent=2)
+
+def diff_tags(dicom1, dicom2):
+    """Return the elements of both datasets by tag, with the common, unique and differing tags."""
     tags1 = {elem.tag: elem for elem in dicom1.iterall()}
     tags2 = {elem.tag: elem for elem in dicom2.iterall()}
 
-    # Find common, unique, and differing tags
     common_tags = set(tags1.keys()) & set(tags2.keys())
     unique_tags_file1 = set(tags1.keys()) - set(tags2.keys())
     unique_tags_file2 = set(tags2.keys()) - set(tags1.keys())
     differing_tags = {tag for tag in common_tags if tags1[tag].value != tags2[tag].value}
+    return tags1, tags2, common_tags, unique_tags_file1, unique_tags_file2, differing_tags
+
+def compare_dicom_tags(file1_path, file2_path, show_all=False, pixels=False):
+    print(f"Comparing DICOM tags between {file1_path} and {file2_path}...")
+
+    if pixels:
+        # Only the headers are loaded, the pixel data is compared separately
+        check_files_exist(file1_path, file2_path)
+        header1, header2 = read_pixel_data_digest(file1_path), read_pixel_data_digest(file2_path)
+        dicom1, dicom2 = header1[0], header2[0]
+    else:
+        # Load the DICOM files
+        dicom1, dicom2 = load_dicom_file(file1_path, file2_path)
+
+    # Find common, unique, and differing tags
+    tags1, tags2, common_tags, unique_tags_file1, unique_tags_file2, differing_tags = diff_tags(dicom1, dicom2)
 
     if show_all:
         print("\nCommon Tags:")
@@ -114,17 +311,369 @@ def compare_dicom_tags(file1_path, file2_path, show_all=False):
         print(colored(f"  File 2: {truncate_value(tags2[tag].value)}", 'green'))
         print()
 
+    if pixels:
+        print_pixel_comparison(file1_path, header1, file2_path, header2)
+
+def read_pixel_data_digest(filepath):
+    """
+    Read the header of a file and a digest of its pixel data, streamed in chunks from its offset in the file.
+
+    Returns the header Dataset, the pixel data tag, the digest and the (offset, length) of the pixel data
+    value, length being None when it runs up to the end of the file. The tag and digest are None when the
+    file has no pixel data, the location is None when it cannot be read from the file directly.
+    """
+    with open(filepath, 'rb') as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)
+        # dcmread stops right at the start of the pixel data element (or at the end of the file)
+        offset = f.tell()
+        element_header = f.read(12)
+
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        if transfer_syntax == pydicom.uid.DeflatedExplicitVRLittleEndian:
+            # The data set is compressed as a whole, so the pixel data has no offset in the file
+            full = pydicom.dcmread(filepath)
+            for tag in PIXEL_DATA_TAGS:
+                if tag in full:
+                    return ds, tag, hashlib.blake2b(full[tag].value).hexdigest(), None
+            return ds, None, None, None
+
+        endian = "<" if transfer_syntax.is_little_endian else ">"
+        if len(element_header) < 8:
+            return ds, None, None, None
+        tag = Tag(*struct.unpack(endian + "HH", element_header[:4]))
+        if tag not in PIXEL_DATA_TAGS:
+            return ds, None, None, None
+
+        if transfer_syntax.is_implicit_VR:
+            length, = struct.unpack(endian + "I", element_header[4:8])
+            offset += 8
+        elif element_header[4:6] in LONG_LENGTH_VRS:
+            length, = struct.unpack(endian + "I", element_header[8:12])
+            offset += 12
+        else:
+            length, = struct.unpack(endian + "H", element_header[6:8])
+            offset += 8
+        if length == 0xFFFFFFFF:
+            # Encapsulated pixel data, its fragments run up to the end of the file
+            length = None
+
+        digest = hashlib.blake2b()
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(HASH_CHUNK_SIZE if remaining is None else min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    return ds, tag, digest.hexdigest(), (offset, length)
+
+def iter_pixel_frames(filepath, ds, tag, location):
+    """
+    Return the shape (frames, rows, columns, samples) of the pixel data of a file and an iterator over its frames.
+
+    Uncompressed pixel data is read one frame at a time from its offset in the file, so that only
+    the frames being compared are held in memory. Anything else is decoded by pydicom.
+    """
+    frames = int(ds.get("NumberOfFrames", 1) or 1)
+    samples = int(ds.get("SamplesPerPixel", 1))
+    shape = (frames, ds.Rows, ds.Columns, samples)
+    planar = samples > 1 and ds.get("PlanarConfiguration", 0) == 1
+
+    dtype = PIXEL_DATA_TAGS[tag]
+    if dtype is None and ds.get("BitsAllocated") in (8, 16, 32, 64):
+        dtype = np.dtype(f"{'i' if ds.get('PixelRepresentation', 0) else 'u'}{ds.BitsAllocated // 8}")
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+
+    if location is not None and location[1] is not None and dtype is not None and not transfer_syntax.is_compressed:
+        dtype = np.dtype(dtype).newbyteorder("<" if transfer_syntax.is_little_endian else ">")
+        frame_size = math.prod(shape[1:]) * dtype.itemsize
+        if location[1] >= frames * frame_size:
+            def read_frames():
+                with open(filepath, 'rb') as f:
+                    for frame in range(frames):
+                        data = np.frombuffer(os.pread(f.fileno(), frame_size, location[0] + frame * frame_size), dtype=dtype)
+                        if planar:
+                            yield data.reshape(samples, ds.Rows, ds.Columns).transpose(1, 2, 0)
+                        else:
+                            yield data.reshape(shape[1:])
+            return shape, read_frames()
+
+    # pixel_array drops the frame and sample axes when there is only one of them
+    return shape, iter(pydicom.dcmread(filepath).pixel_array.reshape(shape))
+
+def pixel_statistics(file1_path, header1, file2_path, header2):
+    """
+    Compare the pixel data of two files frame by frame.
+
+    header1 and header2 are (ds, tag, digest, location) as returned by read_pixel_data_digest. Returns one
+    dict per frame with the maximum absolute difference, the number of differing voxels and the PSNR
+    (None when the frames are identical).
+    """
+    shape1, frames1 = iter_pixel_frames(file1_path, *header1[:2], header1[3])
+    shape2, frames2 = iter_pixel_frames(file2_path, *header2[:2], header2[3])
+    if shape1 != shape2:
+        raise ValueError(f"pixel data shapes differ: {shape1} and {shape2}")
+
+    ds = header1[0]
+    if header1[1] != Tag(0x7FE0, 0x0010):
+        peak = None
+    else:
+        peak = 2 ** int(ds.get("BitsStored", ds.get("BitsAllocated", 8))) - 1
+
+    statistics = []
+    for frame1, frame2 in zip(frames1, frames2):
+        frame1 = frame1.astype(np.float64)
+        difference = np.abs(frame1 - frame2.astype(np.float64))
+        mse = float(np.mean(difference ** 2))
+        frame_peak = peak if peak is not None else float(frame1.max() - frame1.min())
+        statistics.append({
+            "max_abs_diff": float(difference.max()),
+            "differing_voxels": int(np.count_nonzero(difference)),
+            "psnr": 10 * math.log10(frame_peak ** 2 / mse) if mse and frame_peak else None,
+        })
+    return statistics
+
+def summarize_pixel_statistics(statistics):
+    """Reduce per-frame statistics to the worst values over all frames."""
+    psnrs = [frame["psnr"] for frame in statistics if frame["psnr"] is not None]
+    return {
+        "max_abs_diff": max(frame["max_abs_diff"] for frame in statistics),
+        "differing_voxels": sum(frame["differing_voxels"] for frame in statistics),
+        "min_psnr": min(psnrs) if psnrs else None,
+    }
+
+def format_psnr(psnr):
+    return "inf" if psnr is None else f"{psnr:.2f} dB"
+
+def print_pixel_comparison(file1_path, header1, file2_path, header2):
+    print("\nPixel Data:")
+    if header1[2] is None or header2[2] is None:
+        print(colored(f"  Only in File {1 if header2[2] is None else 2}" if header1[2] != header2[2] else "  No pixel data", 'blue'))
+        return
+    if header1[2] == header2[2]:
+        print(colored("  Identical", 'green'))
+        return
+
+    statistics = pixel_statistics(file1_path, header1, file2_path, header2)
+    differing_frames = [(number, frame) for number, frame in enumerate(statistics, 1) if frame["differing_voxels"]]
+    if not differing_frames:
+        print(colored(f"  Encoded differently, but all {len(statistics)} frame(s) have the same pixel values", 'green'))
+        return
+
+    print(colored(f"  {len(differing_frames)} of {len(statistics)} frame(s) differ", 'red'))
+    for number, frame in differing_frames:
+        print(colored(f"  Frame {number}: max abs diff {frame['max_abs_diff']:g}, differing voxels {frame['differing_voxels']}, PSNR {format_psnr(frame['psnr'])}", 'red'))
+
+def read_sop_instance_uid(filepath):
+    """Read the SOPInstanceUID of a file, parsing its header only up to tag (0008,0018)."""
+    with open(filepath, 'rb') as f:
+        ds = read_partial(f, stop_when=lambda tag, VR, length: tag > SOP_INSTANCE_UID_TAG, specific_tags=[SOP_INSTANCE_UID_TAG])
+    return ds.get('SOPInstanceUID')
+
+def read_sop_instance_uid_batch(filepaths):
+    entries = []
+    for filepath in filepaths:
+        try:
+            uid = read_sop_instance_uid(filepath)
+        except Exception:
+            uid = None
+        entries.append((filepath, str(uid) if uid else None))
+    return entries
+
+def tag_label(elem):
+    tag_name = elem.name if hasattr(elem, 'name') else str(elem.tag)
+    return f"{tag_name} {elem.tag}"
+
+def pixel_data_label(tag):
+    return f"{dictionary_description(tag)} {tag}"
+
+def diff_pair(file1_path, file2_path, pixels=False):
+    """
+    Diff the headers of two files and their pixel data digests.
+
+    Returns the labels of the differing tags and of the tags only found in either file, plus with
+    pixels the statistics of the pixel data when it differs.
+    """
+    header1, header2 = read_pixel_data_digest(file1_path), read_pixel_data_digest(file2_path)
+    tags1, tags2, common_tags, unique_tags_file1, unique_tags_file2, differing_tags = diff_tags(header1[0], header2[0])
+
+    differing = [tag_label(tags1[tag]) for tag in differing_tags]
+    unique1 = [tag_label(tags1[tag]) for tag in unique_tags_file1]
+    unique2 = [tag_label(tags2[tag]) for tag in unique_tags_file2]
+
+    statistics = None
+    if header1[1] is not None and header2[1] is None:
+        unique1.append(pixel_data_label(header1[1]))
+    elif header1[1] is None and header2[1] is not None:
+        unique2.append(pixel_data_label(header2[1]))
+    elif header1[2] != header2[2]:
+        if pixels:
+            statistics = summarize_pixel_statistics(pixel_statistics(file1_path, header1, file2_path, header2))
+        # Encoded differently (e.g. after a lossless transcode) but with the same pixel values
+        if statistics is None or statistics["differing_voxels"]:
+            differing.append(pixel_data_label(header1[1]))
+
+    return sorted(differing), sorted(unique1), sorted(unique2), statistics
+
+def diff_pair_batch(pairs, pixels=False):
+    """Diff every (SOPInstanceUID, file1, file2) pair, returning the labels of the tags that differ."""
+    results = []
+    for uid, file1_path, file2_path in pairs:
+        try:
+            differing, unique1, unique2, statistics = diff_pair(file1_path, file2_path, pixels)
+        except Exception as e:
+            results.append((uid, file1_path, file2_path, [], [], [], None, str(e)))
+            continue
+        results.append((uid, file1_path, file2_path, differing, unique1, unique2, statistics, None))
+    return results
+
+def index_by_sop_instance_uid(entries, summary):
+    """Map SOPInstanceUID to file, recording the files without a UID and the duplicated UIDs in summary."""
+    index = {}
+    for filepath, uid in entries:
+        if uid is None:
+            summary["unreadable"].append(filepath)
+        elif uid in index:
+            summary["duplicates"].append(filepath)
+        else:
+            index[uid] = filepath
+    return index
+
+def compare_directories(directory1, directory2, csv_path=None, json_path=None, workers=None, use_threads=False, pixels=False):
+    """
+    Pair the instances of two directory trees by SOPInstanceUID and diff every pair.
+
+    The SOPInstanceUIDs are read header only, the pairs are diffed by a pool of workers and,
+    with csv_path, one row per instance is streamed out as soon as its pair was diffed.
+    Headers are compared without loading the pixel data, which is compared by digest. With
+    pixels, differing pixel data is also compared frame by frame.
+    Returns the summary, which is also written as JSON to json_path.
+    """
+    print(f"Comparing DICOM instances between {directory1} and {directory2}...")
+
+    summary = {
+        "directory1": directory1,
+        "directory2": directory2,
+        "instances1": 0,
+        "instances2": 0,
+        "paired": 0,
+        "identical": 0,
+        "different": 0,
+        "errors": 0,
+        "missing": [],
+        "extra": [],
+        "unreadable": [],
+        "duplicates": [],
+        "tag_differences": collections.Counter(),
+        "only_in_file1": collections.Counter(),
+        "only_in_file2": collections.Counter(),
+        "pixel_max_abs_diff": None,
+        "pixel_min_psnr": None,
+    }
+
+    csv_file = open(csv_path, 'w', newline='') if csv_path else None
+    writer = csv.writer(csv_file) if csv_file else None
+    if writer:
+        writer.writerow(CSV_FIELDS)
+
+    def merge(summary, results):
+        for uid, file1_path, file2_path, differing, unique1, unique2, statistics, error in results:
+            summary["paired"] += 1
+            if error is not None:
+                status = "error"
+                summary["errors"] += 1
+            elif differing or unique1 or unique2:
+                status = "different"
+                summary["different"] += 1
+            else:
+                status = "identical"
+                summary["identical"] += 1
+            summary["tag_differences"].update(differing)
+            summary["only_in_file1"].update(unique1)
+            summary["only_in_file2"].update(unique2)
+            if statistics is None:
+                statistics = {"max_abs_diff": None, "differing_voxels": None, "min_psnr": None}
+            else:
+                summary["pixel_max_abs_diff"] = max(summary["pixel_max_abs_diff"] or 0, statistics["max_abs_diff"])
+                if statistics["min_psnr"] is not None:
+                    summary["pixel_min_psnr"] = min(summary["pixel_min_psnr"] or math.inf, statistics["min_psnr"])
+            if writer:
+                writer.writerow([uid, file1_path, file2_path, status, "|".join(differing), "|".join(unique1), "|".join(unique2),
+                                 statistics["max_abs_diff"], statistics["differing_voxels"], statistics["min_psnr"]])
+        return summary
+
+    def compare(pool):
+        index1 = index_by_sop_instance_uid(dicom_scan.scan_files(dicom_scan.iter_files(directory1), read_sop_instance_uid_batch, dicom_scan.merge_lists, [], pool), summary)
+        index2 = index_by_sop_instance_uid(dicom_scan.scan_files(dicom_scan.iter_files(directory2), read_sop_instance_uid_batch, dicom_scan.merge_lists, [], pool), summary)
+        summary["instances1"] = len(index1)
+        summary["instances2"] = len(index2)
+
+        for uid, filepath in index1.items():
+            if uid not in index2:
+                summary["missing"].append(filepath)
+                if writer:
+                    writer.writerow([uid, filepath, "", "missing", "", "", "", "", "", ""])
+        for uid, filepath in index2.items():
+            if uid not in index1:
+                summary["extra"].append(filepath)
+                if writer:
+                    writer.writerow([uid, "", filepath, "extra", "", "", "", "", "", ""])
+
+        pairs = ((uid, filepath, index2[uid]) for uid, filepath in index1.items() if uid in index2)
+        dicom_scan.scan_files(pairs, functools.partial(diff_pair_batch, pixels=pixels), merge, summary, pool)
+
+    try:
+        dicom_scan.run_with_pool(compare, workers, use_threads)
+    finally:
+        if csv_file:
+            csv_file.close()
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    print_directory_summary(summary)
+    return summary
+
+def print_directory_summary(summary):
+    print(f"\nInstances: {summary['instances1']} in {summary['directory1']}, {summary['instances2']} in {summary['directory2']}")
+    print(colored(f"  Identical: {summary['identical']}", 'green'))
+    print(colored(f"  Different: {summary['different']}", 'red'))
+    print(colored(f"  Missing from {summary['directory2']}: {len(summary['missing'])}", 'red'))
+    print(colored(f"  Extra in {summary['directory2']}: {len(summary['extra'])}", 'blue'))
+    if summary["errors"]:
+        print(colored(f"  Failed to compare: {summary['errors']}", 'red'))
+    if summary["pixel_max_abs_diff"] is not None:
+        print(colored(f"  Differing pixel data: max abs diff {summary['pixel_max_abs_diff']:g}, min PSNR {format_psnr(summary['pixel_min_psnr'])}", 'red'))
+    if summary["unreadable"] or summary["duplicates"]:
+        print(f"  Files without a SOPInstanceUID: {len(summary['unreadable'])}, duplicated SOPInstanceUIDs: {len(summary['duplicates'])}")
+
+    for title, counts in (("Differing Tags", summary["tag_differences"]), ("Tags only in directory 1", summary["only_in_file1"]), ("Tags only in directory 2", summary["only_in_file2"])):
+        if counts:
+            print(f"\n{title}:")
+            for label, count in counts.most_common():
+                print(f"  {label}: {count}")
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Compare DICOM tags between two files. By default, only differing tags are displayed. You can also choose to calculate and display the diff using Git.", epilog="Example: python compareTwoFiles.py file1.dcm file2.dcm", usage="compareTwoFiles.py file1.dcm file2.dcm [--all] [--git --color-words]")
-    parser.add_argument("file1", help="Path to the first DICOM file.")
-    parser.add_argument("file2", help="Path to the second DICOM file.")
+    parser = argparse.ArgumentParser(description="Compare DICOM tags between two files. By default, only differing tags are displayed. You can also choose to display a line diff of the tags, in the style of git diff.", epilog="Example: python compareTwoFiles.py file1.dcm file2.dcm", usage="compareTwoFiles.py file1.dcm file2.dcm [--all] [--pixels] [--json PATH] [--diff --color-words]\n       compareTwoFiles.py directory1 directory2 [--json PATH] [--csv PATH] [--pixels] [--workers N] [--threads]")
+    parser.add_argument("file1", help="Path to the first DICOM file, or directory.")
+    parser.add_argument("file2", help="Path to the second DICOM file, or directory.")
     parser.add_argument("--all", action="store_true", help="Display all tags including common and unique tags.")
-    parser.add_argument("git_and_args", nargs=argparse.REMAINDER, help="Pass --git followed by any git diff args to use git for comparison. Example: python compareTwoFiles.py file1.dcm file2.dcm --git --color-words")
+    parser.add_argument("--pixels", action="store_true", help="Compare the pixel data by streaming digest, apart from the headers. When it differs it is decoded and compared frame by frame (max abs diff, differing voxels, PSNR), so that pixel data with the same values counts as identical.")
+    parser.add_argument("--json", help="Write the differences as JSON to this file, the summary when comparing directories.")
+    parser.add_argument("--csv", help="When comparing directories, write one row per instance to this CSV file.")
+    dicom_scan.add_scan_arguments(parser)
+    parser.add_argument("--diff", "--git", dest="diff", nargs=argparse.REMAINDER, metavar="DIFF_ARGS", help="Display a line diff of the tags. Takes the git diff options --color-words, --word-diff[=color|plain], -U<n>/--unified=<n> and --no-color. Must be given last. Example: python compareTwoFiles.py file1.dcm file2.dcm --diff --color-words")
 
 
     args = parser.parse_args()
     
-    if "--git" in args.git_and_args:
-        use_git(args.file1, args.file2, args.git_and_args[1:])
+    if os.path.isdir(args.file1) and os.path.isdir(args.file2):
+        compare_directories(args.file1, args.file2, args.csv, args.json, args.workers, args.threads, args.pixels)
+    elif args.diff is not None or args.json:
+        show_diff(args.file1, args.file2, args.diff, args.json)
     else:
-        compare_dicom_tags(args.file1, args.file2, args.all)
+        compare_dicom_tags(args.file1, args.file2, args.all, args.pixels)
@@ -1,62 +1,228 @@
 #!/usr/bin/env python3
 
+import argparse
+import csv
+import functools
+import hashlib
+import importlib.util
 import os
 import pydicom
-import sys
-import csv
+from pydicom.datadict import dictionary_VM, dictionary_VR
+
+import dicom_index
+import dicom_scan
+import dicom_stats
+
+
+OUTPUT_FILES = {"csv": "output.csv", "parquet": "output.parquet", "arrow": "output.arrow"}
+
+# Rows buffered by the columnar writers before they are written out as one row group or record batch
+ARROW_BATCH_ROWS = 65536
+
+INTEGER_VRS = {"IS", "SL", "SS", "SV", "UL", "US"}
+FLOAT_VRS = {"DS", "FD", "FL"}
+
+
+def to_report_cell(value):
+    """
+    Render a tag value as plain strings, so it can cross process boundaries.
+
+    Multi-valued tags become tuples of strings (the metadata index returns those as lists),
+    which the CSV report joins with "|" and the columnar reports keep as list columns.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (pydicom.multival.MultiValue, list)):
+        return tuple(map(str, value))
+    return str(value)
+
+def report_entry_from(ds, tags, filepath):
+    report_entry = []
+    for tag in tags:
+        try:
+            report_entry.append(to_report_cell(ds.get(tag, "")))
+        except Exception as e:
+            print(f"Failed while creating entry for tag ({tag}) in {filepath}: {e}")
+
+    return report_entry
+
+def report_read_failure(filepath, tags, e):
+    for tag in tags:
+        print(f"Failed while creating entry for tag ({tag}) in {filepath}: {e}")
+    return []
+
+def read_report_entry(filepath, tags):
+    """Parse a single file once, header only, and return the report row for the requested tags."""
+    try:
+        ds = dicom_scan.read_header(filepath, tags)
+    except Exception as e:
+        return report_read_failure(filepath, tags, e)
+
+    return report_entry_from(ds, tags, filepath)
+
+def scan_report_batch(filepaths, tags, unique_only=False):
+    entries = [read_report_entry(filepath, tags) for filepath in filepaths]
+    # Deduplicate inside the worker already so fewer rows travel back to the parent
+    return list(dict.fromkeys(map(tuple, entries))) if unique_only else entries
+
+
+class UniqueEntries:
+    """Pass every distinct entry on to writer once, remembering only a 16-byte digest of each entry already seen."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.seen = set()
+
+    def append(self, entry):
+        digest = hashlib.blake2b(repr(tuple(entry)).encode("utf-8"), digest_size=16).digest()
+        if digest not in self.seen:
+            self.seen.add(digest)
+            self.writer.append(entry)
+
+def append_entries(writer, entries):
+    for entry in entries:
+        writer.append(entry)
+    return writer
 
-def scan_directory_for_dicom(base_dir, tags, unique_only=False):
-    report_set = set()
-    report_list = []
-
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            if file.lower().endswith(".dcm"):
-                filepath = os.path.join(root, file)
-                report_entry = []
-                for tag in tags:
-                    try:
-                        ds = pydicom.dcmread(filepath)
-                        tag_result = ds.get(tag, "")
-                        
-                        # Handle MultiValue
-                        if isinstance(tag_result, pydicom.multival.MultiValue):
-                            tag_result = "|".join(map(str, tag_result))
-                            
-                        report_entry.append(tag_result)
-                    except Exception as e:
-                        print(f"Failed while creating entry for tag ({tag}) in {filepath}: {e}")
-
-                if unique_only:
-                    report_set.add(tuple(report_entry))
-                else:
-                    report_list.append(report_entry)
-                    
+def write_report(base_dir, tags, writer, unique_only=False, workers=None, use_threads=False, index_path=None, use_index=False):
+    """
+    Append the report entry of every file to writer (a list, or one of the report writers) as soon as it is read, in scan order.
+
+    With unique_only, only the first occurrence of every entry is appended.
+    """
     if unique_only:
-        return [list(item) for item in report_set]
-    else:
-        return report_list
+        writer = UniqueEntries(writer)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python script_name.py <directory_path> tag1 tag2 tag3 ... etc [--unique]")
-        sys.exit(1)
+    if use_index:
+        relpaths = dicom_index.update_index(base_dir, index_path, workers, use_threads)
+        for filepath, values, error in dicom_index.query_index(base_dir, relpaths, tags, index_path):
+            if error is not None:
+                writer.append(report_read_failure(filepath, tags, error))
+            else:
+                writer.append(report_entry_from(values, tags, filepath))
+        return
+
+    scan_batch = functools.partial(scan_report_batch, tags=tags, unique_only=unique_only)
+    dicom_scan.scan_directory(base_dir, scan_batch, append_entries, writer, workers, use_threads)
+
+def scan_directory_for_dicom(base_dir, tags, unique_only=False, workers=None, use_threads=False, index_path=None, use_index=False):
+    """Return the report entries of all the files in memory, multi-valued tags as tuples."""
+    entries = []
+    write_report(base_dir, tags, entries, unique_only, workers, use_threads, index_path, use_index)
+    return entries
+
+
+class CsvReportWriter:
+    def __init__(self, path, tags):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(tags)  # Writing the header (tags)
+
+    def append(self, entry):
+        self.writer.writerow(["|".join(cell) if isinstance(cell, tuple) else cell for cell in entry])
+
+    def close(self):
+        self.file.close()
+
+def column_type(tag):
+    """Return ("text", "integer" or "float", multi-valued) for a tag keyword, from the VR and VM of the DICOM dictionary."""
+    try:
+        vrs, vm = set(dictionary_VR(tag).split(" or ")), dictionary_VM(tag)
+    except (KeyError, ValueError):
+        return "text", False
+    kind = "integer" if vrs <= INTEGER_VRS else "float" if vrs <= FLOAT_VRS else "text"
+    return kind, vm != "1"
+
+def parse_number(text, kind):
+    try:
+        return int(text) if kind == "integer" else float(text)
+    except ValueError:
+        return None
 
-    base_directory = sys.argv[1]
-    tags = sys.argv[2:]
+def to_column_value(cell, kind, multi_valued):
+    """Convert a report cell to the value of its typed column, missing or unparsable numbers become nulls."""
+    if cell == "":
+        return None
+    if multi_valued:
+        values = cell if isinstance(cell, tuple) else (cell,)
+        return list(values) if kind == "text" else [parse_number(value, kind) for value in values]
+    if isinstance(cell, tuple):
+        cell = "|".join(cell)
+    return cell if kind == "text" else parse_number(cell, kind)
+
+class ArrowReportWriter:
+    """
+    Write the report as a Parquet or Arrow IPC file, in row groups of ARROW_BATCH_ROWS entries.
+
+    Numeric VRs get integer or float columns and multi-valued tags list columns, anything else is text.
+    """
+
+    def __init__(self, path, tags, file_format):
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.columns = [column_type(tag) for tag in tags]
+        arrow_types = {"text": pyarrow.string(), "integer": pyarrow.int64(), "float": pyarrow.float64()}
+        self.schema = pyarrow.schema([
+            (tag, pyarrow.list_(arrow_types[kind]) if multi_valued else arrow_types[kind])
+            for tag, (kind, multi_valued) in zip(tags, self.columns)
+        ])
+        if file_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+        self.entries = []
+
+    def append(self, entry):
+        self.entries.append(entry)
+        if len(self.entries) >= ARROW_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.entries:
+            return
+        arrays = []
+        for i, (field, (kind, multi_valued)) in enumerate(zip(self.schema, self.columns)):
+            # Entries of unreadable files are empty, their columns are nulls
+            values = [to_column_value(entry[i], kind, multi_valued) if i < len(entry) else None for entry in self.entries]
+            arrays.append(self.pyarrow.array(values, type=field.type))
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.entries = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def open_report_writer(path, tags, file_format="csv"):
+    if file_format == "csv":
+        return CsvReportWriter(path, tags)
+    return ArrowReportWriter(path, tags, file_format)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract DICOM tags from every .dcm file in a directory into a CSV report.", usage="create_report_for_tags.py <directory_path> tag1 tag2 tag3 ... etc [--unique] [--format csv|parquet|arrow] [--workers N] [--threads] [--index] [--index-path INDEX_PATH] [--stats [JSON_PATH]]")
+    parser.add_argument("directory", help="Path to the directory containing the DICOM files.")
+    parser.add_argument("tags", nargs="+", help="DICOM tag keywords to extract.")
+    parser.add_argument("--unique", action="store_true", help="Only output unique entries.")
+    parser.add_argument("--format", choices=list(OUTPUT_FILES), default="csv", help="Format of the report. parquet and arrow have typed columns, with lists for multi-valued tags, and need pyarrow. Defaults to csv.")
+    dicom_scan.add_scan_arguments(parser)
+    dicom_index.add_index_arguments(parser)
+    dicom_stats.add_stats_arguments(parser)
 
-    unique_only = False
-    if "--unique" in tags:
-        unique_only = True
-        tags.remove("--unique")
+    args = parser.parse_intermixed_args()
+    if args.format != "csv" and importlib.util.find_spec("pyarrow") is None:
+        parser.error(f"--format {args.format} needs pyarrow, install it with: pip install pyarrow")
+    dicom_stats.enable_from_arguments(args)
 
-    result = scan_directory_for_dicom(base_directory, tags, unique_only)
+    base_directory = args.directory
+    tags = args.tags
 
     absolute_base_directory = os.path.abspath(base_directory)
-    output_file_path = os.path.join(absolute_base_directory, 'output.csv')
-    with open(output_file_path, 'w', newline='') as csvfile:
-        print(f"Your report is being created in {os.path.abspath(base_directory)}/output.csv")
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(tags)  # Writing the header (tags)
-        for entry in result:
-            csvwriter.writerow(entry)
+    output_file_path = os.path.join(absolute_base_directory, OUTPUT_FILES[args.format])
+    print(f"Your report is being created in {output_file_path}")
+    writer = open_report_writer(output_file_path, tags, args.format)
+    try:
+        write_report(base_directory, tags, writer, args.unique, args.workers, args.threads, args.index_path, args.index or args.index_path is not None)
+    finally:
+        writer.close()
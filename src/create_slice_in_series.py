@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
+import copy
+import functools
+import glob
+import operator
+import os
 
 import pydicom
 from pydicom.dataelem import DataElement
 from pydicom.uid import generate_uid
 
+import dicom_scan
+import modify_dicom_tag
+
+PN_TAGS = ['ReferringPhysicianName', 'PerformingPhysicianName', 'PhysiciansOfRecord', 'RequestingPhysician']
+
 
 def validate_and_correct_pn(person_name):
     """ Validates and corrects the format of DICOM Person Name (PN) """
@@ -13,15 +23,45 @@ def validate_and_correct_pn(person_name):
     components = str(person_name).split('^')[:5]
     return '^'.join(components)
 
-def modify_dicom_series(input_dcm_path, target_dcm_path, output_dcm_path):
-    # Load the input and target DICOM files
-    input_dcm = pydicom.dcmread(input_dcm_path)
-    target_dcm = pydicom.dcmread(target_dcm_path)
+def load_target_template(target_dcm_path):
+    """
+    Read the target DICOM file once, without its pixel data, into the elements that are copied onto every slice.
+
+    The Person Name tags are corrected here, so that they are not validated again for each slice.
+    """
+    template = pydicom.dcmread(target_dcm_path, stop_before_pixels=True)
+
+    # Iterating converts the raw elements once, they carry no VR when the target is implicit VR
+    for elem in template:
+        if elem.keyword in PN_TAGS:
+            template[elem.tag] = DataElement(elem.tag, 'PN', validate_and_correct_pn(elem.value))
+    return template
 
-    # Copy all tags from the target to the input DICOM, except for pixel data
-    for elem in target_dcm:
-        if elem.tag != pydicom.tag.Tag("7fe0", "0010"):  # Exclude pixel data tag
-            input_dcm[elem.tag] = elem
+def slice_location(template, position):
+    """Return the distance of position along the slice normal, or None when the template has no orientation."""
+    orientation = template.get('ImageOrientationPatient')
+    if orientation is None or len(orientation) != 6:
+        return None
+    row, column = [float(v) for v in orientation[:3]], [float(v) for v in orientation[3:]]
+    normal = (row[1] * column[2] - row[2] * column[1], row[2] * column[0] - row[0] * column[2], row[0] * column[1] - row[1] * column[0])
+    return sum(p * n for p, n in zip(position, normal))
+
+def slice_place(template, instance_number=None, image_position=None):
+    """Return the {tag_name: value} changes that give a slice its place in the series."""
+    changes = {}
+    if instance_number is not None:
+        changes['InstanceNumber'] = instance_number
+    if image_position is not None:
+        changes['ImagePositionPatient'] = [round(v, 6) for v in image_position]
+        location = slice_location(template, image_position)
+        if location is not None and 'SliceLocation' in template:
+            changes['SliceLocation'] = round(location, 6)
+    return changes
+
+def stamp_slice(input_dcm, template, instance_number=None, image_position=None):
+    """Copy the template elements onto input_dcm, giving it a new SOPInstanceUID and optionally its place in the series."""
+    # The slice gets its own copy, so that the values set below never end up in the shared template
+    input_dcm.update(copy.deepcopy(template))
 
     # Generate a new SOPInstanceUID for the input DICOM
     new_uid = generate_uid()
@@ -29,24 +69,107 @@ def modify_dicom_series(input_dcm_path, target_dcm_path, output_dcm_path):
     if 'MediaStorageSOPInstanceUID' in input_dcm.file_meta:
         input_dcm.file_meta.MediaStorageSOPInstanceUID = new_uid
 
-    # Correct the format of Person Name (PN) VRs
-    pn_tags = ['ReferringPhysicianName', 'PerformingPhysicianName', 'PhysiciansOfRecord', 'RequestingPhysician']
-    for tag in pn_tags:
-        if tag in input_dcm:
-            corrected_value = validate_and_correct_pn(input_dcm[tag].value)
-            input_dcm[tag] = DataElement(tag, 'PN', corrected_value)
-            
+    for tag_name, value in slice_place(template, instance_number, image_position).items():
+        setattr(input_dcm, tag_name, value)
+
     input_dcm.PhotometricInterpretation = "RGB"
     input_dcm.SamplesPerPixel = 3
     input_dcm.PlanarConfiguration = 0
+    return input_dcm
+
+def modify_dicom_series(input_dcm_path, target_dcm_path, output_dcm_path, instance_number=None, image_position=None):
+    # Load the input and target DICOM files
+    input_dcm = pydicom.dcmread(input_dcm_path)
+    stamp_slice(input_dcm, load_target_template(target_dcm_path), instance_number, image_position)
 
     # Save the modified input DICOM file
     input_dcm.save_as(output_dcm_path)
     print(f"Modified DICOM file saved as: {output_dcm_path}")
 
+def list_inputs(source):
+    """Return the DICOM files below a directory, or matching a glob pattern, in a stable order."""
+    if os.path.isdir(source):
+        return sorted(dicom_scan.iter_files(source))
+    return sorted(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+
+def stamp_batch(items, template):
+    """Stamp the template onto each (input path, output path), returning the output paths that were written."""
+    written = []
+    for input_dcm_path, output_path in items:
+        try:
+            input_dcm = stamp_slice(pydicom.dcmread(input_dcm_path), template)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            input_dcm.save_as(output_path)
+            print(f"Modified DICOM file saved as: {output_path}")
+            written.append(output_path)
+        except Exception as e:
+            print(f"Failed to modify {input_dcm_path}: {e}")
+    return written
+
+def place_batch(items):
+    """Patch the (output path, changes) slices in place, returning the number of slices that failed."""
+    failures = 0
+    for output_path, changes in items:
+        try:
+            modify_dicom_tag.patch_dicom_file(output_path, changes)
+        except Exception as e:
+            print(f"Failed to number {output_path}: {e}")
+            failures += 1
+    return failures
+
+def create_slices(source, target_dcm_path, output_directory, first_instance_number=None, position_step=None, first_position=None, workers=None, use_threads=False):
+    """
+    Stamp the header of the target file onto all the DICOM files of a directory or glob pattern.
+
+    The target is parsed once and the sub-directories of the inputs are kept in output_directory.
+    In path order, the slices that were stamped are numbered from first_instance_number and placed
+    position_step apart from first_position (the target ImagePositionPatient by default), when these are given,
+    so that failed inputs leave no gaps. Returns the number of slices that failed.
+    """
+    template = load_target_template(target_dcm_path)
+    os.makedirs(output_directory, exist_ok=True)
+
+    if position_step is not None and first_position is None:
+        first_position = [float(v) for v in template.get('ImagePositionPatient', [0, 0, 0])]
+
+    inputs = list_inputs(source)
+    if os.path.isdir(source):
+        base_dir = source
+    else:
+        base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in inputs]) if inputs else ""
+    items = [(path, os.path.join(output_directory, os.path.relpath(os.path.abspath(path), os.path.abspath(base_dir)))) for path in inputs]
+
+    def run(pool):
+        # The slices are stamped first, the ones that were written are then numbered in place
+        written = dicom_scan.scan_files(items, functools.partial(stamp_batch, template=template), operator.add, [], pool)
+        failures = len(items) - len(written)
+        if first_instance_number is None and position_step is None:
+            return failures
+
+        places = []
+        for index, output_path in enumerate(written):
+            instance_number = None if first_instance_number is None else first_instance_number + index
+            image_position = None if position_step is None else [p + index * s for p, s in zip(first_position, position_step)]
+            places.append((output_path, slice_place(template, instance_number, image_position)))
+        return failures + dicom_scan.scan_files(places, place_batch, operator.add, 0, pool)
+
+    return dicom_scan.run_with_pool(run, workers, use_threads)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python modify_dicom_series.py <input_dcm_path> <target_dcm_path> <output_dcm_path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Copy the header of a target DICOM file onto other DICOM files, creating new slices in its series.", usage="python create_slice_in_series.py <input_dcm_path> <target_dcm_path> <output_dcm_path> [--instance-number N] [--first-position X Y Z]\n       python create_slice_in_series.py <input_directory_or_glob> <target_dcm_path> <output_directory> [--instance-number N] [--position-step DX DY DZ [--first-position X Y Z]] [--workers N] [--threads]")
+    parser.add_argument("source", help="DICOM file to modify, or a directory or quoted glob pattern of DICOM files that all become slices of the target series.")
+    parser.add_argument("target", help="DICOM file whose header is copied.")
+    parser.add_argument("output", help="Output DICOM file, or output directory with several input files.")
+    parser.add_argument("--instance-number", type=int, help="Number the slices in path order, starting from N.")
+    parser.add_argument("--position-step", type=float, nargs=3, metavar=("DX", "DY", "DZ"), help="Offset of the ImagePositionPatient of each slice from the previous one.")
+    parser.add_argument("--first-position", type=float, nargs=3, metavar=("X", "Y", "Z"), help="ImagePositionPatient of the first slice. Defaults to the one of the target.")
+    dicom_scan.add_scan_arguments(parser)
+
+    args = parser.parse_args()
 
-    modify_dicom_series(sys.argv[1], sys.argv[2], sys.argv[3])
+    if os.path.isfile(args.source):
+        modify_dicom_series(args.source, args.target, args.output, args.instance_number, args.first_position)
+    else:
+        if args.first_position is not None and args.position_step is None:
+            parser.error("--first-position requires --position-step with several input files")
+        create_slices(args.source, args.target, args.output, args.instance_number, args.position_step, args.first_position, args.workers, args.threads)
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
-import modify_dicom_tag
 import argparse
 import pydicom
 
-def create_new_study(directory, new_study_uid, new_patient_id=None):
-    # Update Study Instance UID
-    modify_dicom_tag.update_dicom_tag_in_directory(directory, "StudyInstanceUID", new_study_uid)
+import dicom_scan
+import modify_dicom_tag
+
+def create_new_study(directory, new_study_uid, new_patient_id=None, output_directory=None, patch=False, workers=None, use_threads=False):
+    # All tags are applied in a single read/write per file
+    changes = {"StudyInstanceUID": new_study_uid}
     
     if new_patient_id:
         print(f"modifying patient id/name to {new_patient_id}")
-        modify_dicom_tag.update_dicom_tag_in_directory(directory, 'PatientID', new_patient_id)
-        modify_dicom_tag.update_dicom_tag_in_directory(directory, 'PatientName', new_patient_id)
+        changes["PatientID"] = new_patient_id
+        changes["PatientName"] = new_patient_id
+
+    modify_dicom_tag.update_dicom_tags_in_directory(directory, changes, output_directory, patch, workers, use_threads)
 
     
 def generate_new_study_uid():
@@ -22,10 +26,13 @@ def main():
     parser.add_argument('source_directory', help='Directory of the existing study.')
     parser.add_argument('--new-study-id', help='New Study ID. If not supplied random will be used')
     parser.add_argument('--new-patient-id', help='New Patient ID. Optional')
+    parser.add_argument('--output-dir', help='Write the new study to this directory and leave the source study untouched. Optional')
+    parser.add_argument('--patch', action='store_true', help='Only rewrite the file headers, the pixel data is copied unchanged.')
+    dicom_scan.add_scan_arguments(parser)
 
     args = parser.parse_args()
     new_study_uid = generate_new_study_uid() if args.new_study_id == None else args.new_study_id
-    create_new_study(args.source_directory, new_study_uid, args.new_patient_id)
+    create_new_study(args.source_directory, new_study_uid, args.new_patient_id, args.output_dir, args.patch, args.workers, args.threads)
 
 if __name__ == "__main__":
     main()
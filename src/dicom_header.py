@@ -0,0 +1,223 @@
+# Fast reader for a few top-level tags of a DICOM file.
+#
+# The scan scripts only need a handful of tags from the start of each file.
+# Instead of letting pydicom build a Dataset with a DataElement for every
+# element, the first PREFIX_SIZE bytes are read in a single unbuffered read
+# and the element headers are walked directly: values of other elements,
+# sequences included, are skipped by their length, and the walk stops at the
+# first element past the last requested tag. Only the requested values are
+# decoded, with pydicom's own converters, so they are exactly what dcmread
+# would return.
+#
+# Only little endian transfer syntaxes (implicit and explicit VR, which
+# includes all the compressed ones) are handled. read_tags returns None for
+# anything else (no DICM prefix, big endian or deflated data, ambiguous or
+# UN VRs, requested sequences or pixel data, truncated files, headers
+# longer than MAX_PREFIX_SIZE), and the caller falls back to pydicom.
+
+import struct
+
+from pydicom.charset import convert_encodings
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import Tag
+from pydicom.values import convert_value
+
+# Most headers end within the first few KB, the prefix is doubled until the last requested tag is reached
+PREFIX_SIZE = 16 * 1024
+MAX_PREFIX_SIZE = 4 * 1024 * 1024
+
+IMPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2"
+# Explicit VR big endian and deflated explicit VR little endian
+UNSUPPORTED_TRANSFER_SYNTAXES = {"1.2.840.10008.1.2.2", "1.2.840.10008.1.2.1.99"}
+
+# VRs whose explicit length takes 4 bytes after 2 reserved ones
+LONG_LENGTH_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+VRS = LONG_LENGTH_VRS | {b"AE", b"AS", b"AT", b"CS", b"DA", b"DS", b"DT", b"FD", b"FL", b"IS", b"LO", b"LT", b"PN", b"SH", b"SL", b"SS", b"ST", b"TM", b"UI", b"UL", b"US"}
+
+SPECIFIC_CHARACTER_SET = 0x00080005
+TRANSFER_SYNTAX_UID = 0x00020010
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+UNDEFINED_LENGTH = 0xFFFFFFFF
+# (7FE0,0008) float, (7FE0,0009) double float and (7FE0,0010) pixel data, where the callers stop reading
+PIXEL_DATA_START = 0x7FE00008
+
+EXPLICIT_HEADER = struct.Struct("<HH2sH")
+IMPLICIT_HEADER = struct.Struct("<HHL")
+LONG_LENGTH = struct.Struct("<L")
+
+
+class Unsupported(Exception):
+    """The file needs the full pydicom reader."""
+
+class NeedMore(Exception):
+    """The header goes on past the bytes read so far."""
+
+
+class Header(dict):
+    """The requested tags of a file by keyword, used like a Dataset: header.get(keyword), keyword in header or header.Modality."""
+
+    def __getattr__(self, keyword):
+        try:
+            return self[keyword]
+        except KeyError:
+            raise AttributeError(f"Header has no attribute '{keyword}'") from None
+
+
+def read_element_header(buf, pos, implicit):
+    """Return (tag, VR or None, length, value position) of the element starting at pos."""
+    if pos + 8 > len(buf):
+        raise NeedMore()
+    if implicit:
+        group, element, length = IMPLICIT_HEADER.unpack_from(buf, pos)
+        return group << 16 | element, None, length, pos + 8
+
+    group, element, vr, length = EXPLICIT_HEADER.unpack_from(buf, pos)
+    tag = group << 16 | element
+    if group == 0xFFFE:
+        # Items and delimiters never have a VR
+        return tag, None, LONG_LENGTH.unpack_from(buf, pos + 4)[0], pos + 8
+    if vr in LONG_LENGTH_VRS:
+        if pos + 12 > len(buf):
+            raise NeedMore()
+        return tag, vr, LONG_LENGTH.unpack_from(buf, pos + 8)[0], pos + 12
+    if vr not in VRS:
+        raise Unsupported()
+    return tag, vr, length, pos + 8
+
+def skip_items(buf, pos, implicit):
+    """Skip the items of an undefined length sequence (or encapsulated data) starting at pos, returning the position after its delimiter."""
+    while True:
+        tag, vr, length, pos = read_element_header(buf, pos, True)
+        if tag == SEQUENCE_DELIMITER:
+            return pos
+        if tag != ITEM:
+            raise Unsupported()
+        pos = skip_elements(buf, pos, implicit) if length == UNDEFINED_LENGTH else pos + length
+
+def skip_elements(buf, pos, implicit):
+    """Skip the elements of an undefined length item starting at pos, returning the position after its delimiter."""
+    while True:
+        tag, vr, length, pos = read_element_header(buf, pos, implicit)
+        if tag == ITEM_DELIMITER:
+            return pos
+        pos = skip_items(buf, pos, implicit) if length == UNDEFINED_LENGTH else pos + length
+
+def parse_file_meta(buf):
+    """Return the transfer syntax UID and the position of the dataset behind the file meta information."""
+    if buf[128:132] != b"DICM":
+        raise Unsupported()
+
+    pos = 132
+    transfer_syntax = None
+    while True:
+        if pos + 8 > len(buf):
+            raise NeedMore()
+        if buf[pos:pos + 2] != b"\x02\x00":
+            break
+        tag, vr, length, value_pos = read_element_header(buf, pos, False)
+        if length == UNDEFINED_LENGTH:
+            raise Unsupported()
+        pos = value_pos + length
+        if tag == TRANSFER_SYNTAX_UID:
+            if pos > len(buf):
+                raise NeedMore()
+            transfer_syntax = buf[value_pos:pos].rstrip(b"\x00 ").decode("ascii")
+
+    if transfer_syntax is None or transfer_syntax in UNSUPPORTED_TRANSFER_SYNTAXES:
+        raise Unsupported()
+    return transfer_syntax, pos
+
+def parse_tags(buf, wanted, complete):
+    """
+    Return {tag: (VR, value bytes, value position)} for the wanted top-level tags found in buf, and whether the VRs are implicit.
+
+    complete tells whether buf holds the whole file, otherwise NeedMore is raised when the header goes on past its end.
+    """
+    try:
+        transfer_syntax, pos = parse_file_meta(buf)
+        implicit = transfer_syntax == IMPLICIT_VR_LITTLE_ENDIAN
+        # pydicom reads datasets whose VRs do not match their transfer syntax, recognized from the first element
+        if implicit and pos + 8 <= len(buf) and buf[pos + 4:pos + 6] in VRS:
+            raise Unsupported()
+        last_tag = max(wanted)
+
+        found = {}
+        while pos < len(buf) or not complete:
+            tag, vr, length, pos = read_element_header(buf, pos, implicit)
+            if tag > last_tag:
+                break
+            if length == UNDEFINED_LENGTH:
+                if tag in wanted:
+                    raise Unsupported()
+                pos = skip_items(buf, pos, implicit)
+                continue
+
+            if tag in wanted:
+                if pos + length > len(buf):
+                    raise NeedMore()
+                found[tag] = (vr, buf[pos:pos + length], pos)
+            pos += length
+    except NeedMore:
+        if complete:
+            # The file is truncated
+            raise Unsupported() from None
+        raise
+    return found, implicit
+
+def decode(tag, vr, value, value_tell, implicit, encodings):
+    if implicit:
+        vr = dictionary_VR(tag)
+    else:
+        vr = vr.decode("ascii")
+    # Ambiguous and unknown VRs are resolved by pydicom from the rest of the dataset
+    if vr in ("SQ", "UN") or " " in vr:
+        raise Unsupported()
+    return convert_value(vr, RawDataElement(Tag(tag), vr, len(value), value, value_tell, implicit, True), encodings)
+
+def read_tags(filepath, keywords):
+    """
+    Read the given top-level tags of a file, returning (header, number of bytes read).
+
+    header is a Header without the missing tags, or None when the file must be read by pydicom.
+    """
+    wanted = {}
+    for keyword in keywords:
+        tag = tag_for_keyword(keyword)
+        if tag is not None:
+            wanted[tag] = keyword
+    # SpecificCharacterSet is needed to decode the text values, pydicom always reads it too
+    wanted.setdefault(SPECIFIC_CHARACTER_SET, "SpecificCharacterSet")
+    if max(wanted) >= PIXEL_DATA_START:
+        return None, 0
+
+    with open(filepath, "rb", buffering=0) as f:
+        buf = f.read(PREFIX_SIZE)
+        complete = len(buf) < PREFIX_SIZE
+        while True:
+            try:
+                found, implicit = parse_tags(buf, wanted, complete)
+                break
+            except NeedMore:
+                if len(buf) >= MAX_PREFIX_SIZE:
+                    return None, len(buf)
+                more = f.read(len(buf))
+                complete = len(more) < len(buf)
+                buf += more
+            except Unsupported:
+                return None, len(buf)
+
+    try:
+        encodings = None
+        if SPECIFIC_CHARACTER_SET in found:
+            vr, value, value_tell = found[SPECIFIC_CHARACTER_SET]
+            encodings = convert_encodings(decode(SPECIFIC_CHARACTER_SET, vr, value, value_tell, implicit, None))
+
+        header = Header()
+        for tag, (vr, value, value_tell) in found.items():
+            header[wanted[tag]] = decode(tag, vr, value, value_tell, implicit, encodings)
+    except Unsupported:
+        return None, len(buf)
+    return header, len(buf)
@@ -0,0 +1,182 @@
+# Persistent, incremental metadata index for repeated scans of the same tree.
+#
+# The header of every .dcm file is stored in a SQLite database, keyed by the
+# absolute path of the scanned root and its path relative to that root, and
+# stored together with its size and mtime. Several roots can share an index.
+# Updating the index only re-parses files that are new or changed since the
+# last run, and tag queries are answered from the stored headers without
+# opening the DICOM files again.
+
+import json
+import os
+import sqlite3
+
+import pydicom
+from pydicom.valuerep import PersonName
+
+import dicom_scan
+import dicom_stats
+
+INDEX_FILE_NAME = ".dicom_index.sqlite"
+
+# Bumped when the files table changes, older index files are rebuilt from scratch
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    header TEXT,
+    unindexed TEXT,
+    error TEXT,
+    PRIMARY KEY (root, path)
+)
+"""
+
+QUERY_CHUNK_SIZE = 500
+
+
+def default_index_path(base_dir):
+    return os.path.join(base_dir, INDEX_FILE_NAME)
+
+def open_index(index_path):
+    conn = sqlite3.connect(index_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        # The index is only a cache of the headers
+        conn.execute("DROP TABLE IF EXISTS files")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.execute(SCHEMA)
+    return conn
+
+def to_index_value(value):
+    """Convert a tag value to plain JSON data, keeping the str() and repr() of text values intact."""
+    if value is None or type(value) in (int, float):
+        return value
+    if isinstance(value, (str, PersonName, pydicom.valuerep.DSfloat, pydicom.valuerep.DSdecimal, pydicom.valuerep.IS)):
+        return str(value)
+    if isinstance(value, (pydicom.multival.MultiValue, list)):
+        return [to_index_value(item) for item in value]
+    raise TypeError(f"Can not index values of type {type(value).__name__}")
+
+def index_dataset(ds):
+    """Return the indexed header of a dataset, and the keywords that could not be indexed (sequences, binary data)."""
+    header = {}
+    unindexed = []
+    for elem in ds:
+        if not elem.keyword:
+            continue
+        try:
+            header[elem.keyword] = to_index_value(elem.value)
+        except TypeError:
+            unindexed.append(elem.keyword)
+    return header, unindexed
+
+def index_batch(entries):
+    rows = []
+    for filepath, root, relpath, size, mtime_ns in entries:
+        dicom_stats.add("files")
+        try:
+            with dicom_stats.timed("index"):
+                with open(filepath, "rb") as f:
+                    ds = pydicom.dcmread(f, stop_before_pixels=True)
+                    dicom_stats.add("bytes_read", f.tell())
+                header, unindexed = index_dataset(ds)
+            rows.append((root, relpath, size, mtime_ns, json.dumps(header), json.dumps(unindexed), None))
+        except Exception as e:
+            rows.append((root, relpath, size, mtime_ns, None, None, str(e)))
+    return rows
+
+def store_rows(conn, rows):
+    conn.executemany("INSERT OR REPLACE INTO files (root, path, size, mtime_ns, header, unindexed, error) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+def update_index(base_dir, index_path=None, workers=None, use_threads=False):
+    """
+    Bring the index of base_dir up to date and return the indexed paths in os.walk order.
+
+    Only new or changed files (by size and mtime) are parsed, deleted files are dropped from the index.
+    The rows of other roots sharing the same index are left alone.
+    """
+    if index_path is None:
+        index_path = default_index_path(base_dir)
+    root = os.path.abspath(base_dir)
+
+    conn = open_index(index_path)
+    try:
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in conn.execute("SELECT path, size, mtime_ns FROM files WHERE root = ?", (root,))}
+
+        relpaths = []
+        stale = []
+        for entry in dicom_scan.iter_file_entries(base_dir):
+            try:
+                stat = entry.stat()
+            except OSError as e:
+                print(f"Failed to stat {entry.path}: {e}")
+                continue
+
+            relpath = os.path.relpath(entry.path, base_dir)
+            relpaths.append(relpath)
+            if known.pop(relpath, None) != (stat.st_size, stat.st_mtime_ns):
+                stale.append((entry.path, root, relpath, stat.st_size, stat.st_mtime_ns))
+
+        # No need to start any workers when nothing changed
+        dicom_scan.run_with_pool(lambda pool: dicom_scan.scan_files(stale, index_batch, store_rows, conn, pool), workers if stale else 1, use_threads)
+
+        # Whatever is left in known no longer exists on disk
+        conn.executemany("DELETE FROM files WHERE root = ? AND path = ?", [(root, path) for path in known])
+        conn.commit()
+    finally:
+        conn.close()
+
+    return relpaths
+
+def query_index(base_dir, relpaths, tags, index_path=None):
+    """
+    Yield (filepath, values, error) for every path returned by update_index.
+
+    values maps each requested tag to its value and can be used like ds.get(tag, default).
+    Multi-valued tags come back as lists. Tags that could not be indexed are read from the file itself.
+    """
+    if index_path is None:
+        index_path = default_index_path(base_dir)
+    root = os.path.abspath(base_dir)
+
+    conn = open_index(index_path)
+    try:
+        for start in range(0, len(relpaths), QUERY_CHUNK_SIZE):
+            chunk = relpaths[start:start + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = {row[0]: row[1:] for row in conn.execute(f"SELECT path, header, unindexed, error FROM files WHERE root = ? AND path IN ({placeholders})", [root] + chunk)}
+
+            for relpath in chunk:
+                filepath = os.path.join(base_dir, relpath)
+                header, unindexed, error = rows[relpath]
+                if error is not None:
+                    yield filepath, None, error
+                    continue
+
+                header = json.loads(header)
+                values = {tag: header[tag] for tag in tags if tag in header}
+
+                unindexed = json.loads(unindexed)
+                missing = [tag for tag in tags if tag in unindexed]
+                if missing:
+                    try:
+                        ds = dicom_scan.read_header(filepath, missing)
+                        values.update({tag: ds.get(tag) for tag in missing if tag in ds})
+                    except Exception as e:
+                        yield filepath, None, str(e)
+                        continue
+
+                yield filepath, values, None
+    finally:
+        conn.close()
+
+def add_index_arguments(parser):
+    parser.add_argument("--index", action="store_true", help=f"Answer the query from a persistent metadata index, only re-reading new or changed files. The index is kept in {INDEX_FILE_NAME} in the scanned directory unless --index-path is given.")
+    parser.add_argument("--index-path", metavar="INDEX_PATH", help="SQLite file of the index, implies --index.")
@@ -0,0 +1,150 @@
+# Shared directory scan engine used by the tag scanning scripts.
+#
+# Files are discovered with os.scandir, handed to a pool of workers in
+# batches and every worker reduces its batch to a small partial result
+# (a set, a dict of sets, a list of rows...). Only those partial results
+# travel back to the parent, never whole Datasets.
+
+import functools
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+import pydicom
+from pydicom.datadict import tag_for_keyword
+
+import dicom_header
+import dicom_stats
+
+DEFAULT_BATCH_SIZE = 64
+
+
+def read_header(filepath, tags):
+    """
+    Read only the given top-level tags of a file, stopping before the pixel data.
+
+    The result can be used like a Dataset (ds.get(tag), tag in ds, ds.Modality). Most files only have
+    their first few KB walked by dicom_header, the others are read by pydicom.
+    """
+    dicom_stats.add("files")
+    with dicom_stats.timed("read_header"):
+        header, bytes_read = dicom_header.read_tags(filepath, tags)
+        if header is not None:
+            dicom_stats.add("bytes_read", bytes_read)
+            return header
+
+        # Only real keywords can be passed to specific_tags, anything else is simply missing from the dataset
+        specific_tags = [tag for tag in tags if tag_for_keyword(tag) is not None]
+        with open(filepath, "rb") as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=specific_tags)
+            dicom_stats.add("bytes_read", f.tell())
+    return ds
+
+def iter_file_entries(base_dir, extension=".dcm"):
+    """Yield os.DirEntry objects for the files under base_dir in os.walk order, optionally only those with the given extension."""
+    pending = [base_dir]
+    while pending:
+        directory = pending.pop()
+        try:
+            with dicom_stats.timed("walk"), os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        sub_directories = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                # Like os.walk, symlinked directories are not followed
+                if not entry.is_symlink():
+                    sub_directories.append(entry.path)
+            elif extension is None or entry.name.lower().endswith(extension):
+                yield entry
+
+        pending.extend(reversed(sub_directories))
+
+def iter_files(base_dir, extension=".dcm"):
+    """Yield the files under base_dir in os.walk order, optionally only those with the given extension."""
+    for entry in iter_file_entries(base_dir, extension):
+        yield entry.path
+
+def iter_batches(iterable, batch_size=DEFAULT_BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def create_pool(workers=None, use_threads=False):
+    """Create a worker pool, or return None when the scan should run serially in this process."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    return ThreadPool(workers) if use_threads else multiprocessing.Pool(workers)
+
+def close_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def imap(function, items, pool=None):
+    """Lazily map function over items in order, on the pool when there is one."""
+    if pool is None:
+        return map(function, items)
+    if dicom_stats.enabled and not isinstance(pool, ThreadPool):
+        # Worker processes send the statistics of every item back with its result
+        return map(dicom_stats.keep_collected, pool.imap(functools.partial(dicom_stats.collect, function), items))
+    return pool.imap(function, items)
+
+def scan_files(paths, scan_batch, merge, result, pool=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run scan_batch over batches of paths and fold every partial result into result with merge.
+
+    scan_batch must be a picklable (module level) function when a process pool is used.
+    Partial results are merged in the same order the paths were given.
+    """
+    for partial in imap(scan_batch, iter_batches(paths, batch_size), pool):
+        result = merge(result, partial)
+    return result
+
+def run_with_pool(function, workers=None, use_threads=False):
+    """Call function(pool) with a fresh worker pool (None when serial) that is shut down afterwards."""
+    pool = create_pool(workers, use_threads)
+    try:
+        result = function(pool)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    close_pool(pool)
+    return result
+
+def scan_directory(base_dir, scan_batch, merge, result, workers=None, use_threads=False, extension=".dcm", batch_size=DEFAULT_BATCH_SIZE):
+    return run_with_pool(lambda pool: scan_files(iter_files(base_dir, extension), scan_batch, merge, result, pool, batch_size), workers, use_threads)
+
+def merge_lists(result, partial):
+    result.extend(partial)
+    return result
+
+def merge_sets(result, partial):
+    result.update(partial)
+    return result
+
+def merge_dict_of_sets(result, partial):
+    for key, values in partial.items():
+        if key not in result:
+            result[key] = set()
+        result[key].update(values)
+    return result
+
+def add_scan_arguments(parser):
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers. Defaults to the number of CPUs, 1 scans serially.")
+    parser.add_argument("--threads", action="store_true", help="Use a thread pool instead of a process pool (useful on network file systems).")
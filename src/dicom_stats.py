@@ -0,0 +1,256 @@
+# Optional timing and throughput statistics shared by the scripts.
+#
+# Enabled with --stats on the command line, or with the DICOM_STATS
+# environment variable (1, or the path of a JSON lines file). Every stage of
+# the work (directory walking, header reads, writes, HTTP requests, ...) is
+# timed per item into a log-scale histogram, so that p50/p95 latencies take
+# constant memory and the statistics of worker processes can be merged into
+# the ones of the parent. Counters track files, bytes read and written, and
+# errors. A summary is printed to stderr periodically and at exit, and
+# appended to the JSON lines file when one is given.
+#
+# When disabled, timed() returns a shared no-op context manager and add()
+# returns at once, so the instrumented code pays a function call per item.
+
+import atexit
+import collections
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+ENV_VARIABLE = "DICOM_STATS"
+INTERVAL_ENV_VARIABLE = "DICOM_STATS_INTERVAL"
+DEFAULT_INTERVAL = 10.0
+
+# Histogram buckets per factor e of latency, neighbouring buckets are about 5% apart
+BUCKETS_PER_E = 20
+
+NULL_TIMER = contextlib.nullcontext()
+
+enabled = False
+
+
+def new_stage():
+    return {"count": 0, "seconds": 0.0, "errors": 0, "histogram": collections.Counter()}
+
+def percentile(histogram, fraction):
+    """Return the latency below which the given fraction of the histogram lies, in seconds."""
+    total = sum(histogram.values())
+    if total == 0:
+        return 0.0
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= fraction * total:
+            return math.exp((bucket + 0.5) / BUCKETS_PER_E)
+    return math.exp((max(histogram) + 0.5) / BUCKETS_PER_E)
+
+
+class Stats:
+    """Counters and per-stage latency histograms, safe to update from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.stages = {}
+
+    def record(self, stage, seconds, error=False):
+        bucket = math.floor(math.log(max(seconds, 1e-7)) * BUCKETS_PER_E)
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = new_stage()
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["histogram"][bucket] += 1
+            if error:
+                entry["errors"] += 1
+                self.counters["errors"] += 1
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def drain(self):
+        """Return the statistics gathered so far and start over, to hand them to the parent process."""
+        with self.lock:
+            drained = (self.counters, self.stages)
+            self.counters = collections.Counter()
+            self.stages = {}
+        return drained
+
+    def reset_after_fork(self):
+        """Start a forked child over: it would otherwise hand the statistics inherited from its parent back to it."""
+        # A lock held by another thread when the process forked would never be released in the child
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.stages = {}
+
+    def merge(self, drained):
+        counters, stages = drained
+        with self.lock:
+            self.counters.update(counters)
+            for stage, other in stages.items():
+                entry = self.stages.get(stage)
+                if entry is None:
+                    entry = self.stages[stage] = new_stage()
+                entry["count"] += other["count"]
+                entry["seconds"] += other["seconds"]
+                entry["errors"] += other["errors"]
+                entry["histogram"].update(other["histogram"])
+
+    def summary(self, elapsed):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {stage: dict(entry, histogram=collections.Counter(entry["histogram"])) for stage, entry in self.stages.items()}
+
+        elapsed = max(elapsed, 1e-9)
+        return {
+            "elapsed": round(elapsed, 3),
+            "counters": counters,
+            "files_per_second": round(counters.get("files", 0) / elapsed, 1),
+            "mb_read_per_second": round(counters.get("bytes_read", 0) / 1024 / 1024 / elapsed, 2),
+            "mb_written_per_second": round(counters.get("bytes_written", 0) / 1024 / 1024 / elapsed, 2),
+            "stages": {
+                stage: {
+                    "count": entry["count"],
+                    "seconds": round(entry["seconds"], 3),
+                    "errors": entry["errors"],
+                    "p50_ms": round(percentile(entry["histogram"], 0.5) * 1000, 3),
+                    "p95_ms": round(percentile(entry["histogram"], 0.95) * 1000, 3),
+                }
+                for stage, entry in sorted(stages.items())
+            },
+        }
+
+
+STATS = Stats()
+
+
+class Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        STATS.record(self.stage, time.perf_counter() - self.start, exc_type is not None)
+
+
+def timed(stage):
+    """Time one item of a stage, an exception leaving the block counts as an error. A no-op unless enabled."""
+    if not enabled:
+        return NULL_TIMER
+    return Timer(stage)
+
+def add(counter, amount=1):
+    """Add to a counter (files, bytes_read, bytes_written, errors, or any other name). A no-op unless enabled."""
+    if enabled:
+        STATS.add(counter, amount)
+
+def collect(function, item):
+    """Call function in a worker process, returning its result together with the statistics it gathered."""
+    result = function(item)
+    return result, STATS.drain()
+
+def keep_collected(collected):
+    """Merge the statistics returned by collect into the ones of this process, returning the result."""
+    result, drained = collected
+    STATS.merge(drained)
+    return result
+
+
+def format_summary(summary, final=False):
+    counters = summary["counters"]
+    line = (f"[stats] {'total' if final else 'after'} {summary['elapsed']:.1f} s: {counters.get('files', 0)} files ({summary['files_per_second']}/s), "
+            f"read {counters.get('bytes_read', 0) / 1024 / 1024:.1f} MB ({summary['mb_read_per_second']} MB/s), "
+            f"written {counters.get('bytes_written', 0) / 1024 / 1024:.1f} MB ({summary['mb_written_per_second']} MB/s), "
+            f"{counters.get('errors', 0)} errors")
+    others = [f"{name} {value}" for name, value in sorted(counters.items()) if name not in ("files", "bytes_read", "bytes_written", "errors")]
+    lines = [line + "".join(f", {other}" for other in others)]
+    for stage, entry in summary["stages"].items():
+        errors = f", {entry['errors']} errors" if entry["errors"] else ""
+        lines.append(f"[stats]   {stage}: {entry['count']} in {entry['seconds']:.2f} s, p50 {entry['p50_ms']:.2f} ms, p95 {entry['p95_ms']:.2f} ms{errors}")
+    return lines
+
+
+class Reporter:
+    """Prints the summary to stderr every interval seconds and at exit, and appends it to the JSON lines file."""
+
+    def __init__(self, json_path=None, interval=DEFAULT_INTERVAL):
+        self.start = time.monotonic()
+        self.json_file = open(json_path, "a", buffering=1) if json_path else None
+        self.stopped = threading.Event()
+        if interval and interval > 0:
+            threading.Thread(target=self.run, args=(interval,), daemon=True).start()
+        atexit.register(self.finish)
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.report()
+
+    def report(self, final=False):
+        summary = STATS.summary(time.monotonic() - self.start)
+        for line in format_summary(summary, final):
+            print(line, file=sys.stderr)
+        sys.stderr.flush()
+        if self.json_file is not None:
+            self.json_file.write(json.dumps({"time": time.time(), "final": final, **summary}) + "\n")
+
+    def finish(self):
+        self.stopped.set()
+        self.report(final=True)
+        if self.json_file is not None:
+            self.json_file.close()
+
+
+reporter = None
+
+def enable(json_path=None, interval=DEFAULT_INTERVAL):
+    """Start gathering statistics, and reporting them unless this is a worker process of a pool."""
+    global enabled, reporter
+    enabled = True
+
+    # Worker processes that are spawned rather than forked enable themselves from the environment
+    os.environ[ENV_VARIABLE] = json_path or "1"
+    os.environ[INTERVAL_ENV_VARIABLE] = str(interval)
+
+    if reporter is None and multiprocessing.parent_process() is None:
+        reporter = Reporter(json_path, interval)
+
+def disable():
+    """Report the final summary and stop gathering statistics, so that the next job run in this process starts over."""
+    global enabled, reporter, STATS
+    if reporter is not None:
+        atexit.unregister(reporter.finish)
+        reporter.finish()
+        reporter = None
+    enabled = False
+    STATS = Stats()
+    os.environ.pop(ENV_VARIABLE, None)
+    os.environ.pop(INTERVAL_ENV_VARIABLE, None)
+
+def add_stats_arguments(parser):
+    parser.add_argument("--stats", nargs="?", const="", default=None, metavar="JSON_PATH", help=f"Print timing and throughput statistics to stderr periodically and at exit, and append them as JSON lines to JSON_PATH when given. Also enabled by the {ENV_VARIABLE} environment variable (1 or a JSON lines path).")
+    parser.add_argument("--stats-interval", type=float, default=None, metavar="SECONDS", help=f"Seconds between two periodic reports, 0 only reports at exit. Defaults to {DEFAULT_INTERVAL:g} or {INTERVAL_ENV_VARIABLE}.")
+
+def enable_from_arguments(args):
+    if args.stats is not None:
+        interval = args.stats_interval if args.stats_interval is not None else float(os.environ.get(INTERVAL_ENV_VARIABLE, DEFAULT_INTERVAL))
+        enable(args.stats or None, interval)
+
+
+os.register_at_fork(after_in_child=lambda: STATS.reset_after_fork())
+
+if os.environ.get(ENV_VARIABLE):
+    value = os.environ[ENV_VARIABLE]
+    enable(None if value.lower() in ("1", "true", "yes") else value, float(os.environ.get(INTERVAL_ENV_VARIABLE, DEFAULT_INTERVAL)))
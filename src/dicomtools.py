@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Single entry point for all the scripts: dicomtools.py <command> [arguments].
+#
+# Only the standard library is imported up front, the script of a command
+# (and with it pydicom, numpy, ...) is loaded once the command is known, so
+# that the help and the usage errors come back at interpreter speed. The
+# script runs in this process exactly as if it had been started on its own.
+#
+# "dicomtools.py batch" reads one command line per line of stdin and runs
+# them all in the same process, so that the interpreter start and the heavy
+# imports are only paid once for a whole series of short jobs.
+
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Command name: (script, summary)
+COMMANDS = {
+    "modify-tag": ("modify_dicom_tag.py", "Update a DICOM tag in all .dcm files of a directory."),
+    "create-study": ("create_study_from.py", "Create a new study from an existing study."),
+    "scan-two-tags": ("generalScanTwoTags.py", "List all unique combinations of two tags in a directory of DICOM files."),
+    "scan-modality-bodyparts": ("scan-modality-bodyparts.py", "List the body parts found for each modality in a directory of DICOM files."),
+    "report": ("create_report_for_tags.py", "Extract DICOM tags from every .dcm file in a directory into a report."),
+    "add-frame-of-ref": ("addFrameOfRef.py", "Set a new FrameOfReferenceUID on all DICOM files of a series directory."),
+    "add-modality-to-dir-name": ("addModalityToDirName.py", "Prefix every sub-directory with the modalities of the DICOM files it contains."),
+    "compare": ("compareTwoFiles.py", "Compare the tags, and optionally the pixel data, of two DICOM files or directories."),
+    "jpg-to-dcm": ("jpg_2_dcm.py", "Convert JPEG images to DICOM, copying the metadata of an example DICOM file."),
+    "create-slices": ("create_slice_in_series.py", "Copy the header of a target DICOM file onto other DICOM files, creating new slices in its series."),
+    "export": ("exportToOrthanc.py", "Upload all the DICOM files of a directory to Orthanc."),
+    "download-by-patient": ("downloadFromOrthancByPatient.py", "Download all the studies of the given patients from Orthanc as ZIP archives."),
+    "download-patients": ("downloadPatients.py", "Download all the studies of the given Orthanc patients as zip files."),
+    "generate-corpus": ("generate_corpus.py", "Generate a deterministic synthetic DICOM corpus."),
+    "benchmark": ("benchmark.py", "Benchmark the core function of every script on a synthetic corpus."),
+    "fake-orthanc": ("fake_orthanc.py", "Serve a minimal in-memory Orthanc REST API."),
+}
+
+# The scripts can also be called by their file name, e.g. "dicomtools.py generalScanTwoTags"
+SCRIPT_COMMANDS = {os.path.splitext(script)[0]: command for command, (script, summary) in COMMANDS.items()}
+
+USAGE = "usage: dicomtools.py <command> [arguments]\n       dicomtools.py batch < jobs.txt\n"
+
+
+def print_help():
+    width = max(map(len, COMMANDS))
+    lines = [USAGE, "Commands:"]
+    lines += [f"  {command:<{width}}  {summary}" for command, (script, summary) in COMMANDS.items()]
+    lines += [
+        f"  {'batch':<{width}}  Run one command line per line of stdin in this process.",
+        "",
+        "Run dicomtools.py <command> --help for the arguments of a command.",
+    ]
+    print("\n".join(lines))
+
+def exit_status(code):
+    """Convert the code of a SystemExit to an exit status, the way the interpreter does."""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+def run_command(command, args):
+    """Run the script of a command with args as its command line in this process, returning its exit status."""
+    import runpy
+
+    command = SCRIPT_COMMANDS.get(command, command)
+    if command not in COMMANDS:
+        sys.stderr.write(f"{USAGE}dicomtools.py: error: unknown command '{command}', see dicomtools.py --help\n")
+        return 2
+
+    # The scripts import each other by name, whatever the current directory is
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+
+    argv = sys.argv
+    sys.argv = [argv[0]] + list(args)
+    try:
+        runpy.run_path(os.path.join(SCRIPTS_DIR, COMMANDS[command][0]), run_name="__main__")
+    except SystemExit as e:
+        return exit_status(e.code)
+    finally:
+        sys.argv = argv
+        sys.stdout.flush()
+    return 0
+
+def run_batch(lines):
+    """
+    Run one command line per line, blank lines and lines starting with # are skipped.
+
+    After each job a status line "[dicomtools] exit <status> in <seconds> s: <line>" goes to stderr,
+    once its output was flushed. A failing job does not stop the batch, the exit status is 1 when any job failed.
+    """
+    import shlex
+    import time
+    import traceback
+
+    # --stats given to one job must not carry over to the next ones, unless it was set for the whole batch
+    stats_for_batch = bool(os.environ.get("DICOM_STATS"))
+
+    failed = False
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        start = time.perf_counter()
+        try:
+            command, *args = shlex.split(line)
+            status = run_command(command, args)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+        dicom_stats = sys.modules.get("dicom_stats")
+        if dicom_stats is not None and dicom_stats.enabled and not stats_for_batch:
+            dicom_stats.disable()
+
+        failed = failed or status != 0
+        sys.stderr.write(f"[dicomtools] exit {status} in {time.perf_counter() - start:.3f} s: {line}\n")
+        sys.stderr.flush()
+    return 1 if failed else 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        print_help()
+        return 0 if argv else 2
+    if argv[0] == "batch":
+        if len(argv) > 1:
+            print_help()
+            return 0 if argv[1] in ("-h", "--help") else 2
+        return run_batch(sys.stdin)
+    return run_command(argv[0], argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
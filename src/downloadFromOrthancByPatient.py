@@ -1,71 +1,77 @@
 #!/usr/bin/env python3
 
-import http.client
-import json
-import sys
+import argparse
+import asyncio
 import os
-from urllib.parse import urlparse
 
-def get_response(url_str, method="GET", body=None, headers={}):
-    """Helper function to retrieve response using http.client."""
-    print(f"downloading from {url_str}")
-    url = urlparse(url_str)
-    conn = http.client.HTTPConnection(url.hostname, url.port)
-    conn.request(method, url.path, body, headers)
-    response = conn.getresponse()
-    data = response.read()
-    conn.close()
-    if response.status >= 400:
-        raise Exception(f"HTTP error {response.status}: {data.decode('utf-8')}")
-    return data
+import dicom_stats
+import orthanc_client
+import orthanc_instances
 
-def get_uuid_for_patient(patient_id):
+async def get_uuid_for_patient(client, patient_id):
     """Retrieve the UUID for a given patient ID using the /tools/find endpoint."""
-    url = ORTHANC_URL + "/tools/find"
-    body = json.dumps({
-        "Level": "Patient",
-        "Query": {
-            "PatientID": patient_id
-        }
-    })
-    headers = {"Content-Type": "application/json"}
-    data = get_response(url, method="POST", body=body, headers=headers)
-    return json.loads(data)
+    print(f"downloading from {ORTHANC_URL}/tools/find")
+    return await client.find_patients(patient_id)
 
-def get_studies_for_uuid(uuid):
+async def get_studies_for_uuid(client, uuid):
     """Retrieve a list of study IDs for a given UUID."""
-    url = ORTHANC_URL + f"/patients/{uuid}"
-    data = get_response(url)
-    return json.loads(data).get('Studies', [])
-
-def download_study(study_id, save_path):
-    """Download a study from Orthanc server given its study ID."""
-    url = ORTHANC_URL + f"/studies/{study_id}/archive"
-    data = get_response(url)
+    print(f"downloading from {ORTHANC_URL}/patients/{uuid}")
+    return await client.patient_studies(uuid)
 
+async def download_study(client, study_id, save_path):
+    """Download a study from Orthanc server given its study ID, streaming it to disk in fixed-size chunks."""
+    print(f"downloading from {ORTHANC_URL}/studies/{study_id}/archive")
     file_path = os.path.join(save_path, f"{study_id}.zip")
-    with open(file_path, 'wb') as f:
-        f.write(data)
-
+    await client.download(f"/studies/{study_id}/archive", file_path, description=f"study {study_id}")
     print(f"Downloaded study {study_id} to {file_path}")
 
-def main(patient_ids, save_path):
-    for patient_id in patient_ids:
-        uuids = get_uuid_for_patient(patient_id)
-        for uuid in uuids:
-            study_ids = get_studies_for_uuid(uuid)
-            for study_id in study_ids:
-                download_study(study_id, save_path)
+async def download_instance(client, path, file_path):
+    """Download a single instance, it only gets its final name once it was completely received."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    print(f"downloading from {ORTHANC_URL}{path}")
+    await client.download(path, file_path)
+
+async def download_patients(patient_ids, save_path, workers=4, instances=False):
+    # Instances that are already stored below save_path are not downloaded again
+    local_uids = orthanc_instances.load_local_sop_instance_uids(save_path) if instances else None
+
+    # One more connection than downloads, so that the remaining patients are looked up while the first studies are downloading
+    async with orthanc_client.OrthancClient(ORTHANC_URL, connections=workers + 1) as client:
+        async def list_downloads():
+            for patient_id in patient_ids:
+                uuids = await get_uuid_for_patient(client, patient_id)
+                for uuid in uuids:
+                    study_ids = await get_studies_for_uuid(client, uuid)
+                    for study_id in study_ids:
+                        if not instances:
+                            yield download_study, client, study_id, save_path
+                            continue
+
+                        missing = await orthanc_instances.list_missing_instances(client, study_id, save_path, local_uids)
+                        print(f"Study {study_id}: {len(missing)} instances to download")
+                        for path, file_path in missing:
+                            yield download_instance, client, path, file_path
+
+        await orthanc_instances.run_downloads(list_downloads(), workers)
+
+def main(patient_ids, save_path, workers=4, instances=False):
+    asyncio.run(download_patients(patient_ids, save_path, workers, instances))
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python script_name.py http://localhost:8042 patient_id1 patient_id2 ...")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Download all the studies of the given patients from Orthanc as ZIP archives.", usage="python script_name.py http://localhost:8042 patient_id1 patient_id2 ... [--workers N] [--instances] [--stats [JSON_PATH]]")
+    parser.add_argument("orthanc_url", help="Base URL of the Orthanc server.")
+    parser.add_argument("patient_ids", nargs="*", help="Patient IDs to download.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of studies (or instances with --instances) downloaded concurrently. Defaults to 4.")
+    parser.add_argument("--instances", action="store_true", help="Download the missing instances one by one into a PatientID/StudyInstanceUID/SeriesInstanceUID layout instead of whole study archives.")
+
+    dicom_stats.add_stats_arguments(parser)
+
+    args = parser.parse_intermixed_args()
+    dicom_stats.enable_from_arguments(args)
     print(f"Current working directory: {os.getcwd()}")
     save_path = "."
-    ORTHANC_URL = sys.argv[1]
+    ORTHANC_URL = args.orthanc_url
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    patient_ids = sys.argv[2:]
-    main(patient_ids, save_path)
+    main(args.patient_ids, save_path, args.workers, args.instances)
@@ -1,45 +1,99 @@
 #!/usr/bin/env python3
 
-import requests
-import sys
+import argparse
+import asyncio
 import os
+import zipfile
+
+import dicom_stats
+import orthanc_client
+import orthanc_instances
 
 AUTH = None  # Change to tuple e.g. ('username', 'password') if you have authentication set up
 
-def download_study_as_zip(base_url, study_id, output_folder):
-    """Download the study with the given ID and save it as a zip file."""
-    url = f"{base_url}/studies/{study_id}/archive"
-    response = requests.get(url, auth=AUTH, stream=True)
+ATTEMPTS = 5
+
+
+def create_client(base_url, workers):
+    """Create a client that can keep a connection open for every worker, plus one for the patient lookups."""
+    username, password = AUTH or (None, None)
+    return orthanc_client.OrthancClient(base_url, username, password, connections=workers + 1, retries=ATTEMPTS - 1)
+
 
-    # Check if request was successful
-    response.raise_for_status()
+def is_valid_zip(path):
+    if not zipfile.is_zipfile(path):
+        return False
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return archive.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
 
+async def download_study_as_zip(client, study_id, output_folder):
+    """
+    Download the study with the given ID and save it as a zip file.
+
+    The data goes to a .part file first. An interrupted download is resumed with a Range request
+    (or restarted when the server does not support ranges), and the file only gets its final name
+    once its length, or if the server did not announce one or the download was resumed its zip
+    structure and CRCs, have been checked. A corrupt archive is downloaded again.
+    """
     output_path = os.path.join(output_folder, f"{study_id}.zip")
-    with open(output_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
 
+    if os.path.exists(output_path):
+        print(f"Study {study_id} was already downloaded to {output_path}")
+        return
+
+    await client.download(f"/studies/{study_id}/archive", output_path, resume=True, validate=is_valid_zip, description=f"study {study_id}")
     print(f"Downloaded study {study_id} to {output_path}")
 
 
-def main(base_url, patient_ids):
-    # For each patient ID, get their studies and download them
-    for patient_id in patient_ids:
-        response = requests.get(f"{base_url}/patients/{patient_id}", auth=AUTH)
-        response.raise_for_status()
+async def download_instance(client, path, file_path):
+    """Download a single instance, it only gets its final name once it was completely received."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    await client.download(path, file_path)
+
 
-        patient_data = response.json()
-        study_ids = patient_data.get("Studies", [])
+async def download_patients(base_url, patient_ids, output_folder="downloads", workers=4, instances=False):
+    os.makedirs(output_folder, exist_ok=True)
 
-        for study_id in study_ids:
-            download_study_as_zip(base_url, study_id, "downloads")  # 'downloads' is the folder where zips will be saved
+    # Instances that are already stored below output_folder are not downloaded again
+    local_uids = orthanc_instances.load_local_sop_instance_uids(output_folder) if instances else None
+
+    async with create_client(base_url, workers) as client:
+        # The studies are downloaded while the remaining patients are still being listed
+        async def list_downloads():
+            # For each patient ID, get their studies and download them
+            for patient_id in patient_ids:
+                study_ids = await client.patient_studies(patient_id)
+
+                for study_id in study_ids:
+                    if not instances:
+                        yield download_study_as_zip, client, study_id, output_folder
+                        continue
+
+                    missing = await orthanc_instances.list_missing_instances(client, study_id, output_folder, local_uids)
+                    print(f"Study {study_id}: {len(missing)} instances to download")
+                    for path, file_path in missing:
+                        yield download_instance, client, path, file_path
+
+        await orthanc_instances.run_downloads(list_downloads(), workers)
+
+
+def main(base_url, patient_ids, output_folder="downloads", workers=4, instances=False):
+    asyncio.run(download_patients(base_url, patient_ids, output_folder, workers, instances))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python script_name.py BASE_URL patient_id1 patient_id2 ...")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Download all the studies of the given Orthanc patients as zip files.", usage="python script_name.py BASE_URL patient_id1 patient_id2 ... [--output-folder FOLDER] [--workers N] [--instances] [--stats [JSON_PATH]]")
+    parser.add_argument("base_url", help="Base URL of the Orthanc server.")
+    parser.add_argument("patient_ids", nargs="+", help="Orthanc IDs of the patients to download.")
+    parser.add_argument("--output-folder", default="downloads", help="Folder where the zip files are saved. Defaults to 'downloads'.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of studies (or instances with --instances) downloaded concurrently. Defaults to 4.")
+    parser.add_argument("--instances", action="store_true", help="Download the missing instances one by one into a PatientID/StudyInstanceUID/SeriesInstanceUID layout instead of whole study archives.")
+
+    dicom_stats.add_stats_arguments(parser)
 
-    base_url = sys.argv[1]
-    patient_ids = sys.argv[2:]
-    main(base_url, patient_ids)
+    args = parser.parse_intermixed_args()
+    dicom_stats.enable_from_arguments(args)
+    main(args.base_url, args.patient_ids, args.output_folder, args.workers, args.instances)
@@ -20,116 +20,306 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import base64
-import httplib2
+import argparse
+import asyncio
 import json
 import os
 import os.path
+import sqlite3
 import sys
+import time
 
-if len(sys.argv) != 4 and len(sys.argv) != 6:
-    print("""
+import dicom_stats
+from orthanc_client import OrthancClient
+
+USAGE = """
 Sample script to recursively import in Orthanc all the DICOM files
 that are stored in some path. Please make sure that Orthanc is running
 before starting this script. The files are uploaded through the REST
 API.
 
-Usage: %s [hostname] [HTTP port] [path]
-Usage: %s [hostname] [HTTP port] [path] [username] [password]
+Usage: %s [hostname] [HTTP port] [path] [options]
+Usage: %s [hostname] [HTTP port] [path] [username] [password] [options]
 For instance: %s 127.0.0.1 8042 .
-""" % (sys.argv[0], sys.argv[0], sys.argv[0]))
-    exit(-1)
 
-URL = 'http://%s:%d/instances' % (sys.argv[1], int(sys.argv[2]))
+Options: [--concurrency N] [--retries N] [--manifest PATH] [--preflight] [--stats [JSON_PATH]]
+""" % (sys.argv[0], sys.argv[0], sys.argv[0])
 
 dicom_count = 0
 json_count = 0
+skipped_count = 0
 total_file_count = 0
 
 
-def IsJson(content):
-    try:
-        if (sys.version_info >= (3, 0)):
-            json.loads(content.decode())
-            return True
-        else:
-            json.loads(content)
-            return True
-    except:
+# The files are classified from their first bytes only: DICOM files
+# carry the "DICM" magic right after their 128-byte preamble, while
+# JSON sidecars start (after whitespace) with an object or an array
+SNIFF_SIZE = 132
+
+
+def IsJson(header):
+    if header[128:132] == b'DICM':
         return False
+    return header.lstrip()[:1] in (b'{', b'[')
+
+
+# Reads the SOPInstanceUID of a DICOM file, parsing its header only up
+# to tag (0008,0018)
+def ReadSopInstanceUid(f):
+    from pydicom.filereader import read_partial
+    from pydicom.tag import Tag
+
+    sop_instance_uid_tag = Tag(0x0008, 0x0018)
+    f.seek(0)
+    ds = read_partial(f, stop_when = lambda tag, VR, length: tag > sop_instance_uid_tag,
+                      specific_tags = [ sop_instance_uid_tag ])
+    f.seek(0)
+    return ds.get('SOPInstanceUID')
+
+
+# Local record of the files that are known to be stored in Orthanc,
+# so that an interrupted export can be resumed without sending them
+# again. A file is only skipped if its size and mtime did not change.
+# The rows are committed in batches, every COMMIT_ROWS rows or
+# COMMIT_INTERVAL seconds and on Close, so an interruption can at worst
+# lose the last few seconds of records, and these files are sent again.
+COMMIT_ROWS = 500
+COMMIT_INTERVAL = 5.0
+
+class Manifest:
+    def __init__(self, path):
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                        'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                        'sop_instance_uid TEXT, orthanc_id TEXT)')
 
+    def IsUploaded(self, path):
+        st = os.stat(path)
+        row = self.db.execute('SELECT size, mtime_ns FROM uploads WHERE path = ?',
+                              (os.path.abspath(path),)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns)
 
-# This function will upload a single file to Orthanc through the REST API
-def UploadFile(path):
+    def Record(self, path, sop_instance_uid, orthanc_id):
+        st = os.stat(path)
+        self.db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)',
+                        (os.path.abspath(path), st.st_size, st.st_mtime_ns, sop_instance_uid, orthanc_id))
+        self.pending += 1
+        if self.pending >= COMMIT_ROWS or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.Commit()
+
+    def Commit(self):
+        self.db.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def Close(self):
+        self.Commit()
+        self.db.close()
+
+
+def SkipFile(path, reason):
+    global skipped_count
+    global total_file_count
+
+    sys.stdout.write('Importing %s => skipped (%s)\n' % (path, reason))
+    total_file_count += 1
+    skipped_count += 1
+    dicom_stats.add('skipped')
+
+
+# This function will upload a single file to Orthanc through the REST
+# API, the file is streamed to Orthanc in chunks
+async def UploadFile(client, path, manifest = None):
     global dicom_count
     global json_count
     global total_file_count
 
-    f = open(path, 'rb')
-    content = f.read()
-    f.close()
-    total_file_count += 1
+    with open(path, 'rb') as f:
+        header = f.read(SNIFF_SIZE)
+        total_file_count += 1
 
-    sys.stdout.write('Importing %s' % path)
+        if IsJson(header):
+            sys.stdout.write('Importing %s => ignored JSON file\n' % path)
+            json_count += 1
+            return
 
-    if IsJson(content):
-        sys.stdout.write(' => ignored JSON file\n')
-        json_count += 1
-        return
+        try:
+            status, content = await client.upload(f)
+        except Exception as e:
+            sys.stderr.write(str(e))
+            sys.stdout.write('Importing %s => unable to connect (Is Orthanc running? Is there a password?)\n' % path)
+            return
+
+        if status != 200:
+            sys.stdout.write('Importing %s => failure (Is it a DICOM file? Is there a password?)\n' % path)
+            return
+
+        sys.stdout.write('Importing %s => success\n' % path)
+        dicom_count += 1
+
+        # The file is stored in Orthanc whatever happens here, it is only sent again by the next run
+        if manifest is not None:
+            try:
+                try:
+                    sop_instance_uid = ReadSopInstanceUid(f)
+                except Exception:
+                    sop_instance_uid = None
+                manifest.Record(path, sop_instance_uid, json.loads(content.decode()).get('ID'))
+            except Exception as e:
+                sys.stdout.write('Importing %s => uploaded, but not recorded in the manifest (%s)\n' % (path, e))
+
+
+# Number of SOPInstanceUIDs looked up in Orthanc by a single request
+PREFLIGHT_BATCH_SIZE = 100
+
+
+# Asks Orthanc which of the given files it already stores, with one
+# /tools/find request for the whole batch. Returns the files that
+# still have to be sent.
+async def Preflight(client, paths, manifest = None):
+    uids = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                if f.read(SNIFF_SIZE)[128:132] == b'DICM':
+                    uid = ReadSopInstanceUid(f)
+                    if uid:
+                        uids[path] = str(uid)
+        except Exception:
+            # Let the upload report any problem with this file
+            pass
+
+    if len(uids) == 0:
+        return paths
 
     try:
-        h = httplib2.Http()
+        instances = await client.find('Instance', { 'SOPInstanceUID' : '\\'.join(sorted(set(uids.values()))) },
+                                      expand = True)
+        stored = {}
+        for instance in instances:
+            stored[instance['MainDicomTags']['SOPInstanceUID']] = instance['ID']
+    except Exception:
+        # Without an answer, simply send everything
+        return paths
+
+    remaining = []
+    for path in paths:
+        uid = uids.get(path)
+        if uid in stored:
+            if manifest is not None:
+                manifest.Record(path, uid, stored[uid])
+            SkipFile(path, 'already stored in Orthanc')
+        else:
+            remaining.append(path)
+    return remaining
 
-        headers = { 'content-type' : 'application/dicom' }
 
-        if len(sys.argv) == 6:
-            username = sys.argv[4]
-            password = sys.argv[5]
+def ListFiles(path):
+    if os.path.isfile(path):
+        # Upload a single file
+        yield path
+    else:
+        # Recursively upload a directory
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                yield os.path.join(root, f)
 
-            # h.add_credentials(username, password)
 
-            # This is a custom reimplementation of the
-            # "Http.add_credentials()" method for Basic HTTP Access
-            # Authentication (for some weird reason, this method does
-            # not always work)
-            # http://en.wikipedia.org/wiki/Basic_access_authentication
-            creds_str = username + ':' + password
-            creds_str_bytes = creds_str.encode('ascii')
-            creds_str_bytes_b64 = b'Basic ' + base64.b64encode(creds_str_bytes)
-            headers['authorization'] = creds_str_bytes_b64.decode('ascii')
+# Upload all the files with a pool of concurrent upload tasks. The
+# walker is kept at most a few files ahead of the uploads by a bounded
+# queue. Files recorded in the manifest are skipped, and with preflight
+# the files Orthanc already stores are looked up in batches and skipped.
+async def UploadFiles(client, paths, concurrency = 1, manifest = None, preflight = False):
+    pending = asyncio.Queue(maxsize = 2 * concurrency)
 
-        resp, content = h.request(URL, 'POST', 
-                                  body = content,
-                                  headers = headers)
+    async def Worker():
+        while True:
+            path = await pending.get()
+            if path is None:
+                return
+            await UploadFile(client, path, manifest)
 
-        if resp.status == 200:
-            sys.stdout.write(' => success\n')
-            dicom_count += 1
+    workers = [ asyncio.create_task(Worker()) for i in range(concurrency) ]
+
+    batch = []
+    for path in paths:
+        if manifest is not None and manifest.IsUploaded(path):
+            SkipFile(path, 'already uploaded according to the manifest')
+        elif not preflight:
+            await pending.put(path)
         else:
-            sys.stdout.write(' => failure (Is it a DICOM file? Is there a password?)\n')
+            batch.append(path)
+            if len(batch) == PREFLIGHT_BATCH_SIZE:
+                for remaining in await Preflight(client, batch, manifest):
+                    await pending.put(remaining)
+                batch = []
+
+    if len(batch) > 0:
+        for remaining in await Preflight(client, batch, manifest):
+            await pending.put(remaining)
+
+    for worker in workers:
+        await pending.put(None)
+    await asyncio.gather(*workers)
+
+
+def PrintSummary():
+    if dicom_count + json_count + skipped_count == total_file_count:
+        print('\nSUCCESS: %d DICOM file(s) have been successfully imported' % dicom_count)
+    else:
+        print('\nWARNING: Only %d out of %d file(s) have been successfully imported as DICOM instance(s)' % (dicom_count, total_file_count - json_count - skipped_count))
 
-    except:
-        type, value, traceback = sys.exc_info()
-        sys.stderr.write(str(value))
-        sys.stdout.write(' => unable to connect (Is Orthanc running? Is there a password?)\n')
+    if json_count != 0:
+        print('NB: %d JSON file(s) have been ignored' % json_count)
 
+    if skipped_count != 0:
+        print('NB: %d file(s) were already stored in Orthanc and have been skipped' % skipped_count)
 
-if os.path.isfile(sys.argv[3]):
-    # Upload a single file
-    UploadFile(sys.argv[3])
-else:
-    # Recursively upload a directory
-    for root, dirs, files in os.walk(sys.argv[3]):
-        for f in files:
-            UploadFile(os.path.join(root, f))
+    print('')
 
 
-if dicom_count + json_count == total_file_count:
-    print('\nSUCCESS: %d DICOM file(s) have been successfully imported' % dicom_count)
-else:
-    print('\nWARNING: Only %d out of %d file(s) have been successfully imported as DICOM instance(s)' % (dicom_count, total_file_count - json_count))
+async def Export(base_url, path, username = None, password = None, concurrency = 1, retries = 0,
+                 manifest = None, preflight = False):
+    # One more connection than upload tasks, so that the preflight lookups do not wait for an upload
+    async with OrthancClient(base_url, username, password, connections = concurrency + 1, retries = retries) as client:
+        await UploadFiles(client, ListFiles(path), concurrency, manifest, preflight)
 
-if json_count != 0:
-    print('NB: %d JSON file(s) have been ignored' % json_count)
 
-print('')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage = USAGE)
+    parser.add_argument('hostname')
+    parser.add_argument('port', type = int)
+    parser.add_argument('path')
+    parser.add_argument('username', nargs = '?')
+    parser.add_argument('password', nargs = '?')
+    parser.add_argument('--concurrency', type = int, default = 1,
+                        help = 'Number of files uploaded in parallel, each over a pooled keep-alive connection')
+    parser.add_argument('--retries', type = int, default = 3,
+                        help = 'Number of retries on connection errors and 5xx answers')
+    parser.add_argument('--manifest',
+                        help = 'SQLite file recording the uploaded files, files recorded there are skipped when the export is run again')
+    parser.add_argument('--preflight', action = 'store_true',
+                        help = 'Ask Orthanc in batches which instances it already stores and skip them')
+    dicom_stats.add_stats_arguments(parser)
+    args = parser.parse_args()
+    dicom_stats.enable_from_arguments(args)
+
+    if (args.username is None) != (args.password is None):
+        print(USAGE)
+        exit(-1)
+
+    BASE_URL = 'http://%s:%d' % (args.hostname, args.port)
+    manifest = Manifest(args.manifest) if args.manifest else None
+
+    try:
+        asyncio.run(Export(BASE_URL, args.path, args.username, args.password,
+                           max(1, args.concurrency), args.retries, manifest, args.preflight))
+    finally:
+        if manifest is not None:
+            manifest.Close()
+
+    PrintSummary()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Minimal in-memory stand-in for the Orthanc REST API.
+#
+# It answers the requests of the export and download scripts (uploads,
+# /tools/find, patient, study, series and instance listings, study archives
+# and instance files, with Range support), so that they can be benchmarked
+# and tried out without a real server. Failures and latency can be injected
+# to exercise the retries. Only the standard library and pydicom are used,
+# the instances are kept in memory.
+
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pydicom
+
+PATIENT_TAGS = ("PatientID", "PatientName", "PatientBirthDate", "PatientSex")
+STUDY_TAGS = ("StudyInstanceUID", "StudyDate", "StudyTime", "StudyID", "StudyDescription", "AccessionNumber")
+SERIES_TAGS = ("SeriesInstanceUID", "Modality", "SeriesNumber", "SeriesDescription", "BodyPartExamined")
+INSTANCE_TAGS = ("SOPInstanceUID", "InstanceNumber")
+
+LEVELS = {"Patient": "patients", "Study": "studies", "Series": "series", "Instance": "instances"}
+
+
+def orthanc_id(*uids):
+    """Build an identifier shaped like the ones of Orthanc, which are hashes of the DICOM identifiers."""
+    digest = hashlib.sha1("|".join(uids).encode("utf-8")).hexdigest()
+    return "-".join(digest[i:i + 8] for i in range(0, 40, 8))
+
+def main_tags(ds, keywords):
+    return {keyword: str(ds.get(keyword, "")) for keyword in keywords}
+
+def matches(value, pattern):
+    """Match a /tools/find query value, which can be a list separated by backslashes with * and ? wildcards."""
+    for alternative in pattern.split("\\"):
+        regex = re.escape(alternative).replace(r"\*", ".*").replace(r"\?", ".")
+        if re.fullmatch(regex, value, re.IGNORECASE):
+            return True
+    return False
+
+
+class FakeOrthanc:
+    """
+    In-memory Orthanc server.
+
+    A fail_rate share of the uploads and downloads is answered with 503, and every request waits latency
+    seconds first. The random failures are seeded, so that runs can be repeated.
+    """
+
+    def __init__(self, fail_rate=0.0, latency=0.0, seed=0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+
+        self.resources = {"patients": {}, "studies": {}, "series": {}, "instances": {}}
+        self.files = {}
+        self.archives = {}
+        self.statistics = {"Requests": 0, "InjectedFailures": 0, "Uploads": 0, "DownloadedBytes": 0}
+
+    def store(self, data):
+        """Store a DICOM file, returning the HTTP status and the answer of Orthanc."""
+        try:
+            ds = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)
+            patient_id, study_uid, series_uid, sop_uid = str(ds.PatientID), str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID), str(ds.SOPInstanceUID)
+        except Exception as e:
+            return 400, {"Message": f"Bad file format: {e}"}
+
+        patient = orthanc_id(patient_id)
+        study = orthanc_id(patient_id, study_uid)
+        series = orthanc_id(patient_id, study_uid, series_uid)
+        instance = orthanc_id(patient_id, study_uid, series_uid, sop_uid)
+
+        with self.lock:
+            self.statistics["Uploads"] += 1
+            status = "AlreadyStored" if instance in self.files else "Success"
+            self.files[instance] = data
+            self.archives.pop(study, None)
+
+            resources = self.resources
+            resources["patients"].setdefault(patient, {"ID": patient, "Type": "Patient", "MainDicomTags": main_tags(ds, PATIENT_TAGS), "Studies": []})
+            resources["studies"].setdefault(study, {"ID": study, "Type": "Study", "ParentPatient": patient, "MainDicomTags": main_tags(ds, STUDY_TAGS), "PatientMainDicomTags": main_tags(ds, PATIENT_TAGS), "Series": []})
+            resources["series"].setdefault(series, {"ID": series, "Type": "Series", "ParentStudy": study, "MainDicomTags": main_tags(ds, SERIES_TAGS), "Instances": []})
+            resources["instances"][instance] = {"ID": instance, "Type": "Instance", "ParentSeries": series, "MainDicomTags": main_tags(ds, INSTANCE_TAGS), "FileSize": len(data)}
+            for level, parent, field, child in (("patients", patient, "Studies", study), ("studies", study, "Series", series), ("series", series, "Instances", instance)):
+                children = resources[level][parent][field]
+                if child not in children:
+                    children.append(child)
+
+        return 200, {"ID": instance, "Path": f"/instances/{instance}", "Status": status, "ParentPatient": patient, "ParentStudy": study, "ParentSeries": series}
+
+    def load_directory(self, path):
+        """Store every DICOM file below path, returning the number of stored files."""
+        import dicom_scan
+
+        count = 0
+        for filepath in dicom_scan.iter_files(path, extension=None):
+            with open(filepath, "rb") as f:
+                if self.store(f.read())[0] == 200:
+                    count += 1
+        return count
+
+    def study_instances(self, study):
+        return [instance for series in self.resources["studies"][study]["Series"] for instance in self.resources["series"][series]["Instances"]]
+
+    def find(self, query):
+        level = LEVELS.get(query.get("Level"))
+        if level is None:
+            return 400, {"Message": "Unknown level"}
+
+        found = []
+        for resource in self.resources[level].values():
+            tags = {**resource.get("PatientMainDicomTags", {}), **resource["MainDicomTags"]}
+            if all(matches(tags.get(keyword, ""), str(pattern)) for keyword, pattern in query.get("Query", {}).items()):
+                found.append(resource if query.get("Expand") else resource["ID"])
+        return 200, found
+
+    def archive(self, study):
+        """Return the zip archive of a study, built once until the study changes."""
+        with self.lock:
+            if study not in self.archives:
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+                    for instance in self.study_instances(study):
+                        archive.writestr(f"{instance}.dcm", self.files[instance])
+                self.archives[study] = buffer.getvalue()
+            return self.archives[study]
+
+    def get(self, path):
+        """Answer a GET request, returning the HTTP status and the JSON answer, or the raw bytes of a file."""
+        parts = path.strip("/").split("/")
+        if parts == ["system"]:
+            return 200, {"Name": "FakeOrthanc", "Version": "fake"}
+        if parts == ["statistics"]:
+            counts = {f"Count{key.capitalize()}": len(value) for key, value in self.resources.items()}
+            return 200, {**counts, **self.statistics}
+        if len(parts) == 1 and parts[0] in self.resources:
+            return 200, list(self.resources[parts[0]])
+        if len(parts) < 2 or parts[0] not in self.resources or parts[1] not in self.resources[parts[0]]:
+            return 404, {"Message": "Unknown resource"}
+
+        level, identifier = parts[0], parts[1]
+        if len(parts) == 2:
+            return 200, self.resources[level][identifier]
+        if level == "studies" and parts[2] == "series":
+            return 200, [self.resources["series"][series] for series in self.resources["studies"][identifier]["Series"]]
+        if level == "studies" and parts[2] == "instances":
+            return 200, [self.resources["instances"][instance] for instance in self.study_instances(identifier)]
+        if level == "studies" and parts[2] == "archive":
+            return 200, self.archive(identifier)
+        if level == "instances" and parts[2] == "file":
+            return 200, self.files[identifier]
+        return 404, {"Message": "Unknown resource"}
+
+    def inject_failure(self):
+        with self.lock:
+            if self.fail_rate and self.random.random() < self.fail_rate:
+                self.statistics["InjectedFailures"] += 1
+                return True
+            return False
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Start serving in a background thread, returning the base URL."""
+        self.server = ThreadingHTTPServer((host, port), type("Handler", (RequestHandler,), {"orthanc": self}))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, without this every answer waits for a delayed ACK
+    disable_nagle_algorithm = True
+    orthanc = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, answer, headers={}):
+        body = answer if isinstance(answer, bytes) else json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if isinstance(answer, bytes) else "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_bytes(self, data):
+        """Send a file, or the part of it asked for with a Range: bytes=<start>- header."""
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+        if start and start >= len(data):
+            return self.reply(416, {"Message": "Range not satisfiable"}, {"Content-Range": f"bytes */{len(data)}"})
+
+        with self.orthanc.lock:
+            self.orthanc.statistics["DownloadedBytes"] += len(data) - start
+        if match is None:
+            return self.reply(200, data, {"Accept-Ranges": "bytes"})
+        self.reply(206, data[start:], {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"})
+
+    def begin(self):
+        with self.orthanc.lock:
+            self.orthanc.statistics["Requests"] += 1
+        if self.orthanc.latency:
+            time.sleep(self.orthanc.latency)
+
+    def do_POST(self):
+        self.begin()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/instances":
+            if self.orthanc.inject_failure():
+                return self.reply(503, {"Message": "Injected failure"})
+            return self.reply(*self.orthanc.store(body))
+        if self.path == "/tools/find":
+            return self.reply(*self.orthanc.find(json.loads(body)))
+        self.reply(404, {"Message": "Unknown resource"})
+
+    def do_GET(self):
+        self.begin()
+        status, answer = self.orthanc.get(self.path)
+        if isinstance(answer, bytes):
+            if self.orthanc.inject_failure():
+                return self.reply(503, {"Message": "Injected failure"})
+            return self.reply_bytes(answer)
+        self.reply(status, answer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a minimal in-memory Orthanc REST API.", usage="fake_orthanc.py [--host HOST] [--port PORT] [--load DIRECTORY] [--fail-rate F] [--latency SECONDS] [--seed N]")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. Defaults to 127.0.0.1.")
+    parser.add_argument("--port", type=int, default=8042, help="Port to listen on. Defaults to 8042.")
+    parser.add_argument("--load", help="Directory whose DICOM files are stored before serving.")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of the uploads and downloads answered with 503. Defaults to 0.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request waits before it is answered. Defaults to 0.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected failures. Defaults to 0.")
+
+    args = parser.parse_args()
+    orthanc = FakeOrthanc(args.fail_rate, args.latency, args.seed)
+    if args.load:
+        print(f"Stored {orthanc.load_directory(args.load)} instances from {args.load}")
+
+    url = orthanc.serve(args.host, args.port)
+    print(f"Serving on {url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        orthanc.stop()
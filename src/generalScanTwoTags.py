@@ -1,51 +1,72 @@
 #!/usr/bin/env python3
 
-import os
+import argparse
+import functools
 import pydicom
-import sys
 
+import dicom_index
+import dicom_scan
+import dicom_stats
 
-def scan_directory_for_dicom(base_dir, tag1, tag2):
+
+def add_two_tags(dicom_info, ds, tag1, tag2):
+    tag1_result = ds.get(tag1, "")
+    tag2_result = ds.get(tag2, "")
+
+    # Handle MultiValue (the metadata index returns those as lists)
+    if isinstance(tag1_result, (pydicom.multival.MultiValue, list)):
+        tag1_result = tuple(tag1_result)
+    if isinstance(tag2_result, (pydicom.multival.MultiValue, list)):
+        tag2_result = tuple(tag2_result)
+
+    if tag1_result not in dicom_info:
+        dicom_info[tag1_result] = set()
+
+    dicom_info[tag1_result].add(tag2_result)
+
+def scan_two_tags_batch(filepaths, tag1, tag2):
     dicom_info = {}
 
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            if file.lower().endswith(".dcm"):
-                filepath = os.path.join(root, file)
-                try:
-                    ds = pydicom.dcmread(filepath)
-                    tag1_result = ds.get(tag1, "")
-                    tag2_result = ds.get(tag2, "")
-                    
-                    # Handle MultiValue
-                    if isinstance(tag1_result, pydicom.multival.MultiValue):
-                        tag1_result = tuple(tag1_result)
-                    if isinstance(tag2_result, pydicom.multival.MultiValue):
-                        tag2_result = tuple(tag2_result)
-                    
-                    if tag1_result not in dicom_info:
-                        dicom_info[tag1_result] = set()
-                    
-                    dicom_info[tag1_result].add(tag2_result)
-                except Exception as e:
-                    print(f"Failed to read {filepath}: {e}")
-                    
+    for filepath in filepaths:
+        try:
+            ds = dicom_scan.read_header(filepath, [tag1, tag2])
+            add_two_tags(dicom_info, ds, tag1, tag2)
+        except Exception as e:
+            print(f"Failed to read {filepath}: {e}")
+
+    return dicom_info
+
+def scan_directory_for_dicom(base_dir, tag1, tag2, workers=None, use_threads=False, index_path=None, use_index=False):
+    if use_index:
+        relpaths = dicom_index.update_index(base_dir, index_path, workers, use_threads)
+        dicom_info = {}
+        for filepath, values, error in dicom_index.query_index(base_dir, relpaths, [tag1, tag2], index_path):
+            if error is not None:
+                print(f"Failed to read {filepath}: {error}")
+                continue
+            add_two_tags(dicom_info, values, tag1, tag2)
+    else:
+        scan_batch = functools.partial(scan_two_tags_batch, tag1=tag1, tag2=tag2)
+        dicom_info = dicom_scan.scan_directory(base_dir, scan_batch, dicom_scan.merge_dict_of_sets, {}, workers, use_threads)
+
     # Convert sets to lists for easier JSON serialization later if needed
     for key in dicom_info:
         dicom_info[key] = list(dicom_info[key])
-        
-    return dicom_info
 
+    return dicom_info
 
 if __name__ == "__main__":
-    if len(sys.argv) !=4:
-        print("Usage: python script_name.py <directory_path> tag1 tag2")
-        sys.exit(1)
-
-    base_directory = sys.argv[1]
-    tag1 = sys.argv[2]
-    tag2 = sys.argv[3]
-    result = scan_directory_for_dicom(base_directory, tag1, tag2)
+    parser = argparse.ArgumentParser(description="List all unique combinations of two tags in a directory of DICOM files.", usage="generalScanTwoTags.py <directory_path> tag1 tag2 [--workers N] [--threads] [--index] [--index-path INDEX_PATH] [--stats [JSON_PATH]]")
+    parser.add_argument("directory", help="Path to the directory containing the DICOM files.")
+    parser.add_argument("tag1", help="Tag to group by.")
+    parser.add_argument("tag2", help="Tag whose unique values are listed for each value of tag1.")
+    dicom_scan.add_scan_arguments(parser)
+    dicom_index.add_index_arguments(parser)
+    dicom_stats.add_stats_arguments(parser)
+
+    args = parser.parse_args()
+    dicom_stats.enable_from_arguments(args)
+    result = scan_directory_for_dicom(args.directory, args.tag1, args.tag2, args.workers, args.threads, args.index_path, args.index or args.index_path is not None)
 
     for modality, body_parts in result.items():
         print(f"{modality}={body_parts}")
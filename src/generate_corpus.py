@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Deterministic synthetic DICOM corpus for benchmarks and manual testing.
+#
+# Builds a tree of CT/MR/CR-like series of a configurable number of
+# patients, studies, series and slices, optionally with multi-frame files
+# and non-DICOM noise (JSON sidecars, random bytes and truncated files named
+# .dcm). Every series is written from one header template whose per-slice
+# values are updated in place, as jpg_2_dcm.py and create_slice_in_series.py
+# do with their example files. The same arguments always produce the same
+# files, so that benchmark runs can be compared with each other.
+
+import argparse
+import functools
+import json
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+
+import dicom_scan
+
+MODALITIES = {
+    "CT": {
+        "sop_class_uid": pydicom.uid.CTImageStorage,
+        "body_parts": ("HEAD", "CHEST", "ABDOMEN"),
+        "pixel_representation": 1,
+        "tags": {"RescaleIntercept": "-1024", "RescaleSlope": "1", "KVP": "120", "SliceThickness": "2.5"},
+    },
+    "MR": {
+        "sop_class_uid": pydicom.uid.MRImageStorage,
+        "body_parts": ("BRAIN", "KNEE", "SPINE"),
+        "pixel_representation": 0,
+        "tags": {"MagneticFieldStrength": "1.5", "EchoTime": "10", "RepetitionTime": "500", "SliceThickness": "4"},
+    },
+    "CR": {
+        "sop_class_uid": pydicom.uid.ComputedRadiographyImageStorage,
+        "body_parts": ("CHEST", "HAND", "PELVIS"),
+        "pixel_representation": 0,
+        "tags": {"ViewPosition": "PA"},
+    },
+}
+
+MULTIFRAME_SOP_CLASS_UID = pydicom.uid.MultiFrameGrayscaleWordSecondaryCaptureImageStorage
+
+TRANSFER_SYNTAXES = {"explicit": ExplicitVRLittleEndian, "implicit": ImplicitVRLittleEndian}
+
+NOISE_KINDS = ("json", "random", "truncated")
+
+
+def corpus_uid(seed, *parts):
+    """Return a UID that only depends on the seed and the position of the object in the corpus."""
+    return generate_uid(entropy_srcs=[str(seed)] + [str(part) for part in parts])
+
+def make_template(modality, rows, columns, transfer_syntax_uid):
+    """Create the header shared by all the slices of a modality, without patient, study, series or pixel data."""
+    sop_class_uid = MULTIFRAME_SOP_CLASS_UID if modality == "OT" else MODALITIES[modality]["sop_class_uid"]
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.TransferSyntaxUID = transfer_syntax_uid
+    file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+    template = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    template.SOPClassUID = sop_class_uid
+    template.Modality = modality
+    template.Manufacturer = "useful-dicom-scripts"
+    template.InstitutionName = "Synthetic Hospital"
+    template.ReferringPhysicianName = "Referring^Doctor"
+    template.Rows = rows
+    template.Columns = columns
+    template.SamplesPerPixel = 1
+    template.PhotometricInterpretation = "MONOCHROME2"
+    template.BitsAllocated = 16
+    template.BitsStored = 12
+    template.HighBit = 11
+    template.PixelRepresentation = MODALITIES[modality]["pixel_representation"] if modality in MODALITIES else 0
+    template.PixelSpacing = ["0.7", "0.7"]
+    if modality in ("CT", "MR"):
+        template.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    for keyword, value in MODALITIES.get(modality, {}).get("tags", {}).items():
+        setattr(template, keyword, value)
+    return template
+
+def base_image(seed, modality, rows, columns):
+    """Return a smooth image with some noise, within the 12 bits of the stored values."""
+    rng = np.random.default_rng([seed, rows, columns, ord(modality[0])])
+    y, x = np.mgrid[0:rows, 0:columns]
+    image = 2000 + 1500 * np.sin(x / max(columns, 1) * np.pi) * np.cos(y / max(rows, 1) * np.pi)
+    image += rng.normal(0, 50, (rows, columns))
+    image = np.clip(image, 0, 4095)
+    if modality == "CT":
+        # Signed 12 bits values
+        return np.clip(image - 1024, -1024, 2047).astype(np.int16)
+    return image.astype(np.uint16)
+
+def write_noise(directory, name, kind, seed, sample_path=None):
+    """Write a non-DICOM file, returning its path."""
+    rng = np.random.default_rng([seed, len(name)])
+    if kind == "json":
+        path = os.path.join(directory, name + ".json")
+        with open(path, "w") as f:
+            json.dump({"source": "synthetic", "name": name}, f)
+    elif kind == "random":
+        path = os.path.join(directory, name + ".dcm")
+        with open(path, "wb") as f:
+            f.write(rng.bytes(4096))
+    else:
+        # The first bytes of a real file, cut in the middle of its header
+        path = os.path.join(directory, name + ".dcm")
+        with open(sample_path, "rb") as f:
+            data = f.read(300)
+        with open(path, "wb") as f:
+            f.write(data)
+    return path
+
+def series_directory(output_dir, depth, patient, study, series):
+    parts = [f"patient{patient:03d}", f"study{study:02d}", f"series{series:02d}"][:depth]
+    return os.path.join(output_dir, *parts)
+
+def plan_series(patients, studies, series, modalities, multiframe, transfer_syntax):
+    """Return one item per series to write, in a stable order."""
+    items = []
+    for patient in range(patients):
+        for study in range(studies):
+            for index in range(series):
+                items.append((patient, study, index, modalities[index % len(modalities)]))
+            if multiframe:
+                items.append((patient, study, series, "OT"))
+
+    plan = []
+    for position, (patient, study, index, modality) in enumerate(items):
+        if transfer_syntax == "mixed":
+            transfer_syntax_uid = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)[position % 2]
+        else:
+            transfer_syntax_uid = TRANSFER_SYNTAXES[transfer_syntax]
+        plan.append((patient, study, index, modality, transfer_syntax_uid))
+    return plan
+
+def write_series_batch(items, output_dir, depth, instances, rows, columns, multiframe, frames, noise, seed):
+    """Write the series of a batch, returning the number of files and bytes written."""
+    files, size = 0, 0
+    for patient, study, index, modality, transfer_syntax_uid in items:
+        directory = series_directory(output_dir, depth, patient, study, index)
+        os.makedirs(directory, exist_ok=True)
+        prefix = f"{modality}_{patient:03d}_{study:02d}_{index:02d}"
+
+        ds = make_template(modality, rows, columns, transfer_syntax_uid)
+        ds.PatientID = f"PAT{patient:05d}"
+        ds.PatientName = f"Synthetic^Patient{patient:05d}"
+        ds.PatientBirthDate = f"{1940 + patient % 60}0101"
+        ds.PatientSex = "MF"[patient % 2]
+        ds.StudyInstanceUID = corpus_uid(seed, patient, study)
+        ds.StudyID = str(study + 1)
+        ds.StudyDate = f"2020{1 + study % 12:02d}{1 + patient % 28:02d}"
+        ds.StudyTime = "120000"
+        ds.AccessionNumber = f"ACC{patient:05d}{study:02d}"
+        ds.StudyDescription = f"Synthetic study {study}"
+        ds.SeriesInstanceUID = corpus_uid(seed, patient, study, index)
+        ds.SeriesNumber = index + 1
+        ds.SeriesDescription = f"Synthetic {modality} series {index}"
+        ds.FrameOfReferenceUID = corpus_uid(seed, patient, study, "frame")
+        body_parts = MODALITIES.get(modality, {}).get("body_parts", ("WHOLEBODY",))
+        ds.BodyPartExamined = body_parts[(patient + study + index) % len(body_parts)]
+
+        image = base_image(seed, modality if modality in MODALITIES else "MR", rows, columns)
+        count = multiframe if modality == "OT" else instances
+        sample_path = None
+        for instance in range(count):
+            # The per-slice values are updated in place, the template is never copied again
+            ds.SOPInstanceUID = corpus_uid(seed, patient, study, index, instance)
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            ds.InstanceNumber = instance + 1
+            if modality == "OT":
+                ds.NumberOfFrames = frames
+                pixels = np.stack([np.roll(image, instance + frame, axis=1) for frame in range(frames)])
+            else:
+                pixels = np.roll(image, instance, axis=0)
+            if "ImageOrientationPatient" in ds:
+                ds.ImagePositionPatient = ["-90", "-90", f"{instance * 2.5:.1f}"]
+                ds.SliceLocation = f"{instance * 2.5:.1f}"
+            ds.PixelData = pixels.tobytes()
+
+            path = os.path.join(directory, f"{prefix}_{instance:05d}.dcm")
+            ds.save_as(path)
+            sample_path = sample_path or path
+            files += 1
+            size += os.path.getsize(path)
+
+        for number in range(noise if sample_path else 0):
+            path = write_noise(directory, f"{prefix}_noise{number:02d}", NOISE_KINDS[number % len(NOISE_KINDS)], seed, sample_path)
+            files += 1
+            size += os.path.getsize(path)
+
+    return files, size
+
+def merge_totals(result, partial):
+    return result[0] + partial[0], result[1] + partial[1]
+
+def generate_corpus(output_dir, patients=2, studies=2, series=3, instances=20, rows=256, columns=256, depth=3,
+                    modalities=("CT", "MR", "CR"), multiframe=0, frames=10, noise=0, transfer_syntax="explicit",
+                    seed=0, workers=None, use_threads=False):
+    """
+    Write a synthetic corpus under output_dir, returning the number of files and bytes written.
+
+    depth is the number of patient/study/series directory levels (0 writes every file directly into
+    output_dir). Each study also gets multiframe multi-frame files of frames frames, and each series
+    noise non-DICOM files.
+    """
+    plan = plan_series(patients, studies, series, list(modalities), multiframe, transfer_syntax)
+    scan_batch = functools.partial(write_series_batch, output_dir=output_dir, depth=depth, instances=instances, rows=rows,
+                                   columns=columns, multiframe=multiframe, frames=frames, noise=noise, seed=seed)
+    return dicom_scan.run_with_pool(lambda pool: dicom_scan.scan_files(plan, scan_batch, merge_totals, (0, 0), pool, batch_size=1), workers, use_threads)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic DICOM corpus.", usage="generate_corpus.py <output_dir> [--patients N] [--studies N] [--series N] [--instances N] [--rows N] [--columns N] [--depth 0-3] [--modalities CT MR CR] [--multiframe N] [--frames N] [--noise N] [--transfer-syntax explicit|implicit|mixed] [--seed N] [--workers N] [--threads]")
+    parser.add_argument("output_dir", help="Directory the corpus is written to.")
+    parser.add_argument("--patients", type=int, default=2, help="Number of patients. Defaults to 2.")
+    parser.add_argument("--studies", type=int, default=2, help="Number of studies per patient. Defaults to 2.")
+    parser.add_argument("--series", type=int, default=3, help="Number of series per study, their modalities are cycled through. Defaults to 3.")
+    parser.add_argument("--instances", type=int, default=20, help="Number of slices per series. Defaults to 20.")
+    parser.add_argument("--rows", type=int, default=256, help="Rows of each slice. Defaults to 256.")
+    parser.add_argument("--columns", type=int, default=256, help="Columns of each slice. Defaults to 256.")
+    parser.add_argument("--depth", type=int, choices=range(4), default=3, help="Number of patient/study/series directory levels. Defaults to 3.")
+    parser.add_argument("--modalities", nargs="+", choices=sorted(MODALITIES), default=["CT", "MR", "CR"], help="Modalities of the series. Defaults to CT MR CR.")
+    parser.add_argument("--multiframe", type=int, default=0, help="Number of multi-frame files in an extra series of each study. Defaults to 0.")
+    parser.add_argument("--frames", type=int, default=10, help="Number of frames of the multi-frame files. Defaults to 10.")
+    parser.add_argument("--noise", type=int, default=0, help="Number of non-DICOM files per series (JSON sidecars, random bytes and truncated files). Defaults to 0.")
+    parser.add_argument("--transfer-syntax", choices=["explicit", "implicit", "mixed"], default="explicit", help="Explicit or implicit VR little endian, or alternating between series. Defaults to explicit.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the UIDs and pixel data. Defaults to 0.")
+    dicom_scan.add_scan_arguments(parser)
+
+    args = parser.parse_args()
+    files, size = generate_corpus(args.output_dir, args.patients, args.studies, args.series, args.instances, args.rows, args.columns,
+                                  args.depth, args.modalities, args.multiframe, args.frames, args.noise, args.transfer_syntax,
+                                  args.seed, args.workers, args.threads)
+    print(f"Wrote {files} files ({size / 1024 / 1024:.1f} MB) to {args.output_dir}")
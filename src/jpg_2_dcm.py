@@ -1,45 +1,106 @@
 #!/usr/bin/env python3
-import sys
+import argparse
+import copy
+import functools
+import glob
+import operator
+import os
 
 import numpy as np
 import pydicom
 from PIL import Image
-from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, JPEGBaseline8Bit, JPEGExtended12Bit, generate_uid
 
+import dicom_scan
 
-def convert_jpg_to_dcm(jpg_path, example_dcm_path, output_path):
-    # Load the JPEG image
-    jpg_image = Image.open(jpg_path)
-    jpg_data = np.array(jpg_image)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
 
-    # Ensure the image is in RGB format
-    if jpg_data.ndim == 2:  # Grayscale image
-        jpg_data = np.stack((jpg_data,) * 3, axis=-1)  # Convert to RGB
-    elif jpg_data.shape[2] == 4:  # RGBA image
-        jpg_data = jpg_data[:, :, :3]  # Discard alpha channel
+# Frame header (SOF) markers of the JPEG processes whose bitstream can be stored as is
+PASSTHROUGH_TRANSFER_SYNTAXES = {0xC0: JPEGBaseline8Bit, 0xC1: JPEGExtended12Bit}
 
-    # Load the example DICOM file
-    example_dcm = pydicom.dcmread(example_dcm_path)
+# Every SOF marker, DHT (C4), JPG (C8) and DAC (CC) share the range but are no frame headers
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
 
+
+def load_template(example_dcm_path):
+    """Read the example DICOM file once, without its pixel data, to copy the metadata of every converted image from."""
+    return pydicom.dcmread(example_dcm_path, stop_before_pixels=True)
+
+def read_rgb_pixels(jpg_path):
+    # PIL converts grayscale and RGBA images to RGB in a single pass, without intermediate copies
+    with Image.open(jpg_path) as jpg_image:
+        return np.asarray(jpg_image.convert("RGB"))
+
+def read_jpeg_header(jpeg_bytes):
+    """
+    Read the frame header of a JPEG bitstream, without decoding it.
+
+    Returns (SOF marker, precision, rows, columns, components, [(H, V) sampling factors of each component],
+    Adobe color transform or None), or None when jpeg_bytes is not a JPEG bitstream.
+    """
+    if jpeg_bytes[:2] != b"\xff\xd8":
+        return None
+
+    adobe_transform = None
+    position = 2
+    while position + 4 <= len(jpeg_bytes):
+        if jpeg_bytes[position] != 0xFF:
+            return None
+        marker = jpeg_bytes[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a segment
+            position += 2
+            continue
+
+        length = int.from_bytes(jpeg_bytes[position + 2:position + 4], "big")
+        segment = jpeg_bytes[position + 4:position + 2 + length]
+        if marker == 0xEE and segment[:5] == b"Adobe" and len(segment) >= 12:
+            adobe_transform = segment[11]
+        elif marker in SOF_MARKERS:
+            rows = int.from_bytes(segment[1:3], "big")
+            columns = int.from_bytes(segment[3:5], "big")
+            if len(segment) < 6 or len(segment) < 6 + 3 * segment[5]:
+                return None
+            # Component specifications of 3 bytes: identifier, H and V sampling factors, quantization table
+            sampling = [(segment[offset] >> 4, segment[offset] & 0x0F) for offset in range(7, 6 + 3 * segment[5], 3)]
+            return marker, segment[0], rows, columns, segment[5], sampling, adobe_transform
+        elif marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        position += 2 + length
+
+    return None
+
+def new_instance(template, series_instance_uid, instance_number=None):
     # Create a new DICOM file, copying metadata from the example
-    new_dcm = pydicom.Dataset()
-    new_dcm.file_meta = example_dcm.file_meta
-    new_dcm.update(example_dcm)
+    new_dcm = copy.deepcopy(template)
 
     # Set necessary values for the new DICOM file
-    new_dcm.is_little_endian = True
-    new_dcm.is_implicit_VR = False
     new_dcm.SOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
     new_dcm.SOPInstanceUID = generate_uid()
+    new_dcm.file_meta.MediaStorageSOPClassUID = new_dcm.SOPClassUID
+    new_dcm.file_meta.MediaStorageSOPInstanceUID = new_dcm.SOPInstanceUID
     new_dcm.Modality = 'OT'
-    new_dcm.SeriesInstanceUID = example_dcm.SeriesInstanceUID
+    new_dcm.SeriesInstanceUID = series_instance_uid
+    if instance_number is not None:
+        new_dcm.InstanceNumber = instance_number
+    return new_dcm
+
+def build_dicom(template, jpg_data, series_instance_uid, instance_number=None):
+    """Create a new DICOM dataset holding the RGB pixels of jpg_data, with the metadata of template."""
+    new_dcm = new_instance(template, series_instance_uid, instance_number)
 
     # Update pixel data
     rows, columns, _ = jpg_data.shape
     new_dcm.Rows, new_dcm.Columns = rows, columns
-    # new_dcm.PhotometricInterpretation = "RGB"
+    new_dcm.PhotometricInterpretation = "RGB"
     new_dcm.SamplesPerPixel = 3
-    print(example_dcm.PixelRepresentation)
+    new_dcm.PlanarConfiguration = 0
     new_dcm.BitsAllocated = 8
     new_dcm.BitsStored = 8
     new_dcm.HighBit = 7
@@ -47,16 +108,144 @@ def convert_jpg_to_dcm(jpg_path, example_dcm_path, output_path):
     new_dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
 
     # Pixel data should be in RGB format
-    # PIL reads images in RGB format by default, so no additional conversion is necessary
     new_dcm.PixelData = jpg_data.tobytes()
+    # The template was read without its pixel data, the VR of the new element cannot be looked up
+    new_dcm["PixelData"].VR = "OB"
+    return new_dcm
+
+def build_encapsulated_dicom(template, jpeg_bytes, jpeg_header, series_instance_uid, instance_number=None):
+    """
+    Create a new DICOM dataset that stores the JPEG bitstream as is, as a single frame of encapsulated pixel data.
+
+    jpeg_header is the result of read_jpeg_header, whose SOF marker must be in PASSTHROUGH_TRANSFER_SYNTAXES.
+    """
+    marker, precision, rows, columns, components, sampling, adobe_transform = jpeg_header
+    new_dcm = new_instance(template, series_instance_uid, instance_number)
+
+    new_dcm.Rows, new_dcm.Columns = rows, columns
+    new_dcm.SamplesPerPixel = components
+    if components == 1:
+        new_dcm.PhotometricInterpretation = "MONOCHROME2"
+        if "PlanarConfiguration" in new_dcm:
+            del new_dcm.PlanarConfiguration
+    else:
+        # JFIF color images are stored as YCbCr, unless an Adobe marker says they were not transformed
+        if adobe_transform == 0:
+            new_dcm.PhotometricInterpretation = "RGB"
+        else:
+            # Chroma sampled less often than luma is labeled YBR_FULL_422, 4:2:0 included, as PS3.5 8.2.1 asks for JPEG
+            new_dcm.PhotometricInterpretation = "YBR_FULL_422" if sampling[1] != sampling[0] or sampling[2] != sampling[0] else "YBR_FULL"
+        new_dcm.PlanarConfiguration = 0
+    new_dcm.BitsAllocated = 8 if precision <= 8 else 16
+    new_dcm.BitsStored = precision
+    new_dcm.HighBit = precision - 1
+    new_dcm.PixelRepresentation = 0
+    new_dcm.LossyImageCompression = "01"
+    new_dcm.LossyImageCompressionMethod = "ISO_10918_1"
+    new_dcm.file_meta.TransferSyntaxUID = PASSTHROUGH_TRANSFER_SYNTAXES[marker]
+
+    # One fragment per frame behind a basic offset table, odd length bitstreams are padded
+    new_dcm.PixelData = encapsulate([jpeg_bytes], has_bot=True)
+    new_dcm["PixelData"].VR = "OB"
+    new_dcm["PixelData"].is_undefined_length = True
+    return new_dcm
+
+def build_dicom_from_file(template, jpg_path, series_instance_uid, instance_number=None, passthrough=False):
+    """Convert an image file, storing its JPEG bitstream as is with passthrough when its JPEG process allows it."""
+    if passthrough:
+        with open(jpg_path, "rb") as f:
+            jpeg_bytes = f.read()
+        jpeg_header = read_jpeg_header(jpeg_bytes)
+        if jpeg_header is not None and jpeg_header[0] in PASSTHROUGH_TRANSFER_SYNTAXES and jpeg_header[4] in (1, 3):
+            return build_encapsulated_dicom(template, jpeg_bytes, jpeg_header, series_instance_uid, instance_number)
+        print(f"{jpg_path} is not a baseline or extended JPEG image, storing its decoded pixels")
+
+    return build_dicom(template, read_rgb_pixels(jpg_path), series_instance_uid, instance_number)
+
+def convert_jpg_to_dcm(jpg_path, example_dcm_path, output_path, passthrough=False):
+    template = load_template(example_dcm_path)
+    new_dcm = build_dicom_from_file(template, jpg_path, template.SeriesInstanceUID, passthrough=passthrough)
 
     # Save the new DICOM file
     new_dcm.save_as(output_path)
 
+def list_images(source):
+    """Return the JPEG files below a directory, or matching a glob pattern, in a stable order."""
+    if os.path.isdir(source):
+        return sorted(path for path in dicom_scan.iter_files(source, extension=None) if path.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+
+def output_paths(source, images, output_directory):
+    """
+    Return {image: output path}, keeping the path of every image relative to the source directory
+    (or to the deepest directory shared by the images matching a glob pattern) under output_directory.
+
+    Images that would be written to the same output file, e.g. scan.jpg and scan.jpeg, are left out and reported.
+    """
+    if os.path.isdir(source):
+        base_dir = source
+    else:
+        base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in images]) if images else ""
+
+    by_output_path = {}
+    for jpg_path in images:
+        relpath = os.path.relpath(os.path.abspath(jpg_path), os.path.abspath(base_dir))
+        by_output_path.setdefault(os.path.join(output_directory, os.path.splitext(relpath)[0] + ".dcm"), []).append(jpg_path)
+
+    paths = {}
+    for output_path, jpg_paths in by_output_path.items():
+        if len(jpg_paths) == 1:
+            paths[jpg_paths[0]] = output_path
+        else:
+            for jpg_path in jpg_paths:
+                print(f"Failed to convert {jpg_path}: {output_path} would also be written from {', '.join(path for path in jpg_paths if path != jpg_path)}")
+    return paths
+
+def convert_batch(items, template, series_instance_uid, passthrough=False):
+    failures = 0
+    for instance_number, jpg_path, output_path in items:
+        try:
+            new_dcm = build_dicom_from_file(template, jpg_path, series_instance_uid, instance_number, passthrough)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            new_dcm.save_as(output_path)
+            print(f"Converted JPEG to DICOM: {output_path}")
+        except Exception as e:
+            print(f"Failed to convert {jpg_path}: {e}")
+            failures += 1
+    return failures
+
+def convert_series(source, example_dcm_path, output_directory, workers=None, use_threads=False, passthrough=False):
+    """
+    Convert all the JPEG files of a directory or glob pattern into one new series in output_directory.
+
+    The example DICOM file is parsed once. The images share a new SeriesInstanceUID, are numbered in
+    path order and each get their own SOPInstanceUID. The sub-directories of the images are kept in
+    output_directory, images that would overwrite each other's output are not converted.
+    Returns the number of images that failed.
+    """
+    template = load_template(example_dcm_path)
+    series_instance_uid = generate_uid()
+    os.makedirs(output_directory, exist_ok=True)
+
+    images = list_images(source)
+    paths = output_paths(source, images, output_directory)
+    items = [(instance_number, jpg_path, paths[jpg_path]) for instance_number, jpg_path in enumerate((path for path in images if path in paths), 1)]
+    scan_batch = functools.partial(convert_batch, template=template, series_instance_uid=series_instance_uid, passthrough=passthrough)
+    failures = dicom_scan.run_with_pool(lambda pool: dicom_scan.scan_files(items, scan_batch, operator.add, 0, pool), workers, use_threads)
+    return failures + len(images) - len(paths)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python script.py source_jpg example_dcm output_dcm")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Convert JPEG images to DICOM, copying the metadata of an example DICOM file.", usage="python script.py source_jpg example_dcm output_dcm [--passthrough]\n       python script.py source_directory_or_glob example_dcm output_directory [--passthrough] [--workers N] [--threads]")
+    parser.add_argument("source", help="JPEG file to convert, or a directory or quoted glob pattern of JPEG files that are converted into a single new series.")
+    parser.add_argument("example_dcm", help="DICOM file whose metadata is copied.")
+    parser.add_argument("output", help="Output DICOM file, or output directory when converting a series.")
+    parser.add_argument("--passthrough", action="store_true", help="Store the JPEG bitstream as is (JPEG Baseline transfer syntax) instead of decoding it, other images are still decoded.")
+    dicom_scan.add_scan_arguments(parser)
+
+    args = parser.parse_args()
 
-    convert_jpg_to_dcm(sys.argv[1], sys.argv[2], sys.argv[3])
-    print(f"Converted JPEG to DICOM: {sys.argv[3]}")
+    if os.path.isfile(args.source):
+        convert_jpg_to_dcm(args.source, args.example_dcm, args.output, args.passthrough)
+        print(f"Converted JPEG to DICOM: {args.output}")
+    else:
+        convert_series(args.source, args.example_dcm, args.output, args.workers, args.threads, args.passthrough)
@@ -1,28 +1,202 @@
 #!/usr/bin/env python3
 
+import argparse
+import functools
+import operator
 import os
-import sys
+import shutil
+import tempfile
+
 import pydicom
+from pydicom.charset import convert_encodings
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import tag_for_keyword
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import data_element_offset_to_value
+from pydicom.filewriter import write_data_element
+
+import dicom_scan
+import dicom_stats
+
+# Text VRs where trailing spaces are not significant, so a shorter value can be padded up to the old length
+SPACE_PADDED_VRS = {"AE", "CS", "DS", "IS", "LO", "LT", "PN", "SH", "ST", "UC", "UT"}
+
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def encode_value(ds, elem):
+    """Encode the value of elem exactly as it would be stored in the file ds was read from."""
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    fp = DicomBytesIO()
+    fp.is_little_endian = transfer_syntax.is_little_endian
+    fp.is_implicit_VR = transfer_syntax.is_implicit_VR
+    write_data_element(fp, elem, convert_encodings(ds.get("SpecificCharacterSet", "ISO_IR 6")))
+    return fp.getvalue()[data_element_offset_to_value(transfer_syntax.is_implicit_VR, elem.VR):]
+
+def find_in_place_patches(ds, raw_elements):
+    """
+    Return (offset, bytes) pairs that overwrite the changed values directly in the file,
+    or None when at least one of them does not fit into the space of the old value.
+    """
+    if ds.file_meta.TransferSyntaxUID == pydicom.uid.DeflatedExplicitVRLittleEndian:
+        return None
+
+    patches = []
+    for tag, raw in raw_elements.items():
+        # Only plain top level elements that were still untouched in the file can be patched
+        if not isinstance(raw, RawDataElement) or raw.length == 0xFFFFFFFF:
+            return None
+
+        elem = ds[tag]
+        if elem.VR == "SQ" or " or " in elem.VR:
+            return None
+        if raw.VR is not None and raw.VR != elem.VR:
+            return None
+
+        value = encode_value(ds, elem)
+        if len(value) < raw.length and elem.VR in SPACE_PADDED_VRS:
+            value = value.ljust(raw.length, b" ")
+        if len(value) != raw.length:
+            return None
+
+        patches.append((raw.value_tell, value))
+
+    return patches
+
+def copy_file_tail(src, dst, offset):
+    """Append everything from offset to the end of src onto dst, inside the kernel when possible."""
+    dst.flush()
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE, offset)
+                if not copied:
+                    return
+                offset += copied
+        except OSError:
+            # Not supported by this kernel or file system, carry on in user space from where it stopped
+            pass
+
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+def write_patched_header(ds, src, pixel_data_offset, output_path):
+    """Write the modified header followed by the untouched pixel data of src, atomically replacing output_path."""
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            ds.save_as(dst)
+            copy_file_tail(src, dst, pixel_data_offset)
+            dst.flush()
+            os.fsync(dst.fileno())
+        shutil.copymode(src.name, temp_path)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def patch_dicom_file(filepath, changes, output_path=None):
+    """
+    Apply {tag_name: value} changes to a file without reading or rewriting its pixel data.
+
+    Values that fit into the space of the old value are overwritten in place.
+    Otherwise, or when writing to a separate output_path, only the header is rewritten and the
+    pixel data is copied back behind it, through a temporary file that replaces the target once complete.
+    Deflated files have no pixel data offset to copy from and are rewritten in full instead.
+    """
+    with dicom_stats.timed("read"), open(filepath, "rb") as src:
+        ds = pydicom.dcmread(src, stop_before_pixels=True)
+        if ds.file_meta.get("TransferSyntaxUID") == pydicom.uid.DeflatedExplicitVRLittleEndian:
+            # The whole dataset was inflated, so the file position does not point at the pixel data
+            rewrite_dicom_file(filepath, changes, output_path)
+            return
+
+        # dcmread stops right at the start of the pixel data (or at the end of the file)
+        pixel_data_offset = src.tell()
+        dicom_stats.add("bytes_read", pixel_data_offset)
+
+        raw_elements = {}
+        for tag_name, value in changes.items():
+            tag = tag_for_keyword(tag_name)
+            if tag is None:
+                raise ValueError(f"Unknown DICOM keyword {tag_name}")
+            raw_elements[tag] = ds.get_item(tag)
+            setattr(ds, tag_name, value)
+
+        patches = find_in_place_patches(ds, raw_elements) if output_path is None else None
+        if patches is None:
+            with dicom_stats.timed("write"):
+                write_patched_header(ds, src, pixel_data_offset, filepath if output_path is None else output_path)
+            if dicom_stats.enabled:
+                dicom_stats.add("bytes_written", os.path.getsize(filepath if output_path is None else output_path))
+            return
+
+    with dicom_stats.timed("patch"), open(filepath, "r+b") as f:
+        for offset, value in patches:
+            os.pwrite(f.fileno(), value, offset)
+            dicom_stats.add("bytes_written", len(value))
+
+def update_dicom_file(filepath, changes, output_path=None, patch=False):
+    """Apply all {tag_name: value} changes to a file with a single read and write."""
+    dicom_stats.add("files")
+    if patch:
+        patch_dicom_file(filepath, changes, output_path)
+    else:
+        rewrite_dicom_file(filepath, changes, output_path)
+
+def rewrite_dicom_file(filepath, changes, output_path=None):
+    """Apply {tag_name: value} changes by reading the whole file, pixel data included, and saving it again."""
+    output_path = filepath if output_path is None else output_path
+    with dicom_stats.timed("read"):
+        ds = pydicom.dcmread(filepath)
+    if dicom_stats.enabled:
+        dicom_stats.add("bytes_read", os.path.getsize(filepath))
+    for tag_name, value in changes.items():
+        setattr(ds, tag_name, value)
+    with dicom_stats.timed("write"):
+        ds.save_as(output_path)
+    if dicom_stats.enabled:
+        dicom_stats.add("bytes_written", os.path.getsize(output_path))
+
+def update_batch(filepaths, directory, changes, output_directory=None, patch=False):
+    failures = 0
+    for filepath in filepaths:
+        try:
+            output_path = None
+            if output_directory is not None:
+                output_path = os.path.join(output_directory, os.path.relpath(filepath, directory))
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            update_dicom_file(filepath, changes, output_path, patch)
+        except Exception as e:
+            print(f"Failed to process {filepath}: {e}")
+            failures += 1
+    return failures
+
+def update_dicom_tags_in_directory(directory, changes, output_directory=None, patch=False, workers=None, use_threads=False):
+    """
+    Apply a {tag_name: value} mapping to every .dcm file under directory, reading and writing each file once.
+
+    When output_directory is given the modified files are written there with the same layout and
+    the source files are left untouched. Returns the number of files that failed.
+    """
+    scan_batch = functools.partial(update_batch, directory=directory, changes=changes, output_directory=output_directory, patch=patch)
+    return dicom_scan.scan_directory(directory, scan_batch, operator.add, 0, workers, use_threads)
 
-def update_dicom_tag_in_directory(directory, tag_name, value):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(".dcm"):
-                filepath = os.path.join(root, file)
-                try:
-                    ds = pydicom.dcmread(filepath)
-                    setattr(ds, tag_name, value)
-                    ds.save_as(filepath)
-                except Exception as e:
-                    print(f"Failed to process {filepath}: {e}")
+def update_dicom_tag_in_directory(directory, tag_name, value, patch=False, workers=1):
+    update_dicom_tags_in_directory(directory, {tag_name: value}, patch=patch, workers=workers)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python script_name.py <directory_path> <dicom_tag_name> <value>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Update a DICOM tag in all .dcm files of a directory.", usage="modify_dicom_tag.py <directory_path> <dicom_tag_name> <value> [--patch] [--workers N] [--threads] [--stats [JSON_PATH]]")
+    parser.add_argument("directory", help="Path to the directory containing the DICOM files.")
+    parser.add_argument("dicom_tag", help="Name of the DICOM tag to update.")
+    parser.add_argument("value", help="New value of the tag.")
+    parser.add_argument("--patch", action="store_true", help="Only patch the file header, the pixel data is never read or re-encoded.")
+    dicom_scan.add_scan_arguments(parser)
+    dicom_stats.add_stats_arguments(parser)
 
-    directory = sys.argv[1]
-    dicom_tag = sys.argv[2]
-    value = sys.argv[3]
+    args = parser.parse_args()
+    dicom_stats.enable_from_arguments(args)
 
-    update_dicom_tag_in_directory(directory, dicom_tag, value)
+    update_dicom_tags_in_directory(args.directory, {args.dicom_tag: args.value}, patch=args.patch, workers=args.workers, use_threads=args.threads)
@@ -0,0 +1,371 @@
+# Asynchronous client for the Orthanc REST API shared by the export and download scripts.
+#
+# It only uses the standard library: requests are sent over asyncio streams with HTTP/1.1
+# keep-alive connections that are kept in a pool and reused. The number of connections in
+# use is bounded by a semaphore, connection errors and 5xx answers are retried with an
+# exponential backoff, and request and response bodies are streamed in fixed-size chunks,
+# so that memory use does not depend on the size of the files.
+
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import ssl
+from urllib.parse import urlparse
+
+import dicom_stats
+
+CHUNK_SIZE = 1024 * 1024
+
+# Errors after which a request is retried, the connection it was sent over is never reused
+CONNECTION_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+
+class OrthancError(Exception):
+    """Raised when Orthanc answers with an HTTP error."""
+
+    def __init__(self, status, content):
+        super().__init__(f"HTTP error {status}: {content.decode('utf-8', 'replace')}")
+        self.status = status
+        self.content = content
+
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class Response:
+    """Status and headers of an answer, its body is read on demand."""
+
+    def __init__(self, connection, status, headers, method, timeout):
+        self.connection = connection
+        self.status = status
+        self.headers = headers
+        self.timeout = timeout
+
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self.remaining = None if self.chunked or "content-length" not in headers else int(headers["content-length"])
+        self.chunk_left = 0
+        self.will_close = headers.get("connection", "").lower() == "close" or (not self.chunked and self.remaining is None)
+        self.complete = method == "HEAD" or status in (204, 304) or self.remaining == 0
+
+    async def read_chunk(self, size=CHUNK_SIZE):
+        """Return the next part of the body, at most size bytes, or b"" once it was fully read."""
+        if self.complete:
+            return b""
+
+        reader = self.connection.reader
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await wait(reader.readline(), self.timeout)
+                if not line:
+                    raise asyncio.IncompleteReadError(b"", None)
+                self.chunk_left = int(line.split(b";")[0], 16)
+                if self.chunk_left == 0:
+                    # Skip the trailer up to the final empty line
+                    while (await wait(reader.readline(), self.timeout)).strip():
+                        pass
+                    self.complete = True
+                    return b""
+            data = await wait(reader.read(min(size, self.chunk_left)), self.timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", self.chunk_left)
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await wait(reader.readexactly(2), self.timeout)
+            return data
+
+        data = await wait(reader.read(size if self.remaining is None else min(size, self.remaining)), self.timeout)
+        if self.remaining is None:
+            # The body ends when the server closes the connection
+            self.complete = not data
+            return data
+        if not data:
+            raise asyncio.IncompleteReadError(b"", self.remaining)
+        self.remaining -= len(data)
+        self.complete = self.remaining == 0
+        return data
+
+    async def iter_chunks(self, size=CHUNK_SIZE):
+        while True:
+            chunk = await self.read_chunk(size)
+            if not chunk:
+                return
+            yield chunk
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    async def json(self):
+        return json.loads(await self.read())
+
+    def expected_size(self):
+        """Return the full size of the resource announced by the server, if it announced one."""
+        if self.status == 206:
+            # Content-Range: bytes <start>-<end>/<total>
+            total = self.headers.get("content-range", "").rpartition("/")[2]
+            return int(total) if total.isdigit() else None
+        if "content-encoding" in self.headers or self.remaining is None:
+            return None
+        return int(self.headers["content-length"])
+
+
+async def wait(coroutine, timeout):
+    return await (asyncio.wait_for(coroutine, timeout) if timeout else coroutine)
+
+
+class OrthancClient:
+    """
+    Client for one Orthanc server, to be used from a single event loop.
+
+    At most `connections` requests are sent at the same time, each over its own keep-alive
+    connection. Failed requests are retried `retries` times, waiting backoff * 2 ** attempt
+    seconds in between.
+    """
+
+    def __init__(self, base_url, username=None, password=None, connections=4, retries=3, backoff=0.5, timeout=300):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.prefix = url.path.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.headers = {"Host": url.netloc}
+        if username is not None:
+            credentials = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+            self.headers["Authorization"] = f"Basic {credentials}"
+
+        self.semaphore = asyncio.Semaphore(connections)
+        self.idle = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+    async def connect(self):
+        reader, writer = await wait(asyncio.open_connection(self.host, self.port, ssl=self.ssl, limit=CHUNK_SIZE), self.timeout)
+        return Connection(reader, writer)
+
+    async def acquire(self):
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection.reader.at_eof():
+                return connection, True
+            connection.close()
+        return await self.connect(), False
+
+    def release(self, connection, response):
+        if response.complete and not response.will_close:
+            self.idle.append(connection)
+        else:
+            connection.close()
+
+    async def send(self, connection, method, path, body, headers):
+        lines = [f"{method} {self.prefix}{path} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in {**self.headers, **headers}.items()]
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, bytes):
+            lines.append(f"Content-Length: {len(body)}")
+        elif body is not None:
+            # File objects are streamed, so their length has to be given upfront
+            body.seek(0)
+            lines.append(f"Content-Length: {os.fstat(body.fileno()).st_size}")
+
+        writer = connection.writer
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await wait(writer.drain(), self.timeout)
+        await wait(writer.drain(), self.timeout)
+
+        reader = connection.reader
+        status_line = await wait(reader.readline(), self.timeout)
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+
+        response_headers = {}
+        while True:
+            line = (await wait(reader.readline(), self.timeout)).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        if version == "HTTP/1.0" and response_headers.get("connection", "").lower() != "keep-alive":
+            response_headers["connection"] = "close"
+
+        return Response(connection, int(status), response_headers, method, self.timeout)
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, path, body=None, headers={}):
+        """
+        Send a request and yield its response once the status and headers were received.
+
+        body can be bytes, a string or a file object, which is streamed and sent again from its
+        start when the request is retried. The connection goes back to the pool once the body
+        of the response was fully read.
+        """
+        async with self.semaphore:
+            attempt = 0
+            while True:
+                connection, reused = await self.acquire()
+                try:
+                    response = await self.send(connection, method, path, body, headers)
+                except CONNECTION_ERRORS:
+                    connection.close()
+                    if reused:
+                        # The server closed the idle connection in the meantime, try again on another one
+                        continue
+                    if attempt >= self.retries:
+                        raise
+                    dicom_stats.add("retries")
+                else:
+                    if response.status < 500 or attempt >= self.retries:
+                        break
+                    dicom_stats.add("retries")
+                    try:
+                        await response.read()
+                        self.release(connection, response)
+                    except CONNECTION_ERRORS:
+                        connection.close()
+
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+            try:
+                yield response
+            except BaseException:
+                connection.close()
+                raise
+            self.release(connection, response)
+
+    async def call(self, method, path, body=None, headers={}):
+        """Send a request and return the decoded JSON answer, raising OrthancError on HTTP errors."""
+        with dicom_stats.timed("request"):
+            async with self.request(method, path, body, headers) as response:
+                content = await response.read()
+        if response.status >= 400:
+            raise OrthancError(response.status, content)
+        return json.loads(content)
+
+    async def get_json(self, path):
+        return await self.call("GET", path)
+
+    async def post_json(self, path, data):
+        return await self.call("POST", path, json.dumps(data), {"Content-Type": "application/json"})
+
+    async def upload(self, f):
+        """Store the DICOM file f in Orthanc, returning the HTTP status and the raw answer."""
+        dicom_stats.add("files")
+        with dicom_stats.timed("upload"):
+            async with self.request("POST", "/instances", f, {"Content-Type": "application/dicom"}) as response:
+                content = await response.read()
+        if response.status >= 400:
+            dicom_stats.add("errors")
+        elif dicom_stats.enabled:
+            dicom_stats.add("bytes_written", f.tell())
+        return response.status, content
+
+    async def find(self, level, query, expand=False):
+        return await self.post_json("/tools/find", {"Level": level, "Query": query, "Expand": expand})
+
+    async def find_patients(self, patient_id):
+        """Return the Orthanc IDs of the patients with the given PatientID."""
+        return await self.find("Patient", {"PatientID": patient_id})
+
+    async def patient_studies(self, patient_uuid):
+        return (await self.get_json(f"/patients/{patient_uuid}")).get("Studies", [])
+
+    async def study(self, study_id):
+        return await self.get_json(f"/studies/{study_id}")
+
+    async def study_series(self, study_id):
+        return await self.get_json(f"/studies/{study_id}/series")
+
+    async def study_instances(self, study_id):
+        return await self.get_json(f"/studies/{study_id}/instances")
+
+    async def download(self, path, file_path, resume=False, validate=None, description=None):
+        """
+        Stream the answer of a GET request to file_path.
+
+        The data goes to file_path + ".part" first. With resume, an interrupted download carries
+        on with a Range request (or restarts when the server does not support ranges), otherwise
+        it starts over. The file only gets its final name once its length, or if the server did
+        not announce one validate(part_path), has been checked. A resumed download is always checked
+        with validate too, since its length says nothing about the data written before the interruption.
+        """
+        description = description or path
+        part_path = file_path + ".part"
+
+        with dicom_stats.timed("download"):
+            await self.download_to_part(path, file_path, part_path, resume, validate, description)
+        dicom_stats.add("files")
+
+    async def download_to_part(self, path, file_path, part_path, resume, validate, description):
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+            try:
+                async with self.request("GET", path, headers=headers) as response:
+                    if response.status == 416:
+                        # The partial file does not match what the server has, start over
+                        await response.read()
+                        os.remove(part_path)
+                        continue
+                    if response.status >= 400:
+                        raise OrthancError(response.status, await response.read())
+
+                    if offset and (response.status != 206 or not response.headers.get("content-range", "").startswith(f"bytes {offset}-")):
+                        print(f"Server does not support resuming {description}, restarting from the beginning")
+                        offset = 0
+
+                    size = response.expected_size()
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        async for chunk in response.iter_chunks():
+                            f.write(chunk)
+                            dicom_stats.add("bytes_read", len(chunk))
+            except CONNECTION_ERRORS as e:
+                print(f"Download of {description} was interrupted ({e}), {'resuming' if resume else 'retrying'}")
+                dicom_stats.add("retries")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            downloaded = os.path.getsize(part_path)
+            if size is not None and downloaded < size:
+                print(f"Download of {description} is incomplete ({downloaded} of {size} bytes), {'resuming' if resume else 'retrying'}")
+                continue
+            # With an offset, the start of the file was written by an earlier request that may not have been for the same data
+            if (size is not None and downloaded != size) or ((size is None or offset) and validate is not None and not validate(part_path)):
+                print(f"Download of {description} is corrupt, restarting from the beginning")
+                os.remove(part_path)
+                continue
+
+            os.replace(part_path, file_path)
+            return
+
+        raise Exception(f"Failed to download {description} after {self.retries + 1} attempts")
@@ -0,0 +1,102 @@
+# Instance level synchronisation shared by the Orthanc download scripts.
+#
+# Instead of asking Orthanc to build a study archive, the instances of a
+# study are listed and only those whose SOPInstanceUID is not already in
+# the local target tree are fetched, each into
+# <PatientID>/<StudyInstanceUID>/<SeriesInstanceUID>/<SOPInstanceUID>.dcm.
+# The UIDs of the local tree come from the persistent metadata index, so
+# a re-sync only parses the files that changed since the previous one.
+#
+# The downloads are run by a fixed number of workers fed from a bounded
+# queue while the studies are still being listed, so that only a few
+# coroutines are pending at any time, however large the archive is.
+
+import asyncio
+import os
+import re
+
+
+def load_local_sop_instance_uids(target_dir, workers=None):
+    """Return the SOPInstanceUIDs of all the DICOM files already stored under target_dir."""
+    if not os.path.isdir(target_dir):
+        return set()
+
+    # Imported here, so that pydicom is only loaded when instances are downloaded
+    import dicom_index
+
+    relpaths = dicom_index.update_index(target_dir, workers=workers)
+    local_uids = set()
+    for filepath, values, error in dicom_index.query_index(target_dir, relpaths, ["SOPInstanceUID"]):
+        if error is None and values.get("SOPInstanceUID"):
+            local_uids.add(values["SOPInstanceUID"])
+    return local_uids
+
+async def run_downloads(jobs, workers):
+    """
+    Await every (coroutine function, *args) job of the async iterable jobs, at most workers at a time.
+
+    A failed job is reported and does not stop the others, an exception is raised once all jobs ran if any failed.
+    """
+    pending = asyncio.Queue(maxsize=2 * workers)
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        while True:
+            job = await pending.get()
+            if job is None:
+                return
+            function, *args = job
+            try:
+                await function(*args)
+            except Exception as e:
+                print(f"Failed: {e}")
+                failures += 1
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        async for job in jobs:
+            await pending.put(job)
+        for task in tasks:
+            await pending.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        # Only left running when listing the jobs failed
+        for task in tasks:
+            task.cancel()
+
+    if failures:
+        raise Exception(f"{failures} download(s) failed")
+
+def safe_name(value):
+    """Make a tag value usable as a single path component."""
+    return re.sub(r"[^A-Za-z0-9._^-]", "_", str(value)) or "UNKNOWN"
+
+async def list_missing_instances(client, study_id, target_dir, local_uids):
+    """
+    Return (path, file_path) pairs for the instances of a study that are not stored locally yet.
+
+    client is an orthanc_client.OrthancClient, path is the REST path of the instance file. The
+    returned instances are added to local_uids, so that they are not planned twice.
+    """
+    study = await client.study(study_id)
+    patient_id = study.get("PatientMainDicomTags", {}).get("PatientID", "")
+    study_uid = study.get("MainDicomTags", {}).get("StudyInstanceUID", study_id)
+
+    series_uids = {}
+    for series in await client.study_series(study_id):
+        series_uids[series["ID"]] = series.get("MainDicomTags", {}).get("SeriesInstanceUID", series["ID"])
+
+    missing = []
+    for instance in await client.study_instances(study_id):
+        sop_uid = instance.get("MainDicomTags", {}).get("SOPInstanceUID")
+        if sop_uid in local_uids:
+            continue
+
+        series_uid = series_uids.get(instance["ParentSeries"], instance["ParentSeries"])
+        file_path = os.path.join(target_dir, safe_name(patient_id), safe_name(study_uid), safe_name(series_uid), f"{safe_name(sop_uid or instance['ID'])}.dcm")
+        missing.append((f"/instances/{instance['ID']}/file", file_path))
+        if sop_uid:
+            local_uids.add(sop_uid)
+
+    return missing
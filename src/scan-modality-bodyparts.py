@@ -1,30 +1,46 @@
 #!/usr/bin/env python3
 
-import os
-import pydicom
-import sys
+import argparse
 
+import dicom_index
+import dicom_scan
+import dicom_stats
 
-# scan directories for dcm files and generate a set of bodyparts for each modality 
-def scan_directory_for_dicom(base_dir):
+
+def add_modality_bodypart(dicom_info, ds):
+    modality = ds.get("Modality", "")
+    body_part = ds.get("BodyPartExamined", "")
+
+    if modality not in dicom_info:
+        dicom_info[modality] = set()
+
+    dicom_info[modality].add(body_part)
+
+def scan_modality_bodyparts_batch(filepaths):
     dicom_info = {}
 
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            if file.lower().endswith(".dcm"):
-                filepath = os.path.join(root, file)
-                try:
-                    ds = pydicom.dcmread(filepath)
-                    modality = ds.get("Modality", "")
-                    body_part = ds.get("BodyPartExamined", "")
-                    
-                    if modality not in dicom_info:
-                        dicom_info[modality] = set()
-                    
-                    dicom_info[modality].add(body_part)
-                except Exception as e:
-                    print(f"Failed to read {filepath}: {e}")
-                    
+    for filepath in filepaths:
+        try:
+            ds = dicom_scan.read_header(filepath, ["Modality", "BodyPartExamined"])
+            add_modality_bodypart(dicom_info, ds)
+        except Exception as e:
+            print(f"Failed to read {filepath}: {e}")
+
+    return dicom_info
+
+# scan directories for dcm files and generate a set of bodyparts for each modality 
+def scan_directory_for_dicom(base_dir, workers=None, use_threads=False, index_path=None, use_index=False):
+    if use_index:
+        relpaths = dicom_index.update_index(base_dir, index_path, workers, use_threads)
+        dicom_info = {}
+        for filepath, values, error in dicom_index.query_index(base_dir, relpaths, ["Modality", "BodyPartExamined"], index_path):
+            if error is not None:
+                print(f"Failed to read {filepath}: {error}")
+                continue
+            add_modality_bodypart(dicom_info, values)
+    else:
+        dicom_info = dicom_scan.scan_directory(base_dir, scan_modality_bodyparts_batch, dicom_scan.merge_dict_of_sets, {}, workers, use_threads)
+
     # Convert sets to lists for easier JSON serialization later if needed
     for key in dicom_info:
         dicom_info[key] = list(dicom_info[key])
@@ -32,12 +48,15 @@ def scan_directory_for_dicom(base_dir):
     return dicom_info
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script_name.py <directory_path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="List the body parts found for each modality in a directory of DICOM files.", usage="scan-modality-bodyparts.py <directory_path> [--workers N] [--threads] [--index] [--index-path INDEX_PATH] [--stats [JSON_PATH]]")
+    parser.add_argument("directory", help="Path to the directory containing the DICOM files.")
+    dicom_scan.add_scan_arguments(parser)
+    dicom_index.add_index_arguments(parser)
+    dicom_stats.add_stats_arguments(parser)
 
-    base_directory = sys.argv[1]
-    result = scan_directory_for_dicom(base_directory)
+    args = parser.parse_args()
+    dicom_stats.enable_from_arguments(args)
+    result = scan_directory_for_dicom(args.directory, args.workers, args.threads, args.index_path, args.index or args.index_path is not None)
 
     for modality, body_parts in result.items():
         print(f"{modality}={body_parts}")
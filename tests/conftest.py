@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The scripts import each other by name from src/
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    """A small synthetic corpus: one patient, one study, two series of five 64x64 slices."""
+    import generate_corpus
+
+    directory = str(tmp_path_factory.mktemp("corpus"))
+    generate_corpus.generate_corpus(directory, patients=1, studies=1, series=2, instances=5, rows=64, columns=64)
+    return directory
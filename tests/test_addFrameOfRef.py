@@ -0,0 +1,38 @@
+import os
+
+import pydicom
+
+import addFrameOfRef
+import dicom_scan
+
+
+def write_series(corpus, directory, count):
+    """Copy count slices of the corpus to directory, without their FrameOfReferenceUID."""
+    os.makedirs(directory)
+    for index, path in enumerate(sorted(dicom_scan.iter_files(corpus))[:count]):
+        ds = pydicom.dcmread(path)
+        if "FrameOfReferenceUID" in ds:
+            del ds.FrameOfReferenceUID
+        ds.save_as(os.path.join(directory, f"slice{index}.dcm"))
+
+def frames_of_reference(directory):
+    return {pydicom.dcmread(os.path.join(directory, name)).get("FrameOfReferenceUID") for name in os.listdir(directory) if name.startswith("slice")}
+
+def test_recursive_skips_series_with_unreadable_file(corpus, tmp_path, capsys):
+    root = str(tmp_path)
+    for series in ("a", os.path.join("b", "nested"), "c"):
+        write_series(corpus, os.path.join(root, series), 3)
+    junk_path = os.path.join(root, "b", "nested", "junk.dcm")
+    with open(junk_path, "wb") as f:
+        f.write(b"not a DICOM file")
+
+    addFrameOfRef.set_frame_of_reference_recursive(root, workers=1)
+
+    for series in ("a", "c"):
+        uids = frames_of_reference(os.path.join(root, series))
+        assert len(uids) == 1 and None not in uids
+    # The series holding the junk file is left untouched
+    assert frames_of_reference(os.path.join(root, "b", "nested")) == {None}
+    with open(junk_path, "rb") as f:
+        assert f.read() == b"not a DICOM file"
+    assert "Warning: DICOM file junk.dcm can not be read" in capsys.readouterr().out
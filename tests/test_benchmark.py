@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import SRC_DIR
+
+# os.cpu_count() is what a pool gets when no number of workers is given, 4 makes that a real pool on any machine
+SETUP_CHILDREN = """
+import contextlib, os, resource, sys, tempfile
+os.cpu_count = lambda: 4
+sys.path.insert(0, sys.argv[1])
+import benchmark
+with tempfile.TemporaryDirectory() as work_dir, contextlib.ExitStack() as resources:
+    benchmark.bench_index_warm(sys.argv[2], work_dir, int(sys.argv[3]), False, resources)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+"""
+
+
+def run_child(corpus, name, workers):
+    completed = subprocess.run([sys.executable, os.path.join(SRC_DIR, "benchmark.py"), corpus, "--child", name, "--workers", str(workers)],
+                               stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(completed.stdout)
+
+def test_index_warm_setup_starts_no_workers(corpus):
+    # Children reaped during the setup would count in the peak RSS of the timed run
+    for workers in (1, 4):
+        completed = subprocess.run([sys.executable, "-c", SETUP_CHILDREN, SRC_DIR, corpus, str(workers)], stdout=subprocess.PIPE, text=True, check=True)
+        assert int(completed.stdout) == 0
+
+def test_index_warm_peak_rss_does_not_depend_on_workers(corpus):
+    serial = run_child(corpus, "index_warm", 1)
+    parallel = run_child(corpus, "index_warm", 4)
+    assert serial["files"] == parallel["files"] == 10
+    assert abs(serial["peak_rss_mb"] - parallel["peak_rss_mb"]) < 5
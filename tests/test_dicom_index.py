@@ -0,0 +1,43 @@
+import os
+import shutil
+
+import pydicom
+
+import dicom_index
+import dicom_scan
+
+
+def copy_tree(corpus, root, patient_id):
+    """Copy the corpus to root with another PatientID of the same length, keeping the sizes and mtimes of the files."""
+    shutil.copytree(corpus, root)
+    for path in dicom_scan.iter_files(root):
+        stat = os.stat(path)
+        ds = pydicom.dcmread(path)
+        ds.PatientID = patient_id.ljust(len(ds.PatientID), "X")[:len(ds.PatientID)]
+        ds.save_as(path)
+        assert os.path.getsize(path) == stat.st_size
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def patient_ids(root, index_path):
+    relpaths = dicom_index.update_index(root, index_path, workers=1)
+    return {values["PatientID"] for filepath, values, error in dicom_index.query_index(root, relpaths, ["PatientID"], index_path) if error is None}
+
+def test_roots_sharing_an_index_keep_their_own_rows(corpus, tmp_path):
+    first, second = os.path.join(tmp_path, "first"), os.path.join(tmp_path, "second")
+    copy_tree(corpus, first, "A")
+    copy_tree(corpus, second, "B")
+    index_path = os.path.join(tmp_path, "index.sqlite")
+
+    first_ids = patient_ids(first, index_path)
+    second_ids = patient_ids(second, index_path)
+    assert first_ids and all(patient_id.startswith("A") for patient_id in first_ids)
+    assert second_ids and all(patient_id.startswith("B") for patient_id in second_ids)
+
+    # Indexing the second root must not have dropped the rows of the first one
+    conn = dicom_index.open_index(index_path)
+    try:
+        roots = {root for (root,) in conn.execute("SELECT DISTINCT root FROM files")}
+    finally:
+        conn.close()
+    assert roots == {os.path.abspath(first), os.path.abspath(second)}
+    assert patient_ids(first, index_path) == first_ids
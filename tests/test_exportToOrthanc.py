@@ -0,0 +1,31 @@
+import asyncio
+import os
+import shutil
+
+import benchmark
+import dicom_scan
+import exportToOrthanc
+
+
+class BrokenManifest(exportToOrthanc.Manifest):
+    def Record(self, path, sop_instance_uid, orthanc_id):
+        raise OSError("disk full")
+
+
+def test_manifest_failure_keeps_upload_a_success(corpus, tmp_path, capsys):
+    directory = os.path.join(tmp_path, "export")
+    os.makedirs(directory)
+    for path in [path for path in sorted(dicom_scan.iter_files(corpus)) if "noise" not in path][:3]:
+        shutil.copy(path, directory)
+    manifest = BrokenManifest(os.path.join(tmp_path, "manifest.sqlite"))
+    exportToOrthanc.dicom_count = 0
+    try:
+        with benchmark.fake_orthanc() as url:
+            asyncio.run(exportToOrthanc.Export(url, directory, manifest=manifest))
+    finally:
+        manifest.Close()
+
+    out = capsys.readouterr().out
+    assert exportToOrthanc.dicom_count == 3
+    assert "unable to connect" not in out
+    assert out.count("uploaded, but not recorded in the manifest (disk full)") == 3
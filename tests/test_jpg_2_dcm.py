@@ -0,0 +1,22 @@
+import os
+
+import pytest
+from PIL import Image
+from pydicom.uid import generate_uid
+
+import dicom_scan
+import jpg_2_dcm
+
+
+@pytest.mark.parametrize("subsampling, photometric_interpretation", [(0, "YBR_FULL"), (1, "YBR_FULL_422"), (2, "YBR_FULL_422")])
+def test_passthrough_photometric_interpretation_follows_chroma_subsampling(corpus, tmp_path, subsampling, photometric_interpretation):
+    # PIL subsampling 0 is 4:4:4, 1 is 4:2:2 and 2 is 4:2:0
+    jpg_path = os.path.join(tmp_path, "image.jpg")
+    Image.new("RGB", (32, 16), (200, 30, 60)).save(jpg_path, "JPEG", subsampling=subsampling)
+    template = jpg_2_dcm.load_template(sorted(dicom_scan.iter_files(corpus))[0])
+
+    ds = jpg_2_dcm.build_dicom_from_file(template, jpg_path, generate_uid(), passthrough=True)
+
+    assert ds.file_meta.TransferSyntaxUID == jpg_2_dcm.JPEGBaseline8Bit
+    assert ds.PhotometricInterpretation == photometric_interpretation
+    assert (ds.Rows, ds.Columns, ds.SamplesPerPixel) == (16, 32, 3)
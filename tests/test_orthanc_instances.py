@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import orthanc_instances
+
+
+def test_run_downloads_keeps_few_jobs_pending():
+    listed = 0
+    running = 0
+    most_running = 0
+    most_ahead = 0
+    done = []
+
+    async def download(number):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0)
+        running -= 1
+        done.append(number)
+
+    async def list_downloads():
+        nonlocal listed, most_ahead
+        for number in range(1000):
+            listed += 1
+            most_ahead = max(most_ahead, listed - len(done))
+            yield download, number
+
+    asyncio.run(orthanc_instances.run_downloads(list_downloads(), 3))
+
+    assert sorted(done) == list(range(1000))
+    assert most_running <= 3
+    # The running jobs, the queued ones and the one waiting to be queued
+    assert most_ahead <= 3 + 2 * 3 + 1
+
+
+def test_run_downloads_reports_failures_after_the_other_jobs(capsys):
+    done = []
+
+    async def download(number):
+        if number % 10 == 0:
+            raise Exception(f"Failed to download {number}")
+        done.append(number)
+
+    async def list_downloads():
+        for number in range(100):
+            yield download, number
+
+    with pytest.raises(Exception, match="10 download"):
+        asyncio.run(orthanc_instances.run_downloads(list_downloads(), 2))
+
+    assert len(done) == 90
+    assert "Failed to download 50" in capsys.readouterr().out